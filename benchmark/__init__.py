@@ -0,0 +1,248 @@
+"""Throughput and overhead benchmarks for bes
+
+Run the suite with:
+
+  $ python -m benchmark --output results.json
+
+Each scenario logs `events` events through one of the modes below,
+from `concurrency` threads (or asyncio tasks), against a local sink
+that counts what it receives:
+
+* sync: bes.log() sending each event from the calling thread,
+* batched: bes.log() with a bes.batch.BatchEmitter,
+* async: bes.alog() with a bes.aio.AsyncEmitter,
+* trace: a bes.trace.trace()-decorated function, and
+* trace-aggregate: the same, with aggregate=True.
+
+HTTP scenarios also run at each of the GZIP_LEVELS (0 for
+uncompressed bodies), to show the CPU time vs. bytes-on-the-wire
+tradeoff of bes.DEFAULT['gzip_level'].
+
+Results include events per second, per-event latency percentiles
+(the time the caller spends in the logging call), the process CPU
+time (which includes the sink's threads), the bytes the sink
+received, and, with --allocations, the bytes allocated per event
+according to tracemalloc.  Compare result files across versions to
+catch regressions.
+"""
+
+import asyncio as _asyncio
+import datetime as _datetime
+import platform as _platform
+import threading as _threading
+import time as _time
+import tracemalloc as _tracemalloc
+
+import bes as _bes
+import bes.aio as _bes_aio
+import bes.batch as _bes_batch
+import bes.trace as _bes_trace
+
+from . import sinks as _sinks
+
+
+MODES = ['sync', 'batched', 'async', 'trace', 'trace-aggregate']
+PROTOCOLS = ['UDP', 'HTTP']
+PAYLOADS = {
+    'small': {'user': 'jdoe', 'action': 'swims'},
+    'medium': {'user': 'jdoe', 'action': 'swims', 'body': 'x' * 1024},
+    'large': {'user': 'jdoe', 'action': 'swims', 'body': 'x' * 8192},
+    }
+CONCURRENCY = [1, 4, 16]
+GZIP_LEVELS = [0, 1, 6]
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return dict(
+        ('p{}'.format(point),
+         values[min(len(values) - 1, int(point / 100.0 * len(values)))])
+        for point in points)
+
+
+def _sink(protocol):
+    if protocol == 'UDP':
+        return _sinks.UDPSink()
+    return _sinks.HTTPSink()
+
+
+def _run_threads(target, concurrency, events):
+    """Call target() `events` times split across threads
+
+    Returns (wall time, per-call latencies).
+    """
+    per_thread = events // concurrency
+    latencies = [[] for i in range(concurrency)]
+
+    def run(latencies):
+        perf_counter = _time.perf_counter
+        append = latencies.append
+        for i in range(per_thread):
+            start = perf_counter()
+            target()
+            append(perf_counter() - start)
+
+    threads = [
+        _threading.Thread(target=run, args=(latencies[i],))
+        for i in range(concurrency)]
+    start = _time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (_time.perf_counter() - start,
+            [latency for thread in latencies for latency in thread])
+
+
+def _run_async(payload, concurrency, events):
+    per_task = events // concurrency
+    latencies = []
+
+    async def run(emitter):
+        perf_counter = _time.perf_counter
+        for i in range(per_task):
+            start = perf_counter()
+            await _bes.alog(emitter=emitter, **payload)
+            latencies.append(perf_counter() - start)
+            if not i % 100:
+                await _asyncio.sleep(0)  # let the sender task run
+
+    async def main():
+        emitter = _bes_aio.AsyncEmitter()
+        start = _time.perf_counter()
+        await _asyncio.gather(*[run(emitter) for i in range(concurrency)])
+        await emitter.aclose()
+        return _time.perf_counter() - start
+
+    loop = _asyncio.new_event_loop()
+    try:
+        seconds = loop.run_until_complete(main())
+    finally:
+        loop.close()
+    return (seconds, latencies)
+
+
+def _target(mode, payload):
+    """Return a function that logs one event in the given mode"""
+    if mode in ['trace', 'trace-aggregate']:
+        @_bes_trace.trace(aggregate=mode == 'trace-aggregate', interval=1)
+        def target():
+            return payload
+        return target
+
+    def target():
+        return _bes.log(**payload)
+    return target
+
+
+def run_scenario(mode, protocol, payload, concurrency, events,
+                 gzip_level=0):
+    """Run one scenario and return its result dictionary
+
+    bes.DEFAULT is pointed at the sink for the duration of the run,
+    so the scenarios exercise the same code paths as application
+    code calling bes.log().
+    """
+    if not isinstance(payload, dict):
+        payload = PAYLOADS[payload]
+    saved = dict(_bes.DEFAULT)
+    with _sink(protocol) as sink:
+        _bes.DEFAULT.update({
+            'host': '127.0.0.1',
+            'port': sink.port,
+            'protocol': protocol,
+            'type': 'benchmark',
+            'datestamp_index': False,
+            'gzip_level': gzip_level,
+            })
+        cpu_start = _time.process_time()
+        try:
+            if mode == 'async':
+                seconds, latencies = _run_async(
+                    payload=payload, concurrency=concurrency, events=events)
+            else:
+                emitter = None
+                if mode == 'batched':
+                    emitter = _bes.DEFAULT['emitter'] = (
+                        _bes_batch.BatchEmitter())
+                start = _time.perf_counter()
+                _, latencies = _run_threads(
+                    target=_target(mode=mode, payload=payload),
+                    concurrency=concurrency, events=events)
+                if emitter is not None:
+                    emitter.shutdown()
+                _bes_trace.flush_all()
+                seconds = _time.perf_counter() - start
+            message = _bes.encode(payload=payload)
+            cpu_seconds = _time.process_time() - cpu_start
+        finally:
+            _bes.DEFAULT.clear()
+            _bes.DEFAULT.update(saved)
+            _bes.close_all()
+        _time.sleep(0.1)  # let the sink catch up
+    return {
+        'mode': mode,
+        'protocol': protocol,
+        'gzip_level': gzip_level,
+        'payload_bytes': len(message),
+        'concurrency': concurrency,
+        'events': len(latencies),
+        'seconds': seconds,
+        'events_per_second': len(latencies) / seconds,
+        'latency': percentiles(latencies),
+        'cpu_seconds': cpu_seconds,
+        'received_bytes': sink.bytes,
+        }
+
+
+def measure_allocations(mode, protocol, payload, events=1000,
+                        gzip_level=0):
+    """Return memory allocated per event for a single-threaded run"""
+    _tracemalloc.start()
+    try:
+        before = _tracemalloc.get_traced_memory()[0]
+        run_scenario(
+            mode=mode, protocol=protocol, payload=payload, concurrency=1,
+            events=events, gzip_level=gzip_level)
+        current, peak = _tracemalloc.get_traced_memory()
+    finally:
+        _tracemalloc.stop()
+    return {
+        'retained_bytes_per_event': (current - before) / float(events),
+        'peak_bytes_per_event': (peak - before) / float(events),
+        }
+
+
+def run(modes=MODES, protocols=PROTOCOLS, payloads=sorted(PAYLOADS),
+        concurrency=CONCURRENCY, gzip_levels=GZIP_LEVELS, events=10000,
+        allocations=False, progress=None):
+    """Run the benchmark matrix and return a JSON-able result"""
+    results = []
+    for mode in modes:
+        for protocol in protocols:
+            levels = gzip_levels if protocol == 'HTTP' else [0]
+            for payload in payloads:
+                for level in levels:
+                    for threads in concurrency:
+                        result = run_scenario(
+                            mode=mode, protocol=protocol, payload=payload,
+                            concurrency=threads, events=events,
+                            gzip_level=level)
+                        result['payload'] = payload
+                        if allocations and threads == concurrency[0]:
+                            result['allocations'] = measure_allocations(
+                                mode=mode, protocol=protocol,
+                                payload=payload, gzip_level=level)
+                        results.append(result)
+                        if progress is not None:
+                            progress(result)
+    return {
+        'bes_version': _bes.__version__,
+        'python': _platform.python_version(),
+        'implementation': _platform.python_implementation(),
+        'platform': _platform.platform(),
+        'date': _datetime.datetime.utcnow().isoformat(),
+        'results': results,
+        }
@@ -0,0 +1,72 @@
+"""Run the bes benchmarks and write the results as JSON
+"""
+
+import argparse as _argparse
+import json as _json
+import sys as _sys
+
+from . import CONCURRENCY, GZIP_LEVELS, MODES, PAYLOADS, PROTOCOLS, run
+
+
+def _list(value):
+    return value.split(',')
+
+
+def main(args=None):
+    parser = _argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--modes', type=_list, default=MODES,
+        help='comma-separated modes (default: {})'.format(','.join(MODES)))
+    parser.add_argument(
+        '--protocols', type=_list, default=PROTOCOLS,
+        help='comma-separated protocols (default: {})'.format(
+            ','.join(PROTOCOLS)))
+    parser.add_argument(
+        '--payloads', type=_list, default=sorted(PAYLOADS),
+        help='comma-separated payload sizes (default: {})'.format(
+            ','.join(sorted(PAYLOADS))))
+    parser.add_argument(
+        '--concurrency', type=lambda value: [int(x) for x in _list(value)],
+        default=CONCURRENCY,
+        help='comma-separated thread counts (default: {})'.format(
+            ','.join(str(x) for x in CONCURRENCY)))
+    parser.add_argument(
+        '--gzip-levels', type=lambda value: [int(x) for x in _list(value)],
+        default=GZIP_LEVELS,
+        help='comma-separated gzip levels for HTTP, 0 for none '
+        '(default: {})'.format(','.join(str(x) for x in GZIP_LEVELS)))
+    parser.add_argument(
+        '--events', type=int, default=10000,
+        help='events per scenario (default: %(default)s)')
+    parser.add_argument(
+        '--allocations', action='store_true',
+        help='also measure allocations per event with tracemalloc')
+    parser.add_argument(
+        '--output', '-o', help='write JSON results here (default: stdout)')
+    args = parser.parse_args(args)
+
+    def progress(result):
+        _sys.stderr.write(
+            '{mode:>15} {protocol:>4} gzip {gzip_level} {payload:>6} '
+            'x{concurrency:<3} {events_per_second:10.0f} events/s  '
+            'p50 {p50:.1f} us  p99 {p99:.1f} us  '
+            'cpu {cpu_seconds:.2f} s  {received_bytes} bytes\n'.format(
+                p50=result['latency']['p50'] * 1e6,
+                p99=result['latency']['p99'] * 1e6,
+                **result))
+
+    results = run(
+        modes=args.modes, protocols=args.protocols, payloads=args.payloads,
+        concurrency=args.concurrency, gzip_levels=args.gzip_levels,
+        events=args.events,
+        allocations=args.allocations, progress=progress)
+    if args.output:
+        with open(args.output, 'w') as f:
+            _json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        _json.dump(results, _sys.stdout, indent=2, sort_keys=True)
+        _sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Local stand-ins for Elastic Search that just count what they get
+"""
+
+import socket as _socket
+import threading as _threading
+
+from test import http_listener as _http_listener
+from test import udp_listener as _udp_listener
+
+
+class UDPSink (_udp_listener.UDPListener):
+    """Count datagrams until the context manager exits
+
+    Binds to an ephemeral port by default, so check `port` after
+    entering the context.
+    """
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        super(UDPSink, self).__init__(host=host, port=port, **kwargs)
+        self.datagrams = 0
+        self.bytes = 0
+        self._stop = _threading.Event()
+
+    def __enter__(self):
+        result = super(UDPSink, self).__enter__()
+        self.port = self._sock.getsockname()[1]
+        self._sock.settimeout(0.1)
+        self._sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_RCVBUF, 2**24)
+        return result
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        return super(UDPSink, self).__exit__(*exc_info)
+
+    def _listen(self):
+        while not self._stop.is_set():
+            try:
+                data = self._sock.recv(self.bufsize)
+            except _socket.timeout:
+                continue
+            self.datagrams += 1
+            self.bytes += len(data)
+
+
+def _accept(body):
+    return (200, {'took': 0, 'errors': False, 'items': []})
+
+
+class HTTPSink (_http_listener.HTTPListener):
+    """Accept every /_bulk request, counting requests and wire bytes
+
+    The response doesn't list per-item results, so the sink spends as
+    little time as possible holding the GIL.
+    """
+    def __init__(self, respond=_accept, **kwargs):
+        super(HTTPSink, self).__init__(respond=respond, **kwargs)
+        self.count = 0
+        self.bytes = 0
+        self._lock = _threading.Lock()
+
+    def record(self, request):
+        with self._lock:
+            self.count += 1
+            self.bytes += request['length']  # as sent, maybe gzipped
@@ -2,10 +2,22 @@
 Log events to Elastic Search via bulk upload
 """
 
+from __future__ import absolute_import
+
+import atexit as _atexit
+import calendar as _calendar
 import datetime as _datetime
+import errno as _errno
 import json as _json
 import logging as _logging
+import math as _math
+import os as _os
 import socket as _socket
+import threading as _threading
+import time as _time
+
+from . import bulk as _bulk
+from . import serialize as _serialize
 
 
 __version__ = '0.3'
@@ -13,14 +25,287 @@ __version__ = '0.3'
 LOG = _logging.getLogger(__name__)
 
 
-DEFAULT = {
+def is_error(type, payload):
+    """The default priority predicate: errors and error log records
+
+    Matches action='error' events (e.g. from bes.trace) and records
+    logged at ERROR or CRITICAL through bes.logging.
+    """
+    return (payload.get('action') == 'error' or
+            payload.get('level') in ('ERROR', 'CRITICAL'))
+
+
+class _Settings(dict):
+    """A dict that counts its changes (in `version`)
+
+    The default Emitter is rebuilt when DEFAULT's version changes, so
+    log() and emit() pick up new settings without re-reading DEFAULT
+    for every event.
+    """
+    version = 0
+
+    def _changed(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        value = dict.setdefault(self, key, default)
+        self._changed()
+        return value
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._changed()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+
+DEFAULT = _Settings({
     'host': 'localhost',
     'port': 9700,
+    'hosts': None,
+    'balance': 'round_robin',
     'protocol': 'UDP',
     'index': 'log',
     'datestamp_index': True,
+    'datestamp_format': '%Y.%m.%d',
+    'timestamp_format': 'iso',
+    'encoder': 'json',
+    'sampler': None,
     'type': None,
-    }
+    'emitter': None,
+    'timeout': 10,
+    'max_datagram': 1472,
+    'oversize': 'send',
+    'gzip_level': None,
+    'gzip_min_size': 1024,
+    'dns_ttl': 60,
+    'priority': is_error,
+    })
+
+# the largest payload that fits in an IPv4 UDP datagram
+MAX_UDP_PAYLOAD = 65507
+
+_perf_counter = getattr(_time, 'perf_counter', _time.time)
+
+
+class Histogram(object):
+    """A log-scale histogram for durations (or any positive values)
+
+    Values are counted in four buckets per power of two, so
+    percentiles are accurate to within about 12%.  The count, sum,
+    min, and max are exact.  Histograms aren't thread-safe on their
+    own; Counters.observe() locks around them.
+    """
+    buckets_per_octave = 4
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = {}
+
+    def record(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = self._bucket(value)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """Add the values recorded in another Histogram to this one"""
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+
+    def _bucket(self, value):
+        if value <= 0:
+            return None
+        mantissa, exponent = _math.frexp(value)
+        return (exponent * self.buckets_per_octave +
+                int((mantissa - 0.5) * 2 * self.buckets_per_octave))
+
+    def _bucket_value(self, bucket):
+        """The midpoint of a bucket"""
+        if bucket is None:
+            return 0.0
+        exponent, sub_bucket = divmod(bucket, self.buckets_per_octave)
+        mantissa = 0.5 + (sub_bucket + 0.5) / (2.0 * self.buckets_per_octave)
+        return _math.ldexp(mantissa, exponent)
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """Return {percentile: estimate}, clamped to [min, max]"""
+        results = {}
+        if not self.count:
+            return results
+        buckets = sorted(self._buckets.items(), key=lambda item: (
+            item[0] is not None, item[0]))
+        for percentile in percentiles:
+            rank = percentile / 100.0 * self.count
+            seen = 0
+            for bucket, bucket_count in buckets:
+                seen += bucket_count
+                if seen >= rank:
+                    value = self._bucket_value(bucket)
+                    results[percentile] = min(max(value, self.min), self.max)
+                    break
+        return results
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Return count, sum, min, max, and percentiles as a dictionary
+        """
+        summary = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            }
+        for percentile, value in self.percentiles(percentiles).items():
+            summary['p{}'.format(percentile)] = value
+        return summary
+
+
+class Counters(object):
+    """Thread-safe event counters for bes' own bookkeeping
+
+    >>> counters = Counters()
+    >>> counters.increment('sent')
+    >>> counters.increment('bytes', 20)
+    >>> sorted(counters.snapshot().items())
+    [('bytes', 20), ('sent', 1)]
+
+    increment() doesn't take a lock: each thread updates its own
+    counts, and snapshot() adds them up.  Counts from threads that
+    have exited are folded together as new threads register, so
+    short-lived threads don't pile up.  observe() records a value
+    (e.g. a send latency in seconds) in a named Histogram, and
+    register_gauge() adds a callable whose current value is reported
+    by bes.stats() (e.g. a queue depth).
+    """
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self._local = _threading.local()
+        self._threads = []  # (thread, counts) for each counting thread
+        self._retired = {}  # counts from threads that have exited
+        self._prune_at = 64  # len(self._threads) that triggers _prune()
+        self._histograms = {}
+        self._gauges = {}
+
+    def _thread_counts(self):
+        counts = self._local.counts = {}
+        with self._lock:
+            if len(self._threads) >= self._prune_at:
+                self._prune()
+                self._prune_at = max(64, 2 * len(self._threads))
+            self._threads.append((_threading.current_thread(), counts))
+        return counts
+
+    def _prune(self):
+        """Fold exited threads' counts into _retired (hold the lock)"""
+        threads = []
+        for thread, counts in self._threads:
+            if thread.is_alive():
+                threads.append((thread, counts))
+            else:
+                self._merge(self._retired, counts)
+        self._threads = threads
+
+    def increment(self, name, value=1):
+        try:
+            counts = self._local.counts
+        except AttributeError:
+            counts = self._thread_counts()
+        counts[name] = counts.get(name, 0) + value
+
+    def get(self, name):
+        with self._lock:
+            return self._retired.get(name, 0) + sum(
+                counts.get(name, 0) for thread, counts in self._threads)
+
+    def snapshot(self):
+        with self._lock:
+            self._prune()
+            total = dict(self._retired)
+            for thread, counts in self._threads:
+                self._merge(total, dict(counts))
+        return total
+
+    @staticmethod
+    def _merge(total, counts):
+        for name, value in counts.items():
+            total[name] = total.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Record `value` in the histogram called `name`"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.record(value)
+
+    def histograms(self):
+        """Return {name: Histogram.summary()} for each histogram"""
+        with self._lock:
+            return dict(
+                (name, histogram.summary())
+                for name, histogram in self._histograms.items())
+
+    def register_gauge(self, name, function):
+        """Report function()'s current value as `name` in bes.stats()"""
+        self._gauges[name] = function
+
+    def gauges(self):
+        values = {}
+        for name, function in list(self._gauges.items()):
+            try:
+                values[name] = function()
+            except Exception:
+                LOG.exception('unable to read gauge {!r}'.format(name))
+        return values
+
+    def reset(self):
+        """Zero the counters and histograms (gauges are kept)"""
+        with self._lock:
+            for thread, counts in self._threads:
+                counts.clear()
+            self._retired.clear()
+            self._histograms.clear()
+
+    def _after_fork_in_child(self):
+        self._lock = _threading.Lock()
+
+
+COUNTERS = Counters()
 
 
 class Connection(object):
@@ -30,27 +315,139 @@ class Connection(object):
 
     >>> with Connection(host='localhost', port=1234) as c:
     ...     c.send(message='hello!')
+
+    With protocol='HTTP', messages are POSTed to the /_bulk endpoint
+    over persistent HTTP/1.1 connections (see bes.http.BulkClient),
+    and send() returns the parsed bulk response.  `timeout` (in
+    seconds) only applies to HTTP.  If `gzip_level` (1 to 9) is set,
+    bodies of at least `gzip_min_size` bytes are gzipped (with
+    'Content-Encoding: gzip') before they're POSTed.
+
+    With UDP, send() packs as many whole documents into each datagram
+    as fit in `max_datagram` bytes (by default, an Ethernet MTU minus
+    the IP and UDP headers), only splitting messages between
+    documents.  Documents that don't fit in a datagram on their own
+    are handled according to `oversize`:
+
+    * 'send': send them alone anyway (they may be fragmented),
+    * 'truncate': shorten their longest strings until they fit, or
+    * 'reject': log and drop them.
+
+    With protocol='UNIX', `host` is the path of a local Unix datagram
+    socket (see bes.relay), and each message is sent whole.  The
+    socket doesn't block: if the relay falls behind and its receive
+    buffer fills up, messages are dropped (and counted under 'dropped'
+    and 'unix_dropped') rather than stalling the caller.
+
+    If `hosts` (a list of 'host:port' strings or (host, port) tuples)
+    is set, it's used instead of `host`, and sends are spread across
+    the endpoints according to `balance`, with failover (see
+    bes.endpoints).  The balancer is available as `endpoints`; it's
+    shared by every Connection to the same endpoints, so their health
+    outlives any one connection.
+
+    UDP host names are resolved through bes.dns.RESOLVER, which caches
+    them, so sends don't wait on the system resolver.  IPv4 is
+    preferred for names with both kinds of address.  IPv4 and IPv6
+    addresses each get their own socket.
     """
-    def __init__(self, host=None, port=None, protocol=None):
+    def __init__(self, host=None, port=None, protocol=None, timeout=None,
+                 max_datagram=None, oversize=None, gzip_level=None,
+                 gzip_min_size=None, hosts=None, balance=None):
         if host is None:
             host = DEFAULT['host']
         if port is None:
             port = DEFAULT['port']
+        if hosts is None:
+            hosts = DEFAULT['hosts']
+        if balance is None:
+            balance = DEFAULT['balance']
         if protocol is None:
             protocol = DEFAULT['protocol']
+        if timeout is None:
+            timeout = DEFAULT['timeout']
+        if max_datagram is None:
+            max_datagram = DEFAULT['max_datagram']
+        if oversize is None:
+            oversize = DEFAULT['oversize']
+        if oversize not in ['send', 'truncate', 'reject']:
+            raise ValueError(oversize)
+        if gzip_level is None:
+            gzip_level = DEFAULT['gzip_level']
+        if gzip_min_size is None:
+            gzip_min_size = DEFAULT['gzip_min_size']
         self.host = host
         self.port = port
+        self.protocol = protocol
+        self.timeout = timeout
+        self.max_datagram = max_datagram
+        self.oversize = oversize
+        self.gzip_level = gzip_level
+        self.gzip_min_size = gzip_min_size
         if protocol == 'UDP':
             self.socket_type = _socket.SOCK_DGRAM
+        elif protocol == 'HTTP':
+            self.socket_type = _socket.SOCK_STREAM
+        elif protocol == 'UNIX':
+            self.socket_type = _socket.SOCK_DGRAM
         else:
             raise NotImplementedError(protocol)
-        self._sock = None
+        self.endpoints = None
+        if hosts and protocol != 'UNIX':
+            from . import endpoints as _endpoints
+            self.endpoints = _endpoints.get(
+                hosts, port=port, balance=balance)
+        self._resolver = None
+        if protocol == 'UDP':
+            from . import dns as _dns
+            self._resolver = _dns.RESOLVER
+        self._sock = None  # for UNIX
+        self._socks = {}  # for UDP, by address family
+        self._client = None
+        self._clients = {}  # per-endpoint HTTP clients
 
     def __enter__(self):
-        self._sock = _socket.socket(_socket.AF_INET, self.socket_type)
+        if self.protocol == 'HTTP':
+            if self.endpoints is None:
+                self._client = self._http_client(self.host, self.port)
+        elif self.protocol == 'UNIX':
+            self._sock = _socket.socket(_socket.AF_UNIX, self.socket_type)
+            self._sock.setblocking(False)
         return self
 
+    def _target(self, host, port):
+        """Return (socket, address) for sending datagrams to a host"""
+        family, address = self._resolver.resolve(
+            host, port, self.socket_type)
+        sock = self._socks.get(family)
+        if sock is None:
+            sock = _socket.socket(family, self.socket_type)
+            existing = self._socks.setdefault(family, sock)
+            if existing is not sock:  # another thread won the race
+                sock.close()
+                sock = existing
+        return (sock, address)
+
+    def _http_client(self, host, port):
+        from . import http as _http
+        return _http.BulkClient(
+            host=host, port=port, timeout=self.timeout,
+            gzip_level=self.gzip_level, gzip_min_size=self.gzip_min_size)
+
     def __exit__(self, *exc_info):
+        clients = list(self._clients.values())
+        self._clients = {}
+        for client in clients:
+            client.close()
+        socks = list(self._socks.values())
+        self._socks = {}
+        for sock in socks:
+            sock.close()
+        if self._client is not None:
+            try:
+                self._client.close()
+            finally:
+                self._client = None
         if self._sock is not None:
             try:
                 self._sock.close()
@@ -59,76 +456,930 @@ class Connection(object):
 
     def send(self, message):
         LOG.debug(message)
-        self._sock.sendto(message, (self.host, self.port))
+        if self.endpoints is not None:
+            return self._balance(self._send_to, message)
+        if self._client is not None:
+            return self._client.send(message)
+        if self.protocol == 'UNIX':
+            self._send_unix(self._sock.sendto, message, self.host)
+            return
+        self._send_datagrams(message, self._target(self.host, self.port))
+
+    def _send_datagrams(self, message, target):
+        if len(message) <= self.max_datagram:
+            self._sendto(message, target)
+            return
+        for datagram in self.datagrams(message):
+            self._sendto(datagram, target)
+
+    def _send_to(self, endpoint, message):
+        """Send a message to one of several endpoints"""
+        if self.protocol == 'HTTP':
+            client = self._clients.get(endpoint)
+            if client is None:
+                client = self._clients[endpoint] = self._http_client(
+                    endpoint.host, endpoint.port)
+            return client.send(message)
+        self._send_datagrams(
+            message, self._target(endpoint.host, endpoint.port))
+
+    def _balance(self, send, message):
+        """Call send(endpoint, message), failing over between endpoints
+        """
+        failed = []
+        while True:
+            endpoint = self.endpoints.select(exclude=failed)
+            start = _perf_counter()
+            try:
+                result = send(endpoint, message)
+            except Exception as e:
+                if getattr(e, 'status', 500) < 500:  # not the node's fault
+                    self.endpoints.release(endpoint)
+                    raise
+                self.endpoints.failure(endpoint)
+                failed.append(endpoint)
+                if len(failed) >= len(self.endpoints):
+                    raise
+                LOG.warning('send to {} failed ({}), failing over'.format(
+                    endpoint.name, e))
+                COUNTERS.increment('endpoint_failovers')
+                continue
+            self.endpoints.success(endpoint, _perf_counter() - start)
+            return result
+
+    def send_parts(self, parts):
+        """Send a bulk message given as a list of byte strings
+
+        Datagram sockets gather the parts with sendmsg() (where it's
+        available), so they're never joined in memory.  Over UDP, the
+        parts are sent as a single datagram, so they must fit in
+        `max_datagram` bytes (emit_many() chunks them that way).
+        """
+        if self.protocol == 'HTTP':
+            return self.send(b''.join(parts))
+        if self.protocol == 'UNIX':
+            self._send_unix(self._sendmsg, parts, (self._sock, self.host))
+        elif self.endpoints is not None:
+            self._balance(
+                lambda endpoint, parts: self._sendmsg(
+                    parts, self._target(endpoint.host, endpoint.port)),
+                parts)
+        else:
+            self._sendmsg(parts, self._target(self.host, self.port))
+
+    def _send_unix(self, send, *args):
+        """Call send(*args), dropping the message if the relay is full
+        """
+        try:
+            send(*args)
+        except _socket.error as e:
+            if e.errno not in (_errno.EAGAIN, _errno.EWOULDBLOCK):
+                raise
+            COUNTERS.increment('unix_dropped')
+            COUNTERS.increment('dropped')
+
+    def _sendmsg(self, parts, target):
+        sock, address = target
+        if hasattr(sock, 'sendmsg'):
+            sock.sendmsg(parts, (), 0, address)
+        else:
+            sock.sendto(b''.join(parts), address)
+        if self.protocol == 'UDP':
+            COUNTERS.increment('udp_datagrams')
+
+    def datagrams(self, message):
+        """Pack a bulk message into UDP datagrams
+
+        Yields datagrams holding whole documents.  See the class
+        docstring for how oversized documents are handled.
+        """
+        datagram = []
+        size = 0
+        for item in _bulk.split_items(message):
+            if len(item) > self.max_datagram:
+                item = self._oversized(item)
+                if item is None:
+                    continue
+                if len(item) > self.max_datagram:
+                    yield item
+                    continue
+            if size + len(item) > self.max_datagram:
+                yield b''.join(datagram)
+                datagram = []
+                size = 0
+            datagram.append(item)
+            size += len(item)
+        if datagram:
+            yield b''.join(datagram)
+
+    def _sendto(self, datagram, target):
+        sock, address = target
+        sock.sendto(datagram, address)
+        COUNTERS.increment('udp_datagrams')
+
+    def _oversized(self, item):
+        """Apply the oversize policy to a document too big for a datagram
+        """
+        if self.oversize == 'truncate':
+            truncated = _bulk.truncate_item(item, self.max_datagram)
+            if truncated is not None:
+                COUNTERS.increment('udp_truncated')
+                return truncated
+        elif self.oversize == 'send' and len(item) <= MAX_UDP_PAYLOAD:
+            COUNTERS.increment('udp_oversized')
+            return item
+        COUNTERS.increment('udp_rejected')
+        COUNTERS.increment('dropped')
+        LOG.error('dropping {}-byte document too large for UDP'.format(
+            len(item)))
+        return None
+
 
+class ConnectionPool(object):
+    """A process-wide cache of open connections
 
-def log(index=None, type=None, sort_keys=False, **kwargs):
+    Opening and closing a socket for every event is expensive, so
+    emit() borrows connections from a shared pool instead.  Pooled
+    connections are keyed by their class and connection arguments
+    (host, port, protocol, ...), and stay open until close_all() is
+    called (which happens automatically at interpreter exit).
+
+    Connection classes used with the pool must be safe to send on
+    from several threads at once.  UDP sockets are.
+    """
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self._connections = {}
+        self.generation = 0  # bumped whenever connections are closed
+
+    def _key(self, connection_class, kwargs):
+        key = [connection_class]
+        for name in ['host', 'port', 'protocol', 'hosts']:
+            value = kwargs.get(name)
+            if value is None:
+                value = DEFAULT[name]
+            if isinstance(value, list):
+                value = tuple(value)
+            key.append(value)
+        key.append(tuple(sorted(
+            (name, value) for name, value in kwargs.items()
+            if name not in ['host', 'port', 'protocol', 'hosts'])))
+        return tuple(key)
+
+    def get(self, connection_class=Connection, **kwargs):
+        """Return an open connection, creating it if necessary"""
+        key = self._key(connection_class=connection_class, kwargs=kwargs)
+        connection = self._connections.get(key)
+        if connection is None:
+            with self._lock:
+                connection = self._connections.get(key)
+                if connection is None:
+                    connection = connection_class(**kwargs)
+                    connection.__enter__()
+                    self._connections[key] = connection
+        return connection
+
+    def discard(self, connection):
+        """Close a (possibly broken) connection and drop it from the pool
+        """
+        with self._lock:
+            for key, value in list(self._connections.items()):
+                if value is connection:
+                    del self._connections[key]
+            self.generation += 1
+        self._close(connection)
+
+    def close_all(self):
+        """Close every pooled connection"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+            self.generation += 1
+        for connection in connections:
+            self._close(connection)
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _after_fork_in_child(self):
+        """Drop connections inherited from the parent process
+
+        Closing the child's copies of the sockets doesn't affect the
+        parent's.
+        """
+        self._lock = _threading.Lock()
+        self.close_all()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            LOG.exception('error closing {!r}'.format(connection))
+
+
+POOL = ConnectionPool()
+
+
+def close_all():
+    """Close all pooled connections
+
+    Registered with atexit, but you can call it yourself (e.g. after
+    changing DEFAULT, or before forking).
+    """
+    POOL.close_all()
+
+
+_atexit.register(close_all)
+
+
+def _after_fork_in_child():
+    """Reset process-wide state inherited across a fork"""
+    COUNTERS._after_fork_in_child()
+    POOL._after_fork_in_child()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def log(index=None, type=None, sort_keys=False, emitter=None, **kwargs):
     """Log an arbitrary payload dictionary to Elastic Search
 
     Uses the default connection configuration.  If you need to
     override any of them, build your payload dict by hand and use
-    emit() instead.
+    emit() instead, or create an Emitter.
 
     You can optionally override the index and type of payload, for
-    later filtering in Elastic Search.  This means that `index` and
-    `type` are not available as payload keys.
+    later filtering in Elastic Search, and the emitter (see emit()).
+    This means that `index`, `type`, and `emitter` are not available
+    as payload keys.
+
+    If DEFAULT['sampler'] is set (see bes.sampling), events it rejects
+    are dropped before any timestamping or encoding.  Priority events
+    (see emit()) are never sampled.
     """
-    kwargs['@timestamp'] = _datetime.datetime.utcnow().isoformat()
-    kwargs['@version'] = 1
-    return emit(payload=kwargs, index=index, type=type, sort_keys=sort_keys)
+    if emitter is None:
+        pipeline = default_emitter()
+    else:
+        pipeline = Emitter(emitter=emitter, headers=HEADERS)
+    return pipeline.log(index=index, type=type, sort_keys=sort_keys, **kwargs)
+
+
+def is_priority(type, payload):
+    """Return True if DEFAULT['priority'] marks this event urgent"""
+    predicate = DEFAULT['priority']
+    if predicate is None:
+        return False
+    return bool(predicate(
+        type=DEFAULT['type'] if type is None else type, payload=payload))
+
+
+_EPOCH = _datetime.datetime(1970, 1, 1)
+
+
+class Timestamper(object):
+    """Render @timestamp values for time.time() readings
+
+    With the 'iso' format, timestamps are ISO 8601 UTC times with
+    microseconds and a 'Z' designator (2013-09-26T16:34:09.179048Z).
+    The date-and-seconds prefix is formatted once per second and
+    cached, so most calls only render the microseconds.  With
+    'epoch_millis', timestamps are integer milliseconds since the
+    epoch.
+    """
+    FORMATS = ['iso', 'epoch_millis']
+
+    def __init__(self, format='iso'):
+        if format not in self.FORMATS:
+            raise ValueError(format)
+        self.format = format
+        self._prefix = (None, None)  # (second, formatted prefix)
+
+    def render(self, now):
+        if self.format == 'epoch_millis':
+            return int(now * 1000)
+        second = int(now)
+        microsecond = int((now - second) * 1e6 + 0.5)
+        if microsecond == 1000000:
+            second += 1
+            microsecond = 0
+        cached_second, prefix = self._prefix
+        if second != cached_second:
+            prefix = _time.strftime('%Y-%m-%dT%H:%M:%S', _time.gmtime(second))
+            self._prefix = (second, prefix)
+        return '%s.%06dZ' % (prefix, microsecond)  # faster than format()
+
+
+class HeaderCache(object):
+    """Cache encoded bulk action lines
+
+    Every event for a given (index, type) shares the same action line,
+    so there's no need to rebuild and JSON-encode it per event.
+    Datestamps are UTC, like @timestamp, and get() takes the same
+    clock reading (`now`, from time.time()) as the event's @timestamp,
+    so an event's index always matches its timestamp.  Datestamped
+    entries are valid until the datestamp would change: at midnight
+    UTC for daily formats, or at the top of the hour (or minute) for
+    formats that include hours (or minutes).  At most `max_size`
+    entries are kept.
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._headers = {}
+
+    def get(self, index, type, datestamp_index, datestamp_format, now=None):
+        """Return the encoded action line (with trailing newline)"""
+        if now is None:
+            now = _time.time()
+        key = (index, type, datestamp_index and datestamp_format)
+        entry = self._headers.get(key)
+        if entry is not None and entry[0] <= now < entry[1]:
+            return entry[2]
+        entry = self._build(
+            index=index, type=type, datestamp_index=datestamp_index,
+            datestamp_format=datestamp_format, now=now)
+        if key not in self._headers and len(self._headers) >= self.max_size:
+            try:  # evict the oldest entry
+                del self._headers[next(iter(self._headers))]
+            except (KeyError, StopIteration, RuntimeError):
+                pass
+        self._headers[key] = entry
+        return entry[2]
+
+    def clear(self):
+        self._headers.clear()
+
+    @staticmethod
+    def _start(now, datestamp_format):
+        """Return (start, step) for the UTC datetime `now`'s datestamp"""
+        if '%S' in datestamp_format:
+            start = now.replace(microsecond=0)
+            step = _datetime.timedelta(seconds=1)
+        elif '%M' in datestamp_format:
+            start = now.replace(second=0, microsecond=0)
+            step = _datetime.timedelta(minutes=1)
+        elif '%H' in datestamp_format or '%I' in datestamp_format:
+            start = now.replace(minute=0, second=0, microsecond=0)
+            step = _datetime.timedelta(hours=1)
+        else:
+            start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            step = _datetime.timedelta(days=1)
+        return (start, step)
+
+    def _build(self, index, type, datestamp_index, datestamp_format, now):
+        """Return (valid from, valid until, header)"""
+        valid = (float('-inf'), float('inf'))
+        if datestamp_index:
+            utc = _EPOCH + _datetime.timedelta(seconds=now)
+            index = '-'.join([index, utc.strftime(datestamp_format)])
+            start, step = self._start(
+                now=utc, datestamp_format=datestamp_format)
+            valid = (
+                _calendar.timegm(start.timetuple()),
+                _calendar.timegm((start + step).timetuple()))
+        header = _json.dumps({
+            'index': {
+                '_index': index,
+                '_type': type,
+                },
+            }, sort_keys=True) + '\n'
+        return valid + (header.encode('utf-8'),)
+
+
+HEADERS = HeaderCache()
+
+
+def encode(payload, index=None, datestamp_index=None, type=None,
+           sort_keys=False, encoder=None, now=None):
+    """Encode a payload as a bulk 'index' action and source (bytes)
+
+    This is the encoding half of emit(), for callers that want to
+    send the message themselves.  Returns None if no type is set.
+
+    The source is encoded with `encoder` (DEFAULT['encoder'] by
+    default; see bes.serialize).  Dates, times, Decimals, UUIDs, sets,
+    and bytes are converted automatically.  If some fields still
+    can't be encoded, just those fields are replaced by their str().
+    `now` (from time.time()) is the clock reading for the index
+    datestamp; it defaults to the current time.
+    """
+    if datestamp_index is None and encoder is None:
+        pipeline = default_emitter()
+    else:
+        pipeline = Emitter(
+            datestamp_index=datestamp_index, encoder=encoder, headers=HEADERS)
+    return pipeline.encode(
+        payload=payload, index=index, type=type, sort_keys=sort_keys,
+        now=now)
+
+
+def _encode_source(payload, sort_keys, encoder):
+    #not everything is JSON serializable, and logging should not blow up
+    try:
+        return encoder(payload, sort_keys)
+    except (TypeError, ValueError, OverflowError):
+        COUNTERS.increment('serialization_failures')
+        try:
+            source, bad_keys = _serialize.encode_fields(
+                payload, sort_keys=sort_keys, encoder=encoder)
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            LOG.error('Unable to serlialize {!r} to json'.format(payload))
+            return encoder({"error": "unable to serialize"}, sort_keys)
+        LOG.error('Unable to serialize {} in {!r} to json'.format(
+            ', '.join(repr(key) for key in bad_keys), payload))
+        return source
+
+
+class Emitter(object):
+    """A logging pipeline with its settings resolved up front
+
+    Settings you don't pass are copied from DEFAULT when the Emitter
+    is created, and later changes to DEFAULT don't affect it, so
+    separate subsystems can log to separate places without touching
+    global state:
+
+    >>> audit = Emitter(index='audit', type='access', protocol='HTTP')
+    >>> audit.log(user='jdoe', action='login')
+
+    The encoder is looked up once, action lines come from the
+    Emitter's own HeaderCache (or `headers`), and the pooled
+    connection is kept between sends (until the pool closes it), so
+    each event skips the per-call setup emit() would otherwise do.
+
+    `sampler`, `priority`, and `emitter` are as for emit(); pass False
+    to turn off a DEFAULT sampler, priority predicate, or emitter.
+    Remaining keyword arguments configure the connection.  For
+    bes.Connection, unset connection settings (host, port, protocol,
+    ...) are frozen from DEFAULT too.  Emitters are thread-safe.
+
+    The module-level log(), emit(), and encode() use a default
+    Emitter, which is rebuilt whenever DEFAULT changes.
+    """
+    __slots__ = [
+        'index', 'type', 'datestamp_index', 'datestamp_format',
+        'sort_keys', 'encoder', 'sampler', 'priority', 'emitter',
+        'connection_class', 'pool', 'connection_kwargs', 'headers',
+        'timestamper', '_connection',
+        ]
+
+    def __init__(self, index=None, type=None, datestamp_index=None,
+                 datestamp_format=None, sort_keys=False, encoder=None,
+                 sampler=None, priority=None, emitter=None,
+                 connection_class=Connection, pool=POOL, headers=None,
+                 timestamp_format=None, **kwargs):
+        if index is None:
+            index = DEFAULT['index']
+        if type is None:
+            type = DEFAULT['type']
+        if datestamp_index is None:
+            datestamp_index = DEFAULT['datestamp_index']
+        if datestamp_format is None:
+            datestamp_format = DEFAULT['datestamp_format']
+        if encoder is None:
+            encoder = DEFAULT['encoder']
+        if sampler is None:
+            sampler = DEFAULT['sampler']
+        if priority is None:
+            priority = DEFAULT['priority']
+        if emitter is None:
+            emitter = DEFAULT['emitter']
+        if headers is None:
+            headers = HeaderCache()
+        if timestamp_format is None:
+            timestamp_format = DEFAULT['timestamp_format']
+        if connection_class is Connection:
+            for name in _CONNECTION_SETTINGS:
+                if kwargs.get(name) is None:
+                    kwargs[name] = DEFAULT[name]
+        self.index = index
+        self.type = type
+        self.datestamp_index = datestamp_index
+        self.datestamp_format = datestamp_format
+        self.sort_keys = sort_keys
+        self.encoder = _serialize.get_encoder(encoder)
+        self.sampler = sampler or None
+        self.priority = priority or None
+        self.emitter = emitter or None
+        self.connection_class = connection_class
+        self.pool = pool
+        self.connection_kwargs = kwargs
+        self.headers = headers
+        self.timestamper = Timestamper(format=timestamp_format)
+        self._connection = None  # (pool generation, connection)
+
+    def _is_priority(self, type, payload):
+        return self.priority is not None and bool(
+            self.priority(type=type, payload=payload))
+
+    def log(self, index=None, type=None, sort_keys=None, **kwargs):
+        """Timestamp and send keyword arguments as a document
+
+        As for bes.log().  One clock reading is used for both the
+        @timestamp and the index datestamp.
+        """
+        if type is None:
+            type = self.type
+        priority = self._is_priority(type=type, payload=kwargs)
+        if (self.sampler is not None and not priority and
+                not self.sampler.allow(type=type, payload=kwargs)):
+            return
+        now = _time.time()
+        kwargs['@timestamp'] = self.timestamper.render(now)
+        kwargs['@version'] = 1
+        return self._emit(
+            payload=kwargs, index=index, type=type, sort_keys=sort_keys,
+            priority=priority, now=now)
+
+    def emit(self, payload, index=None, type=None, sort_keys=None,
+             priority=None, now=None):
+        """Encode and send a payload, as for bes.emit()"""
+        if type is None:
+            type = self.type
+        if priority is None:
+            priority = self._is_priority(type=type, payload=payload)
+        if (self.sampler is not None and not priority and
+                not self.sampler.allow(type=type, payload=payload)):
+            return
+        return self._emit(
+            payload=payload, index=index, type=type, sort_keys=sort_keys,
+            priority=priority, now=now)
+
+    def encode(self, payload, index=None, type=None, sort_keys=None,
+               now=None):
+        """Return the bulk message for a payload, as for bes.encode()"""
+        if type is None:
+            type = self.type
+        if type is None:
+            LOG.error('You must set a type for {!r}'.format(payload))
+            return
+        header = self.headers.get(
+            index=self.index if index is None else index, type=type,
+            datestamp_index=self.datestamp_index,
+            datestamp_format=self.datestamp_format, now=now)
+        source = _encode_source(
+            payload=payload,
+            sort_keys=self.sort_keys if sort_keys is None else sort_keys,
+            encoder=self.encoder)
+        return b''.join([header, source, b'\n'])
+
+    def _emit(self, payload, index, type, sort_keys, priority, now):
+        message = self.encode(
+            payload=payload, index=index, type=type, sort_keys=sort_keys,
+            now=now)
+        if message is None:
+            return
+        COUNTERS.increment('events')
+        COUNTERS.increment('event_bytes', len(message))
+        emitter = self.emitter
+        if emitter is not None:
+            if priority:
+                COUNTERS.increment('priority_events')
+                getattr(emitter, 'put_priority', emitter.put)(message)
+            else:
+                emitter.put(message)
+            return message
+        self.send(message)
+        return message
+
+    def send(self, message):
+        """Send an encoded message on this Emitter's connection"""
+        start = _perf_counter()
+        try:
+            if self.pool is None:
+                with self.connection_class(
+                        **self.connection_kwargs) as connection:
+                    connection.send(message)
+            else:
+                connection = self._get_connection()
+                try:
+                    connection.send(message)
+                except Exception:
+                    self._connection = None
+                    self.pool.discard(connection)
+                    raise
+        except Exception:
+            COUNTERS.increment('send_errors')
+            raise
+        COUNTERS.observe('send_seconds', _perf_counter() - start)
+
+    def _get_connection(self):
+        generation = self.pool.generation
+        cached = self._connection
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        connection = self.pool.get(
+            connection_class=self.connection_class, **self.connection_kwargs)
+        self._connection = (generation, connection)
+        return connection
+
+
+# Connection arguments an Emitter freezes from DEFAULT
+_CONNECTION_SETTINGS = [
+    'host', 'port', 'hosts', 'balance', 'protocol', 'timeout',
+    'max_datagram', 'oversize', 'gzip_level', 'gzip_min_size',
+    ]
+
+_DEFAULT_EMITTER = None
+
+
+def default_emitter():
+    """Return the Emitter behind log() and emit(), built from DEFAULT
+
+    It's rebuilt on the next call after any change to DEFAULT.
+    """
+    global _DEFAULT_EMITTER
+    cached = _DEFAULT_EMITTER
+    version = DEFAULT.version
+    if cached is None or cached[0] != version:
+        cached = _DEFAULT_EMITTER = (version, Emitter(headers=HEADERS))
+    return cached[1]
 
 
 def emit(payload, index=None, datestamp_index=None, type=None,
-         sort_keys=False, connection_class=Connection, **kwargs):
+         sort_keys=False, encoder=None, sampler=None,
+         connection_class=Connection, pool=POOL, emitter=None,
+         priority=None, now=None, **kwargs):
     """Send bulk-upload data to Elastic Search
 
     Uses the 'index' action to add or replace a document as necessary.
 
+    Connections are borrowed from `pool` (the process-wide POOL by
+    default).  Set `pool` to None to open and close a fresh
+    connection for this message.  Any additional keyword arguments
+    are passed through to `connection_class`.
+
+    If `emitter` (or DEFAULT['emitter']) is set, the encoded message
+    is handed to emitter.put() instead of being sent from this
+    thread.  See bes.batch for a batching, asynchronous emitter.  The
+    emitter uses its own connection settings.
+
+    If `sampler` (or DEFAULT['sampler']) is set, events it rejects are
+    dropped before encoding.  Pass sampler=False to skip sampling.
+
+    Events matching the DEFAULT['priority'] predicate (by default
+    is_error()), or passed with priority=True, are never sampled, and
+    they're handed to emitter.put_priority() (if the emitter has one),
+    which sends them without waiting for a batch to fill.
+
+    `now` (from time.time()) sets the clock reading used for the index
+    datestamp, e.g. to match a payload's own timestamp.
+
+    With only the default settings, this uses default_emitter();
+    otherwise it builds a one-off Emitter.  For a hot loop with
+    custom settings, create an Emitter once and call its emit().
+
     http://www.elasticsearch.org/guide/reference/api/bulk/
     http://www.elasticsearch.org/guide/reference/api/bulk-udp/
     """
+    if (datestamp_index is None and encoder is None and sampler is None and
+            emitter is None and connection_class is Connection and
+            pool is POOL and not kwargs):
+        pipeline = default_emitter()
+    else:
+        pipeline = Emitter(
+            datestamp_index=datestamp_index, encoder=encoder,
+            sampler=sampler, emitter=emitter,
+            connection_class=connection_class, pool=pool, headers=HEADERS,
+            **kwargs)
+    return pipeline.emit(
+        payload=payload, index=index, type=type, sort_keys=sort_keys,
+        priority=priority, now=now)
+
+
+def emit_many(payloads, index=None, datestamp_index=None, type=None,
+              sort_keys=False, encoder=None, sampler=None, max_count=500,
+              max_bytes=None, connection_class=Connection, pool=POOL,
+              emitter=None, **kwargs):
+    """Send an iterable of payloads as a stream of bulk chunks
+
+    `payloads` can be any iterable (e.g. a generator reading a huge
+    file).  Each payload is encoded as it's consumed, and documents
+    are collected into chunks of at most `max_count` documents and
+    `max_bytes` bytes (by default, one datagram over UDP, and 1 MiB
+    otherwise), so memory use doesn't depend on the input's length.
+    Chunks are kept as lists of byte strings (sharing the cached
+    action line) and sent with Connection.send_parts(), which gathers
+    them with sendmsg() over datagram sockets.
+
+    The other arguments are as for emit().  Returns a list with a
+    dictionary for each chunk: the number of `documents` and
+    `bytes`, the number of documents the cluster rejected (`errors`,
+    for HTTP), and the exception (`error`) if the chunk couldn't be
+    sent.  Failed chunks don't stop the stream.
+    """
     if index is None:
         index = DEFAULT['index']
     if type is None:
         type = DEFAULT['type']
     if datestamp_index is None:
         datestamp_index = DEFAULT['datestamp_index']
-    if datestamp_index:
-        index = '-'.join([
-            index,
-            _datetime.date.today().strftime('%Y.%m.%d'),
-            ])
-
     if type is None:
-        LOG.error('You must set a type for {!r}'.format(payload))
-        return
-
-    index_data = {
-        'index': {
-            '_index': index,
-            '_type': type,
-            },
-        }
-    #not everything is JSON serializable, and logging should not blow up
-    #how to make these errors easier to track down?
-    try:
-        message = '\n'.join([
-            _json.dumps(index_data, sort_keys=sort_keys),
-            _json.dumps(payload, sort_keys=sort_keys),
-            '',
-        ])
-    except TypeError:
-        LOG.error('Unable to serlialize {!r} to json'.format(payload))
-        message = '\n'.join([
-            _json.dumps(index_data, sort_keys=sort_keys),
-            _json.dumps({"error": "unable to serialize"}, sort_keys=sort_keys),
-            '',
-        ])
-
-    if hasattr(message, 'encode'):
-        message = message.encode('utf-8')  # convert str to bytes for Python 3
-
-    with connection_class(**kwargs) as connection:
-        connection.send(message)
-
-    return message
+        LOG.error('You must set a type for emit_many()')
+        return []
+    if sampler is None:
+        sampler = DEFAULT['sampler']
+    if encoder is None:
+        encoder = DEFAULT['encoder']
+    encoder = _serialize.get_encoder(encoder)
+    datestamp_format = DEFAULT['datestamp_format']
+    if max_bytes is None:
+        max_bytes = 2**20
+        if (kwargs.get('protocol') or DEFAULT['protocol']) == 'UDP':
+            max_bytes = kwargs.get('max_datagram') or DEFAULT['max_datagram']
+    if emitter is None:
+        emitter = DEFAULT['emitter']
+    chunks = _Chunks(
+        emitter=emitter, connection_class=connection_class, pool=pool,
+        kwargs=kwargs)
+    for payload in payloads:
+        if sampler and not sampler.allow(type=type, payload=payload):
+            continue
+        header = HEADERS.get(
+            index=index, type=type, datestamp_index=datestamp_index,
+            datestamp_format=datestamp_format)
+        source = _encode_source(
+            payload=payload, sort_keys=sort_keys, encoder=encoder)
+        size = len(header) + len(source) + 1
+        if chunks.count and (
+                chunks.count >= max_count or chunks.size + size > max_bytes):
+            chunks.send()
+        chunks.add(header, source, size)
+    chunks.send()
+    return chunks.results
+
+
+class _Chunks(object):
+    """Collect and send emit_many()'s chunks"""
+    def __init__(self, emitter, connection_class, pool, kwargs):
+        self.emitter = emitter
+        self.connection_class = connection_class
+        self.pool = pool
+        self.kwargs = kwargs
+        self.parts = []
+        self.count = 0
+        self.size = 0
+        self.results = []
+        self._connection = None
+
+    def add(self, header, source, size):
+        self.parts.extend([header, source, b'\n'])
+        self.count += 1
+        self.size += size
+
+    def send(self):
+        if not self.count:
+            return
+        result = {
+            'documents': self.count,
+            'bytes': self.size,
+            'errors': None,
+            'error': None,
+            }
+        COUNTERS.increment('events', self.count)
+        COUNTERS.increment('event_bytes', self.size)
+        try:
+            if self.emitter is not None:
+                self.emitter.put(b''.join(self.parts))
+            else:
+                start = _perf_counter()
+                response = self._send()
+                COUNTERS.observe('send_seconds', _perf_counter() - start)
+                if isinstance(response, dict):
+                    result['errors'] = len([
+                        1 for item in response.get('items', [])
+                        for action, item_result in item.items()
+                        if item_result.get('status', 200) >= 300 or
+                        'error' in item_result])
+        except Exception as e:
+            COUNTERS.increment('send_errors')
+            LOG.warning('unable to send chunk of {} documents ({})'.format(
+                self.count, e))
+            result['error'] = e
+        self.results.append(result)
+        self.parts = []
+        self.count = self.size = 0
+
+    def _send(self):
+        if self.pool is None:
+            with self.connection_class(**self.kwargs) as connection:
+                return self._send_parts(connection)
+        if self._connection is None:
+            self._connection = self.pool.get(
+                connection_class=self.connection_class, **self.kwargs)
+        try:
+            return self._send_parts(self._connection)
+        except Exception:
+            self.pool.discard(self._connection)
+            self._connection = None
+            raise
+
+    def _send_parts(self, connection):
+        send_parts = getattr(connection, 'send_parts', None)
+        if send_parts is None:  # a custom connection class
+            return connection.send(b''.join(self.parts))
+        if (getattr(connection, 'protocol', None) == 'UDP' and
+                self.size > connection.max_datagram):
+            # a single oversized document, for the oversize policy
+            return connection.send(b''.join(self.parts))
+        return send_parts(self.parts)
+
+
+def stats():
+    """Return bes' own counters, gauges, and histograms
+
+    Counters (events, event_bytes, batches, send_errors, dropped,
+    serialization_failures, ...) are cumulative since the process
+    started (or since COUNTERS.reset()).  Gauges (e.g.
+    batch_queue_depth) are current values.  Histograms (e.g.
+    send_seconds) are dictionaries with count, sum, min, max, p50,
+    p90, and p99 entries.
+    """
+    values = COUNTERS.snapshot()
+    values.update(COUNTERS.gauges())
+    values.update(COUNTERS.histograms())
+    return values
+
+
+class StatsReporter(object):
+    """Periodically log stats() as a bes document
+
+    Every `interval` seconds, a background thread calls
+    `logger(type=type, **stats())` (bes.log by default).  Use
+    start_stats() to run the process-wide reporter.
+    """
+    def __init__(self, interval=60, type='bes_stats', logger=None):
+        self.interval = interval
+        self.type = type
+        self.logger = logger
+        self._stop = _threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = _threading.Thread(
+                name='bes stats reporter', target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join(timeout)
+            self._thread = None
+
+    def report(self):
+        logger = self.logger
+        if logger is None:
+            logger = log
+        try:
+            logger(type=self.type, **stats())
+        except Exception:
+            LOG.exception('unable to log bes stats')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+
+_STATS_REPORTER = None
+
+
+def start_stats(**kwargs):
+    """Log stats() periodically; see StatsReporter for arguments"""
+    global _STATS_REPORTER
+    stop_stats()
+    _STATS_REPORTER = StatsReporter(**kwargs)
+    _STATS_REPORTER.start()
+    return _STATS_REPORTER
+
+
+def stop_stats(timeout=None):
+    """Stop the reporter started by start_stats()"""
+    global _STATS_REPORTER
+    reporter = _STATS_REPORTER
+    _STATS_REPORTER = None
+    if reporter is not None:
+        reporter.stop(timeout=timeout)
+
+
+def alog(index=None, type=None, sort_keys=False, **kwargs):
+    """Coroutine version of log() for asyncio code
+
+    >>> await bes.alog(type='record', user='jdoe', action='swims')
+
+    See bes.aio for details.
+    """
+    from . import aio as _aio
+    return _aio.alog(index=index, type=type, sort_keys=sort_keys, **kwargs)
+
+
+def aemit(payload, **kwargs):
+    """Coroutine version of emit() for asyncio code
+
+    See bes.aio for details.
+    """
+    from . import aio as _aio
+    return _aio.aemit(payload=payload, **kwargs)
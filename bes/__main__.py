@@ -0,0 +1,89 @@
+"""Command-line tools for bes
+
+  $ python -m bes load --type record events.json
+"""
+
+from __future__ import absolute_import
+
+import argparse as _argparse
+import sys as _sys
+
+import bes as _bes
+from . import load as _bes_load
+
+
+def _connection_arguments(parser):
+    parser.add_argument('--host', help='Elastic Search host')
+    parser.add_argument('--port', type=int, help='Elastic Search port')
+    parser.add_argument('--protocol', help="'UDP' or 'HTTP'")
+    parser.add_argument(
+        '--gzip-level', type=int,
+        help='gzip HTTP request bodies at this level (1 to 9)')
+
+
+def _load(args):
+    kwargs = dict(
+        (name, value) for name, value in [
+            ('host', args.host),
+            ('port', args.port),
+            ('protocol', args.protocol),
+            ('gzip_level', args.gzip_level),
+            ] if value is not None)
+    if args.no_datestamp:
+        kwargs['datestamp_index'] = False
+    loader = _bes_load.Loader(
+        index=args.index, type=args.type, workers=args.workers,
+        max_count=args.max_count, max_bytes=args.max_bytes,
+        output=None if args.quiet else _sys.stderr, **kwargs)
+    paths = _bes_load.expand(args.inputs)
+    try:
+        loader.load(paths, offset=args.offset)
+    except _bes_load.LoadError as e:
+        remaining = paths[paths.index(e.path):]
+        _sys.stderr.write('{}\nresume with: --offset {} {}\n'.format(
+            e, e.offset, ' '.join(remaining)))
+        return 1
+    finally:
+        _bes.close_all()
+    return 0
+
+
+def main(args=None):
+    parser = _argparse.ArgumentParser(prog='python -m bes')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    load = subparsers.add_parser(
+        'load', help='bulk-load NDJSON files',
+        description=_bes_load.__doc__.strip().splitlines()[0])
+    load.add_argument(
+        'inputs', nargs='+',
+        help="files, glob patterns, gzipped files, or '-' for stdin")
+    load.add_argument('--index', help='index (default: DEFAULT)')
+    load.add_argument('--type', help='document type (default: DEFAULT)')
+    load.add_argument(
+        '--no-datestamp', action='store_true',
+        help="don't append a datestamp to the index name")
+    _connection_arguments(load)
+    load.add_argument(
+        '--workers', type=int, default=4,
+        help='parallel upload threads (default: %(default)s)')
+    load.add_argument(
+        '--max-count', type=int, default=500,
+        help='maximum documents per bulk request (default: %(default)s)')
+    load.add_argument(
+        '--max-bytes', type=int, default=2**20,
+        help='maximum bytes per bulk request (default: %(default)s)')
+    load.add_argument(
+        '--offset', type=int, default=0,
+        help='start the first input at this byte offset (to resume)')
+    load.add_argument(
+        '--quiet', '-q', action='store_true', help="don't show progress")
+    load.set_defaults(function=_load)
+
+    args = parser.parse_args(args)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    _sys.exit(main())
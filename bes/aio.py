@@ -0,0 +1,435 @@
+"""Non-blocking logging for asyncio code
+
+Calling bes.log() from a coroutine does blocking socket work on the
+event loop.  Use the coroutine versions instead:
+
+>>> await bes.alog(type='record', user='jdoe', action='swims')
+
+alog() and aemit() encode the event and put it on an AsyncEmitter's
+queue without blocking.  The emitter's sender task batches queued
+messages and writes them with non-blocking UDP (via
+loop.create_datagram_endpoint) or HTTP /_bulk requests.  Close the
+default emitter before your loop shuts down to flush pending events:
+
+>>> await bes.aio.aclose()
+"""
+
+import asyncio as _asyncio
+import collections as _collections
+import time as _time
+import weakref as _weakref
+
+import bes as _bes
+from . import http as _bes_http
+
+
+class _Marker(object):
+    """A control message for the sender task"""
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.event = _asyncio.Event()
+
+
+class _Urgent(object):
+    """Wake the sender task to send the waiting priority messages"""
+
+
+class _BoundedQueue(_asyncio.Queue):
+    """An asyncio.Queue with a policy for when it holds `maxsize` items
+
+    offer() applies `policy` ('drop_newest' or 'drop_oldest') when
+    the queue is full, counting drops as bes.batch.BoundedQueue does.
+    put_control() ignores the bound, for control items.
+    """
+    POLICIES = ['drop_newest', 'drop_oldest']
+
+    def __init__(self, maxsize=10000, policy='drop_newest'):
+        if policy not in self.POLICIES:
+            raise ValueError(policy)
+        super().__init__()
+        self.bound = maxsize
+        self.policy = policy
+
+    def offer(self, item):
+        """Queue `item` if the policy allows; return True if queued"""
+        if self.qsize() >= self.bound:
+            if self.policy != 'drop_oldest' or not self._drop_oldest():
+                self._drop('queue_dropped_newest')
+                return False
+        self.put_nowait(item)
+        return True
+
+    def put_control(self, item, front=False):
+        """Queue a control item, even if the queue is full
+
+        With `front`, the item jumps ahead of everything queued.
+        """
+        self.put_nowait(item)
+        if front:
+            self._queue.rotate(1)  # from the back to the front
+
+    def _drop_oldest(self):
+        """Drop the oldest message (not a control item); False if none"""
+        for index, item in enumerate(self._queue):
+            if not isinstance(item, (_Marker, _Urgent)):
+                del self._queue[index]
+                self._drop('queue_dropped_oldest')
+                return True
+        return False
+
+    @staticmethod
+    def _drop(counter):
+        _bes.COUNTERS.increment('dropped')
+        _bes.COUNTERS.increment(counter)
+
+
+class _UDPSender(object):
+    def __init__(self, host, port, max_datagram=None, oversize=None):
+        # only used for packing datagrams, so it never opens a socket
+        self._packer = _bes.Connection(
+            host=host, port=port, protocol='UDP',
+            max_datagram=max_datagram, oversize=oversize)
+        self._transport = None
+
+    async def send(self, body):
+        if self._transport is None:
+            loop = _asyncio.get_running_loop()
+            self._transport, protocol = await loop.create_datagram_endpoint(
+                _asyncio.DatagramProtocol,
+                remote_addr=(self._packer.host, self._packer.port))
+        for datagram in self._packer.datagrams(body):
+            self._transport.sendto(datagram)
+            _bes.COUNTERS.increment('udp_datagrams')
+
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+
+class _HTTPSender(object):
+    """A minimal keep-alive HTTP/1.1 client for /_bulk"""
+    def __init__(self, host, port, timeout=None, path='/_bulk',
+                 gzip_level=None, gzip_min_size=None):
+        if timeout is None:
+            timeout = _bes.DEFAULT['timeout']
+        if gzip_level is None:
+            gzip_level = _bes.DEFAULT['gzip_level']
+        if gzip_min_size is None:
+            gzip_min_size = _bes.DEFAULT['gzip_min_size']
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.path = path
+        self.gzip_level = gzip_level
+        self.gzip_min_size = gzip_min_size
+        self._reader = self._writer = None
+
+    async def send(self, body):
+        headers = []
+        if self.gzip_level and len(body) >= self.gzip_min_size:
+            # zlib releases the GIL, so compress off the event loop
+            body = await _asyncio.get_running_loop().run_in_executor(
+                None, _bes_http.gzip, body, self.gzip_level)
+            headers.append('Content-Encoding: gzip')
+        _bes.COUNTERS.increment('http_bytes', len(body))
+        try:
+            status, reason, data = await _asyncio.wait_for(
+                self._post(body, headers), self.timeout)
+        except Exception:
+            await self.close()
+            _bes.COUNTERS.increment('http_send_errors')
+            raise
+        _bes.COUNTERS.increment('http_requests')
+        if status >= 300:
+            _bes.COUNTERS.increment('http_request_errors')
+            raise _bes_http.BulkError(status=status, reason=reason, body=data)
+        response = _bes_http.parse_response(data)
+        _bes_http.check_response(response)
+        return response
+
+    async def _post(self, body, headers=()):
+        if self._writer is None:
+            self._reader, self._writer = await _asyncio.open_connection(
+                self.host, self.port)
+        head = '\r\n'.join([
+            'POST {} HTTP/1.1'.format(self.path),
+            'Host: {}:{}'.format(self.host, self.port),
+            'Content-Type: application/x-ndjson',
+            'Content-Length: {}'.format(len(body)),
+            ] + list(headers) + ['', '']).encode('ascii')
+        self._writer.write(head + body)
+        await self._writer.drain()
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by server')
+        version, status, reason = status_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await self._reader.readline()
+                length = int(size_line.split(b';')[0], 16)
+                chunk = await self._reader.readexactly(length + 2)
+                if not length:
+                    break
+                chunks.append(chunk[:-2])
+            data = b''.join(chunks)
+        else:
+            data = await self._reader.readexactly(
+                int(headers.get('content-length', 0)))
+        if (headers.get('connection', '').lower() == 'close' or
+                version == 'HTTP/1.0'):
+            await self.close()
+        return (int(status), reason.strip(), data)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+_EMITTERS = _weakref.WeakSet()
+
+
+class AsyncEmitter(object):
+    """Batch bulk messages and send them from an asyncio task
+
+    put() never blocks; it just queues the message.  At most
+    `max_queue` messages wait, and when the queue is full,
+    `queue_policy` ('drop_newest' or 'drop_oldest') decides which one
+    is dropped.  The sender task
+    (started on first use in the running loop) joins queued messages
+    into bulk bodies and sends them once a batch holds `max_count`
+    messages, reaches `max_bytes`, or has waited `max_linger` seconds.
+    Send failures are logged and the batch is dropped.  Messages
+    passed to put_priority() wait in a separate lane of at most
+    `max_priority_queue` messages, and whatever is waiting there when
+    the task wakes is sent at once in one bulk request.
+
+    Connection arguments default to bes.DEFAULT, as for bes.emit().
+    """
+    def __init__(self, host=None, port=None, protocol=None, timeout=None,
+                 max_datagram=None, oversize=None, gzip_level=None,
+                 gzip_min_size=None, max_count=500, max_bytes=65000,
+                 max_linger=1.0, max_queue=10000, queue_policy='drop_newest',
+                 max_priority_queue=1000):
+        if host is None:
+            host = _bes.DEFAULT['host']
+        if port is None:
+            port = _bes.DEFAULT['port']
+        if protocol is None:
+            protocol = _bes.DEFAULT['protocol']
+        if protocol == 'UDP':
+            self._sender = _UDPSender(
+                host=host, port=port, max_datagram=max_datagram,
+                oversize=oversize)
+        elif protocol == 'HTTP':
+            self._sender = _HTTPSender(
+                host=host, port=port, timeout=timeout, gzip_level=gzip_level,
+                gzip_min_size=gzip_min_size)
+        else:
+            raise NotImplementedError(protocol)
+        if queue_policy not in _BoundedQueue.POLICIES:
+            raise ValueError(queue_policy)
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.max_queue = max_queue
+        self.queue_policy = queue_policy
+        self.max_priority_queue = max_priority_queue
+        self._queue = None
+        self._urgent = _collections.deque()  # waiting priority messages
+        self._task = None
+        _EMITTERS.add(self)
+
+    def put(self, message):
+        """Queue a bulk message (bytes) for sending
+
+        Returns False if the message was dropped because the queue was
+        full.
+        """
+        if self._task is None:
+            self._start()
+        return self._queue.offer(message)
+
+    def put_priority(self, message):
+        """Queue a message to be sent without waiting for a batch
+
+        Returns False if the message was dropped because
+        `max_priority_queue` priority messages were already waiting.
+        """
+        if len(self._urgent) >= self.max_priority_queue:
+            _bes.COUNTERS.increment('dropped')
+            _bes.COUNTERS.increment('priority_dropped')
+            return False
+        self._urgent.append(message)
+        if len(self._urgent) == 1:  # otherwise the task's been woken
+            if self._task is None:
+                self._start()
+            self._queue.put_control(_Urgent(), front=True)
+        return True
+
+    async def flush(self):
+        """Wait until everything queued so far has been sent"""
+        if self._task is None:
+            return
+        marker = _Marker()
+        self._queue.put_control(marker)
+        await marker.event.wait()
+
+    async def aclose(self):
+        """Flush queued messages, then stop the sender task"""
+        if self._task is not None:
+            marker = _Marker(stop=True)
+            self._queue.put_control(marker)
+            await self._task
+            self._task = None
+        await self._sender.close()
+
+    def _start(self):
+        self._queue = _BoundedQueue(
+            maxsize=self.max_queue, policy=self.queue_policy)
+        self._task = _asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = _asyncio.get_running_loop()
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            if deadline is None:
+                item = await self._queue.get()
+            else:
+                try:
+                    item = await _asyncio.wait_for(
+                        self._queue.get(), max(deadline - loop.time(), 0))
+                except _asyncio.TimeoutError:
+                    item = None
+            if isinstance(item, _Marker):
+                await self._send(batch)
+                batch, size, deadline = [], 0, None
+                item.event.set()
+                if item.stop:
+                    return
+                continue
+            if isinstance(item, _Urgent):
+                urgent = list(self._urgent)
+                self._urgent.clear()
+                await self._send(urgent)
+                continue
+            if item is not None:
+                if not batch:
+                    deadline = loop.time() + self.max_linger
+                batch.append(item)
+                size += len(item)
+            if batch and (
+                    item is None or
+                    len(batch) >= self.max_count or
+                    size >= self.max_bytes or
+                    loop.time() >= deadline):
+                await self._send(batch)
+                batch, size, deadline = [], 0, None
+
+    async def _send(self, batch):
+        if not batch:
+            return
+        body = b''.join(batch)
+        _bes.COUNTERS.increment('batches')
+        _bes.COUNTERS.increment('batch_bytes', len(body))
+        start = _time.perf_counter()
+        try:
+            await self._sender.send(body)
+        except Exception:
+            _bes.LOG.exception(
+                'unable to send batch of {} messages'.format(len(batch)))
+            _bes.COUNTERS.increment('send_errors')
+            _bes.COUNTERS.increment('dropped', len(batch))
+            return
+        _bes.COUNTERS.observe('send_seconds', _time.perf_counter() - start)
+
+
+def queue_depth():
+    """Messages queued in this process' AsyncEmitters"""
+    return sum(
+        emitter._queue.qsize() for emitter in list(_EMITTERS)
+        if emitter._queue is not None)
+
+
+_bes.COUNTERS.register_gauge('async_queue_depth', queue_depth)
+
+
+_EMITTER = None
+
+
+def get_emitter():
+    """Return the default AsyncEmitter, creating it if necessary"""
+    global _EMITTER
+    if _EMITTER is None:
+        _EMITTER = AsyncEmitter()
+    return _EMITTER
+
+
+async def aclose():
+    """Flush and close the default AsyncEmitter"""
+    global _EMITTER
+    emitter = _EMITTER
+    _EMITTER = None
+    if emitter is not None:
+        await emitter.aclose()
+
+
+async def alog(index=None, type=None, sort_keys=False, emitter=None,
+               **kwargs):
+    """Coroutine version of bes.log()"""
+    priority = _bes.is_priority(type=type, payload=kwargs)
+    sampler = _bes.DEFAULT['sampler']
+    if sampler is not None and not priority and not sampler.allow(
+            type=_bes.DEFAULT['type'] if type is None else type,
+            payload=kwargs):
+        return
+    now = _time.time()
+    kwargs['@timestamp'] = _bes.default_emitter().timestamper.render(now)
+    kwargs['@version'] = 1
+    return await aemit(
+        payload=kwargs, index=index, type=type, sort_keys=sort_keys,
+        sampler=False, emitter=emitter, priority=priority, now=now)
+
+
+async def aemit(payload, index=None, datestamp_index=None, type=None,
+                sort_keys=False, encoder=None, sampler=None, emitter=None,
+                priority=None, now=None):
+    """Coroutine version of bes.emit()
+
+    Encodes the payload and queues it on `emitter` (by default, the
+    one returned by get_emitter()) without blocking.
+    """
+    if priority is None:
+        priority = _bes.is_priority(type=type, payload=payload)
+    if sampler is None:
+        sampler = _bes.DEFAULT['sampler']
+    if sampler and not priority and not sampler.allow(
+            type=_bes.DEFAULT['type'] if type is None else type,
+            payload=payload):
+        return
+    message = _bes.encode(
+        payload=payload, index=index, datestamp_index=datestamp_index,
+        type=type, sort_keys=sort_keys, encoder=encoder, now=now)
+    if message is None:
+        return
+    _bes.COUNTERS.increment('events')
+    _bes.COUNTERS.increment('event_bytes', len(message))
+    if emitter is None:
+        emitter = get_emitter()
+    if priority:
+        _bes.COUNTERS.increment('priority_events')
+        getattr(emitter, 'put_priority', emitter.put)(message)
+    else:
+        emitter.put(message)
+    return message
@@ -0,0 +1,586 @@
+"""Batch bulk messages and send them from a background thread
+
+Use start() to route bes.log() and bes.emit() through a shared
+BatchEmitter:
+
+>>> import bes.batch
+>>> emitter = bes.batch.start(max_count=100, max_linger=0.5)
+>>> bes.log(type='record', user='jdoe', action='swims')
+>>> bes.batch.stop()
+"""
+
+from __future__ import absolute_import
+
+import atexit as _atexit
+import collections as _collections
+import heapq as _heapq
+import os as _os
+try:
+    import queue as _queue
+except ImportError:  # Python 2
+    import Queue as _queue
+import threading as _threading
+import time as _time
+import weakref as _weakref
+
+import bes as _bes
+from . import bulk as _bes_bulk
+from . import http as _bes_http
+from . import retry as _bes_retry
+from . import spool as _bes_spool
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+_perf_counter = getattr(_time, 'perf_counter', _time.time)
+
+_EMITTERS = _weakref.WeakSet()
+
+# seconds shutdown_all() waits at interpreter exit (None: no limit)
+EXIT_TIMEOUT = 5
+
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - _monotonic(), 0)
+
+
+class _Marker(object):
+    """A control message for the worker thread
+
+    A stop marker's `deadline` (from _monotonic()) is when the worker
+    gives up on pending retries, and `expired` says if it had to.
+    """
+    def __init__(self, stop=False, deadline=None):
+        self.stop = stop
+        self.deadline = deadline
+        self.expired = False
+        self.event = _threading.Event()
+
+
+class _Urgent(object):
+    """Wake the worker to send the waiting priority messages"""
+
+
+class BoundedQueue(_queue.Queue):
+    """A queue of at most `maxsize` items, with a policy for when it's full
+
+    offer() applies `policy` when the queue is full:
+
+    * 'block': wait up to `timeout` seconds (forever, if None) for
+      room, then drop the new item,
+    * 'drop_newest': drop the new item,
+    * 'drop_oldest': drop the oldest queued item to make room, or
+    * 'spill': pass the new item to `spill(item)` (e.g. a
+      bes.spool.Spool's append) instead of queueing it.
+
+    Drops are counted in bes.COUNTERS under 'dropped' and a
+    per-policy counter ('queue_block_timeouts', 'queue_dropped_newest',
+    'queue_dropped_oldest', or 'queue_spilled'), and time spent
+    blocked is recorded in the 'queue_block_seconds' histogram.
+    """
+    POLICIES = ['block', 'drop_newest', 'drop_oldest', 'spill']
+
+    def __init__(self, maxsize=10000, policy='block', timeout=None,
+                 spill=None):
+        if policy not in self.POLICIES:
+            raise ValueError(policy)
+        if policy == 'spill' and spill is None:
+            raise ValueError("the 'spill' policy needs a spill function")
+        _queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.timeout = timeout
+        self.spill = spill
+
+    def offer(self, item):
+        """Queue `item` if the policy allows; return True if queued"""
+        try:
+            self.put_nowait(item)
+            return True
+        except _queue.Full:
+            pass
+        if self.policy == 'block':
+            start = _perf_counter()
+            try:
+                self.put(item, timeout=self.timeout)
+                return True
+            except _queue.Full:
+                self._drop('queue_block_timeouts')
+                return False
+            finally:
+                _bes.COUNTERS.observe(
+                    'queue_block_seconds', _perf_counter() - start)
+        elif self.policy == 'drop_oldest':
+            with self.not_full:
+                while self._qsize() >= self.maxsize:
+                    if not self._drop_oldest():
+                        break
+                self._put_unbounded(item)
+            return True
+        elif self.policy == 'spill':
+            _bes.COUNTERS.increment('queue_spilled')
+            self.spill(item)
+            return False
+        self._drop('queue_dropped_newest')
+        return False
+
+    def _drop_oldest(self):
+        """Drop the oldest message (not a control item); False if none"""
+        for index, item in enumerate(self.queue):
+            if not isinstance(item, (_Marker, _Urgent)):
+                del self.queue[index]
+                self._drop('queue_dropped_oldest')
+                return True
+        return False
+
+    @staticmethod
+    def _drop(counter):
+        _bes.COUNTERS.increment('dropped')
+        _bes.COUNTERS.increment(counter)
+
+    def put_control(self, item, front=False):
+        """Queue a control item, even if the queue is full
+
+        With `front`, the item jumps ahead of everything queued.
+        """
+        with self.not_full:
+            self._put_unbounded(item, front=front)
+
+    def _put_unbounded(self, item, front=False):
+        # call with self.mutex held
+        if front:
+            self.queue.appendleft(item)
+        else:
+            self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+
+class BatchEmitter(object):
+    """Concatenate bulk messages and send them from a worker thread
+
+    Messages passed to put() are queued and the caller returns
+    immediately.  The worker joins queued messages into a single bulk
+    body, which it sends once the batch holds `max_count` messages,
+    reaches `max_bytes`, or the oldest message has waited `max_linger`
+    seconds, whichever comes first.
+
+    Documents the cluster rejects under load (and whole batches that
+    fail with a 429, 503, or socket error) are resent after a delay
+    chosen by `retry_policy` (a bes.retry.RetryPolicy).  Documents
+    that run out of retries are passed to
+    `dead_letter(message, reason)`.
+
+    If `spool` (a bes.spool.Spool) is given, documents that run out of
+    retries are written to it instead, and a bes.spool.Replayer
+    resends them every `replay_interval` seconds until the spool is
+    empty.
+
+    Messages wait in a BoundedQueue of at most `max_queue` messages.
+    When it's full, put() applies `queue_policy` ('drop_newest' by
+    default, 'drop_oldest', 'block' for up to `queue_timeout` seconds,
+    or 'spill' to the spool), so a slow cluster costs dropped events
+    rather than unbounded memory or stalled callers.
+
+    Priority messages (passed to put_priority(), e.g. errors) take a
+    separate lane of at most `max_priority_queue` messages: they skip
+    ahead of queued messages, and whatever priority messages are
+    waiting when the worker wakes are sent at once in one bulk
+    request, while routine messages keep filling the current batch.
+
+    Emitters are fork-safe: in a child process, the queue and worker
+    state inherited from the parent are discarded, and a new worker
+    thread starts on the child's first put().  Messages queued in the
+    parent are the parent's to send, and only the parent replays the
+    spool.
+
+    Remaining keyword arguments configure the connection used for
+    sending, as they would for bes.emit().
+    """
+    def __init__(self, max_count=500, max_bytes=65000, max_linger=1.0,
+                 retry_policy=None, dead_letter=None, spool=None,
+                 replay_interval=30, max_queue=10000,
+                 queue_policy='drop_newest', queue_timeout=0.1,
+                 max_priority_queue=1000, connection_class=_bes.Connection,
+                 pool=_bes.POOL, **kwargs):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        if retry_policy is None:
+            retry_policy = _bes_retry.RetryPolicy()
+        self.retry_policy = retry_policy
+        self.spool = spool
+        self._replayer = None
+        if spool is not None:
+            if dead_letter is None:
+                dead_letter = spool.dead_letter
+            self._replayer = _bes_spool.Replayer(
+                spool=spool, send=self._replay, interval=replay_interval)
+        if dead_letter is None:
+            dead_letter = _bes_retry.log_dead_letter
+        self.dead_letter = dead_letter
+        if queue_policy == 'spill' and spool is None:
+            raise ValueError("the 'spill' policy needs a spool")
+        self.max_queue = max_queue
+        self.queue_policy = queue_policy
+        self.queue_timeout = queue_timeout
+        self.max_priority_queue = max_priority_queue
+        self.connection_class = connection_class
+        self.pool = pool
+        self.connection_kwargs = kwargs
+        self._queue = self._new_queue()
+        self._urgent = _collections.deque()  # waiting priority messages
+        self._urgent_lock = _threading.Lock()
+        self._lock = _threading.Lock()
+        self._thread = None
+        self._retries = []  # heap of (due, index, (message, attempt))
+        self._retries_lock = _threading.Lock()
+        self._retry_index = 0
+        _EMITTERS.add(self)
+
+    def _new_queue(self):
+        spill = None
+        if self.spool is not None:
+            spill = self.spool.append
+        return BoundedQueue(
+            maxsize=self.max_queue, policy=self.queue_policy,
+            timeout=self.queue_timeout, spill=spill)
+
+    def _after_fork_in_child(self):
+        self._queue = self._new_queue()
+        self._urgent = _collections.deque()
+        self._urgent_lock = _threading.Lock()
+        self._lock = _threading.Lock()
+        self._thread = None
+        self._retries = []
+        self._retries_lock = _threading.Lock()
+        self._replayer = None
+
+    def put(self, message):
+        """Queue a bulk message (bytes) for sending
+
+        Returns False if the message was dropped or spilled because
+        the queue was full.
+        """
+        if self._thread is None:
+            self._start()
+        return self._queue.offer(message)
+
+    def put_priority(self, message):
+        """Queue a message to be sent without waiting for a batch
+
+        Returns False if the message was dropped because
+        `max_priority_queue` priority messages were already waiting.
+        """
+        if self._thread is None:
+            self._start()
+        with self._urgent_lock:
+            if len(self._urgent) >= self.max_priority_queue:
+                _bes.COUNTERS.increment('dropped')
+                _bes.COUNTERS.increment('priority_dropped')
+                return False
+            self._urgent.append(message)
+            if len(self._urgent) == 1:  # otherwise the worker's been woken
+                self._queue.put_control(_Urgent(), front=True)
+        return True
+
+    def flush(self, timeout=None):
+        """Send everything queued so far
+
+        Blocks until the worker has sent (or failed to send) the
+        current batch.  Returns False if `timeout` expired first.
+        """
+        if self._thread is None:
+            return True
+        marker = _Marker()
+        self._queue.put_control(marker)
+        return marker.event.wait(timeout)
+
+    def shutdown(self, timeout=None):
+        """Flush queued messages and stop the worker thread
+
+        The worker keeps running until pending retries have been
+        delivered or dead-lettered.  If `timeout` expires first,
+        messages still queued or awaiting retry are passed to
+        `dead_letter` (the spool, if there is one), and shutdown()
+        returns False.
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return True
+            deadline = None
+            if timeout is not None:
+                deadline = _monotonic() + timeout
+            marker = _Marker(stop=True, deadline=deadline)
+            self._queue.put_control(marker)
+            flushed = marker.event.wait(timeout)
+            if not flushed:  # the worker is stuck in a send
+                self._expire(batch=[])
+            flushed = flushed and not marker.expired
+            thread.join(_remaining(deadline))
+            self._thread = None
+            if self._replayer is not None:
+                self._replayer.stop(_remaining(deadline))
+                self.spool.close()
+        return flushed
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                thread = _threading.Thread(
+                    name='bes batch emitter', target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+                if self._replayer is not None:
+                    self._replayer.start()
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        stop = None
+        while True:
+            now = _monotonic()
+            if (stop is not None and stop.deadline is not None and
+                    now >= stop.deadline):
+                self._expire(batch=batch)
+                stop.expired = True
+                stop.event.set()
+                return
+            with self._retries_lock:
+                while self._retries and self._retries[0][0] <= now:
+                    due, index, entry = _heapq.heappop(self._retries)
+                    if not batch:
+                        deadline = now + self.max_linger
+                    batch.append(entry)
+                    size += len(entry[0])
+            if batch and (
+                    stop is not None or
+                    len(batch) >= self.max_count or
+                    size >= self.max_bytes or
+                    now >= deadline):
+                self._send(batch)
+                batch, size, deadline = [], 0, None
+                continue
+            if stop is not None and not self._retries:
+                stop.event.set()
+                return
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - now
+            if self._retries:
+                due = self._retries[0][0] - now
+                if timeout is None or due < timeout:
+                    timeout = due
+            if stop is not None and stop.deadline is not None:
+                if timeout is None or stop.deadline - now < timeout:
+                    timeout = stop.deadline - now
+            if timeout is not None:
+                timeout = max(timeout, 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except _queue.Empty:
+                continue
+            if isinstance(item, _Marker):
+                if item.stop:  # keep going until pending retries finish
+                    stop = item
+                    continue
+                self._send(batch)
+                batch, size, deadline = [], 0, None
+                item.event.set()
+                continue
+            if isinstance(item, _Urgent):
+                self._send([(message, 0) for message in self._take_urgent()])
+                continue
+            if not batch:
+                deadline = _monotonic() + self.max_linger
+            batch.append((item, 0))
+            size += len(item)
+
+    def _expire(self, batch):
+        """Dead-letter `batch` and everything still queued or pending"""
+        with self._retries_lock:
+            entries = [entry for due, index, entry in self._retries]
+            self._retries = []
+        entries.extend(batch)
+        stops = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except _queue.Empty:
+                break
+            if isinstance(item, _Marker):
+                if item.stop:  # still needed to stop a busy worker
+                    stops.append(item)
+                else:
+                    item.event.set()
+            elif not isinstance(item, _Urgent):
+                entries.append((item, 0))
+        for item in stops:
+            self._queue.put_control(item)
+        entries.extend((message, 0) for message in self._take_urgent())
+        if entries:
+            _bes.LOG.warning(
+                'shutdown timed out; dead-lettering {} messages'.format(
+                    len(entries)))
+        for message, attempt in entries:
+            _bes.COUNTERS.increment('dead_letters')
+            self.dead_letter(message, 'shutdown timed out')
+
+    def _take_urgent(self):
+        """Return the waiting priority messages, emptying their lane"""
+        with self._urgent_lock:
+            messages = list(self._urgent)
+            self._urgent.clear()
+        return messages
+
+    def _send(self, batch):
+        """Send a batch of (message, attempt) entries"""
+        if not batch:
+            return
+        body = b''.join(message for message, attempt in batch)
+        _bes.COUNTERS.increment('batches')
+        _bes.COUNTERS.increment('batch_bytes', len(body))
+        start = _perf_counter()
+        try:
+            response = self._deliver(body)
+        except Exception as e:
+            _bes.COUNTERS.increment('send_errors')
+            if not self.retry_policy.retryable_error(e):
+                _bes.LOG.exception(
+                    'unable to send batch of {} messages'.format(len(batch)))
+                _bes.COUNTERS.increment('dropped', len(batch))
+                return
+            _bes.LOG.warning('retrying batch of {} messages ({})'.format(
+                len(batch), e))
+            for entry in batch:
+                self._retry(entry, reason=str(e))
+            return
+        _bes.COUNTERS.observe('send_seconds', _perf_counter() - start)
+        delivered = len([1 for message, attempt in batch if attempt == 0])
+        if isinstance(response, dict) and response.get('errors'):
+            for entry, reason in self._rejected(batch, response):
+                if entry[1] == 0:
+                    delivered -= 1
+                self._retry(entry, reason=reason)
+        self.retry_policy.deposit(delivered)
+
+    def _deliver(self, body):
+        connection = self.pool.get(
+            connection_class=self.connection_class, **self.connection_kwargs)
+        try:
+            return connection.send(body)
+        except Exception:
+            self.pool.discard(connection)
+            raise
+
+    def _replay(self, body):
+        """Send a chunk from the spool, respooling rejected documents"""
+        response = self._deliver(body)
+        if isinstance(response, dict) and response.get('errors'):
+            for entry, reason in self._rejected([(body, 0)], response):
+                self.spool.append(entry[0])
+
+    def _rejected(self, batch, response):
+        """Yield retryable ((item, attempt), reason) pairs from a response
+        """
+        results = _bes_http.item_results(response)
+        for message, attempt in batch:
+            for item in _bes_bulk.split_items(message):
+                try:
+                    action, result = next(results)
+                except StopIteration:
+                    return
+                if self.retry_policy.retryable_item(result):
+                    yield ((item, attempt), result.get('error'))
+
+    def _retry(self, entry, reason):
+        message, attempt = entry
+        if not self.retry_policy.acquire(attempt):
+            _bes.COUNTERS.increment('dead_letters')
+            self.dead_letter(message, reason)
+            return
+        _bes.COUNTERS.increment('retries')
+        due = _monotonic() + self.retry_policy.delay(attempt)
+        with self._retries_lock:
+            self._retry_index += 1
+            _heapq.heappush(
+                self._retries,
+                (due, self._retry_index, (message, attempt + 1)))
+
+
+def start(**kwargs):
+    """Create a BatchEmitter and make it the default for bes.emit()
+
+    Keyword arguments are passed to BatchEmitter.  Like every
+    BatchEmitter, it's flushed and shut down automatically at
+    interpreter exit (see shutdown_all()).
+    """
+    stop()
+    emitter = BatchEmitter(**kwargs)
+    _bes.DEFAULT['emitter'] = emitter
+    return emitter
+
+
+def flush(timeout=None):
+    """Flush the default emitter installed by start()"""
+    emitter = _bes.DEFAULT.get('emitter')
+    if emitter is None:
+        return True
+    return emitter.flush(timeout=timeout)
+
+
+def stop(timeout=None):
+    """Shut down the default emitter and return to synchronous sends"""
+    emitter = _bes.DEFAULT.get('emitter')
+    _bes.DEFAULT['emitter'] = None
+    if emitter is None:
+        return True
+    return emitter.shutdown(timeout=timeout)
+
+
+def shutdown_all(timeout=None):
+    """Shut down every BatchEmitter in this process
+
+    This runs automatically at interpreter exit (with EXIT_TIMEOUT),
+    so emitters created directly (not just the default from start())
+    send what they've queued.  `timeout` covers all the emitters
+    together; whatever they haven't sent by then is dead-lettered.
+    Returns False if any of them timed out.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = _monotonic() + timeout
+    flushed = stop(timeout=timeout)
+    for emitter in list(_EMITTERS):
+        if not emitter.shutdown(timeout=_remaining(deadline)):
+            flushed = False
+    return flushed
+
+
+def _shutdown_at_exit():
+    shutdown_all(timeout=EXIT_TIMEOUT)
+
+
+_atexit.register(_shutdown_at_exit)
+
+
+def queue_depth():
+    """Messages queued or awaiting retry in this process' emitters"""
+    return sum(
+        emitter._queue.qsize() + len(emitter._urgent) +
+        len(emitter._retries) for emitter in list(_EMITTERS))
+
+
+_bes.COUNTERS.register_gauge('batch_queue_depth', queue_depth)
+
+
+def _after_fork_in_child():
+    for emitter in list(_EMITTERS):
+        emitter._after_fork_in_child()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,76 @@
+"""Helpers for working with the bulk API's newline-delimited format
+
+http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/docs-bulk.html
+"""
+
+import json as _json
+
+
+def split_items(body):
+    """Split a bulk body into one chunk per action
+
+    Each chunk holds an action line and (except for 'delete', which
+    has no source) the following source line, newline-terminated.
+
+    >>> split_items(b'{"index": {}}\\n{"a": 1}\\n{"delete": {}}\\n')
+    [b'{"index": {}}\\n{"a": 1}\\n', b'{"delete": {}}\\n']
+    """
+    lines = body.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+    items = []
+    i = 0
+    while i < len(lines):
+        action = lines[i]
+        if action.lstrip().startswith(b'{"delete"'):
+            items.append(action + b'\n')
+            i += 1
+        else:
+            items.append(b'\n'.join(lines[i:i + 2] + [b'']))
+            i += 2
+    return items
+
+
+def _strings(value):
+    """Yield (container, key, string) for each string in a JSON value"""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return
+    for key, child in items:
+        if isinstance(child, (type(u''), type(''))):
+            yield (value, key, child)
+        else:
+            for string in _strings(child):
+                yield string
+
+
+def truncate_item(item, max_size, marker=u'...'):
+    """Shorten string values in an item's source to fit in `max_size`
+
+    The longest strings are cut first, and each cut string ends with
+    `marker`.  Returns the re-encoded item, or None if it can't be
+    made small enough.
+
+    >>> truncate_item(b'{"index": {}}\\n{"a": "0123456789"}\\n', 30)
+    b'{"index": {}}\\n{"a": "012..."}\\n'
+    """
+    lines = item.split(b'\n')
+    if len(lines) < 3:  # no source to truncate
+        return None
+    action, source = lines[:2]
+    payload = _json.loads(source.decode('utf-8'))
+    while True:
+        source = _json.dumps(payload).encode('utf-8')
+        item = b'\n'.join([action, source, b''])
+        excess = len(item) - max_size
+        if excess <= 0:
+            return item
+        strings = [s for s in _strings(payload) if len(s[2]) > len(marker)]
+        if not strings:
+            return None
+        container, key, string = max(strings, key=lambda s: len(s[2]))
+        keep = max(len(string) - excess - len(marker), 0)
+        container[key] = string[:keep] + marker
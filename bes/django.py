@@ -1,8 +1,15 @@
 from __future__ import absolute_import
 
+import atexit as _atexit
+import contextlib as _contextlib
+import threading as _threading
+import time as _time
+
 from django.conf import settings as _django_settings
+from django.db import connections as _django_connections
 
 import bes as _bes
+from . import batch as _bes_batch
 
 
 if _django_settings.configured:
@@ -40,8 +47,197 @@ def log_request_path(type='request', request=None, **kwargs):
 
 def log_request_body(request=None, **kwargs):
     """Like log_request_path, but also adds the request body
+
+    This reads the whole body into memory.  RequestLoggingMiddleware
+    can capture a capped prefix instead.
     """
     return log_request_path(
         request=request,
         request_body=request.read(),
         **kwargs)
+
+
+_perf_counter = getattr(_time, 'perf_counter', _time.time)
+
+_EMITTER = None
+_EMITTER_LOCK = _threading.Lock()
+
+
+def get_emitter():
+    """Return the emitter RequestLoggingMiddleware logs through
+
+    That's DEFAULT['emitter'] if you've set one (e.g. with
+    bes.batch.start()), and otherwise a BatchEmitter shared by the
+    middleware, so logging never blocks a request on network I/O.
+    """
+    global _EMITTER
+    emitter = _bes.DEFAULT['emitter']
+    if emitter is not None:
+        return emitter
+    if _EMITTER is None:
+        with _EMITTER_LOCK:
+            if _EMITTER is None:
+                _EMITTER = _bes_batch.BatchEmitter()
+    return _EMITTER
+
+
+def _shutdown_emitter():
+    if _EMITTER is not None:
+        _EMITTER.shutdown()
+
+
+_atexit.register(_shutdown_emitter)
+
+
+class _BodyCapture(object):
+    """Wrap a request stream, keeping the first `max_size` bytes read
+
+    The body is captured as the view reads it, so nothing is read
+    that the view doesn't read itself, and no more than `max_size`
+    bytes are ever held.
+    """
+    def __init__(self, stream, max_size):
+        self._stream = stream
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.read_size = 0
+
+    def _capture(self, data):
+        self.read_size += len(data)
+        room = self.max_size - self.size
+        if room > 0 and data:
+            chunk = data[:room]
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+        return data
+
+    def read(self, *args, **kwargs):
+        return self._capture(self._stream.read(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self._capture(self._stream.readline(*args, **kwargs))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def value(self):
+        return b''.join(self.chunks)
+
+    def truncated(self):
+        return self.read_size > self.size
+
+
+class _QueryTimer(object):
+    """A database execute_wrapper that totals query time"""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = _perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += _perf_counter() - start
+
+
+class RequestLoggingMiddleware(object):
+    """Log one event per request, after the response has been sent
+
+    Add 'bes.django.RequestLoggingMiddleware' to MIDDLEWARE (after
+    AuthenticationMiddleware, so the user is known).  Each event has
+    the request method and path, user_id and username, response
+    status, view name, wall time (`duration`, in seconds, including
+    streaming the response), and with Django >= 2.0, the number and
+    total time of database queries (`db_queries`, `db_duration`).
+
+    The event is logged when the server closes the response, and it's
+    handed to a background emitter (see get_emitter()), so the
+    request never waits for Elastic Search.  Events are encoded by a
+    bes.Emitter the middleware builds once and reuses until DEFAULT
+    or the background emitter changes.
+
+    Set `max_body_size` (in a subclass) to capture up to that many
+    bytes of the request body, as the view reads them.  Longer bodies
+    are truncated and flagged with request_body_truncated, so large
+    uploads are never buffered or serialized in full.
+    """
+    type = 'request'
+    max_body_size = 0
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._pipeline_cache = None  # (DEFAULT version, emitter, Emitter)
+
+    def __call__(self, request):
+        start = _perf_counter()
+        capture = None
+        stream = getattr(request, '_stream', None)
+        if self.max_body_size and stream is not None:
+            capture = request._stream = _BodyCapture(
+                stream=stream, max_size=self.max_body_size)
+        timer = _QueryTimer()
+        with _contextlib.ExitStack() as stack:
+            for connection in _django_connections.all():
+                if hasattr(connection, 'execute_wrapper'):
+                    stack.enter_context(connection.execute_wrapper(timer))
+            response = self.get_response(request)
+        close = response.close
+
+        def close_and_log():
+            try:
+                close()
+            finally:
+                self.log(
+                    request=request, response=response,
+                    duration=_perf_counter() - start, timer=timer,
+                    capture=capture)
+
+        response.close = close_and_log
+        return response
+
+    def payload(self, request, response, duration, timer, capture):
+        """Return the event payload for a finished request"""
+        user = getattr(request, 'user', None)
+        match = getattr(request, 'resolver_match', None)
+        payload = {
+            'method': request.method,
+            'request_path': request.get_full_path(),
+            'user_id': getattr(user, 'id', None),
+            'username': getattr(user, 'username', None),
+            'status': response.status_code,
+            'view': match.view_name if match is not None else None,
+            'duration': duration,
+            'db_queries': timer.count,
+            'db_duration': timer.duration,
+            }
+        if capture is not None:
+            payload['request_body_size'] = int(
+                request.META.get('CONTENT_LENGTH') or 0)
+            payload['request_body'] = capture.value()
+            payload['request_body_truncated'] = capture.truncated()
+        return payload
+
+    def _pipeline(self):
+        """Return the bes.Emitter that encodes this middleware's events"""
+        emitter = get_emitter()
+        cached = self._pipeline_cache
+        version = _bes.DEFAULT.version
+        if cached is None or cached[0] != version or cached[1] is not emitter:
+            cached = self._pipeline_cache = (version, emitter, _bes.Emitter(
+                type=self.type, emitter=emitter, headers=_bes.HEADERS))
+        return cached[2]
+
+    def log(self, request, response, duration, timer, capture):
+        try:
+            self._pipeline().log(
+                **self.payload(
+                    request=request, response=response, duration=duration,
+                    timer=timer, capture=capture))
+        except Exception:
+            _bes.LOG.exception('unable to log request')
@@ -0,0 +1,130 @@
+"""Cached host name resolution for datagram sends
+
+Sending a datagram to a host name makes the system resolver look it
+up for every send.  Connection resolves names through RESOLVER
+instead, which caches the addresses for DEFAULT['dns_ttl'] seconds:
+
+>>> import bes
+>>> bes.DEFAULT['dns_ttl'] = 300
+
+Expired entries are still used while a background thread refreshes
+them, so only a host's very first lookup waits on the resolver.  If a
+refresh fails, the old addresses are kept.  If a host has never
+resolved, the failure is cached for `negative_ttl` seconds, and sends
+fail immediately instead of queueing up behind a slow resolver.
+"""
+
+from __future__ import absolute_import
+
+import os as _os
+import socket as _socket
+import threading as _threading
+import time as _time
+
+import bes as _bes
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+
+# names the socket module accepts that getaddrinfo() doesn't
+_SPECIAL_HOSTS = {
+    '': '0.0.0.0',
+    '<broadcast>': '255.255.255.255',
+    }
+
+
+class _Entry(object):
+    def __init__(self):
+        self.addresses = []  # [(family, socket address), ...]
+        self.error = None
+        self.expires = 0
+        self.refreshing = False
+
+
+class Resolver(object):
+    """Resolve (host, port) to (family, socket address), with a cache
+
+    `ttl` defaults to DEFAULT['dns_ttl'].  Names with both IPv4 and
+    IPv6 addresses (like 'localhost', with ::1 in /etc/hosts) resolve
+    to IPv4, as they would for a plain AF_INET socket, so listeners
+    bound to IPv4 keep receiving.  IPv6 is used for IPv6 literals and
+    names with only IPv6 addresses.
+    """
+    def __init__(self, ttl=None, negative_ttl=5):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = _threading.Lock()
+        self._cache = {}
+
+    def resolve(self, host, port, socket_type=_socket.SOCK_DGRAM):
+        """Return (family, socket address) for `host` and `port`
+
+        Raises socket.gaierror if the host has never been resolved.
+        """
+        key = (host, port, socket_type)
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = _Entry()
+            self._lookup(key, entry)
+            self._cache[key] = entry
+        elif _monotonic() >= entry.expires:
+            self._refresh(key, entry)
+        if not entry.addresses:
+            raise _socket.gaierror(*entry.error.args)
+        return entry.addresses[0]
+
+    def _refresh(self, key, entry):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+        thread = _threading.Thread(
+            name='bes resolver', target=self._lookup, args=(key, entry))
+        thread.daemon = True
+        thread.start()
+
+    def _lookup(self, key, entry):
+        host, port, socket_type = key
+        _bes.COUNTERS.increment('dns_lookups')
+        try:
+            addresses = [
+                (family, address) for family, _, _, _, address in
+                _socket.getaddrinfo(
+                    _SPECIAL_HOSTS.get(host, host), port, 0, socket_type)
+                if family in (_socket.AF_INET, _socket.AF_INET6)]
+            if not addresses:
+                raise _socket.gaierror(
+                    _socket.EAI_NONAME, 'no IP addresses for {}'.format(host))
+            # prefer IPv4, keeping getaddrinfo()'s order within a family
+            addresses.sort(key=lambda address: address[0] != _socket.AF_INET)
+        except _socket.error as e:
+            _bes.COUNTERS.increment('dns_errors')
+            _bes.LOG.warning('unable to resolve {} ({})'.format(host, e))
+            entry.error = e
+            entry.expires = _monotonic() + self.negative_ttl
+        else:
+            ttl = self.ttl
+            if ttl is None:
+                ttl = _bes.DEFAULT['dns_ttl']
+            entry.addresses = addresses
+            entry.error = None
+            entry.expires = _monotonic() + ttl
+        finally:
+            entry.refreshing = False
+
+    def clear(self):
+        """Forget every cached address"""
+        self._cache = {}
+
+    def _after_fork_in_child(self):
+        """Forget refreshes running in the parent's threads"""
+        self._lock = _threading.Lock()
+        for entry in list(self._cache.values()):
+            entry.refreshing = False
+
+
+RESOLVER = Resolver()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=RESOLVER._after_fork_in_child)
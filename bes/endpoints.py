@@ -0,0 +1,271 @@
+"""Spread bulk traffic across several Elastic Search nodes
+
+Set DEFAULT['hosts'] to a list of endpoints, and each Connection
+balances its sends across them:
+
+>>> import bes
+>>> bes.DEFAULT['hosts'] = ['es1:9200', 'es2:9200', '[fd00::3]:9200']
+>>> bes.DEFAULT['balance'] = 'least_outstanding'
+
+Endpoints that fail `max_failures` times in a row are ejected for
+`cooldown` seconds, after which a single request probes them again.
+A failed send is retried on the next healthy endpoint, so one dead
+node doesn't take logging down with it.  Connections to the same
+endpoints share their health state (see get()), so a reopened
+connection doesn't retry nodes that are known to be down.
+"""
+
+from __future__ import absolute_import
+
+import os as _os
+import threading as _threading
+import time as _time
+import weakref as _weakref
+
+import bes as _bes
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+
+_ENDPOINTS = _weakref.WeakSet()
+
+_SHARED = {}  # {((host, port), ...), balance): Endpoints}
+_SHARED_LOCK = _threading.Lock()
+
+BALANCE = ['round_robin', 'least_outstanding']
+
+
+def parse(endpoint, port=None):
+    """Return (host, port) for 'host', 'host:port', '[v6]:port', ...
+
+    Tuples are passed through.  `port` is used when the endpoint
+    doesn't have one.
+
+    >>> parse('es1:9200')
+    ('es1', 9200)
+    >>> parse('[fd00::3]:9200')
+    ('fd00::3', 9200)
+    >>> parse('es1', port=9700)
+    ('es1', 9700)
+    """
+    if isinstance(endpoint, (tuple, list)):
+        return (endpoint[0], int(endpoint[1]))
+    if endpoint.startswith('['):
+        host, _, rest = endpoint[1:].partition(']')
+        if rest.startswith(':'):
+            port = int(rest[1:])
+        return (host, port)
+    if endpoint.count(':') == 1:
+        host, port = endpoint.split(':')
+        return (host, int(port))
+    return (endpoint, port)
+
+
+class Endpoint(object):
+    """One node, with its health and traffic statistics"""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.outstanding = 0
+        self.failures = 0  # consecutive
+        self.ejected_until = None
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+        self.latency = _bes.Histogram()
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.name)
+
+    @property
+    def name(self):
+        if ':' in self.host:
+            return '[{}]:{}'.format(self.host, self.port)
+        return '{}:{}'.format(self.host, self.port)
+
+    def stats(self):
+        return {
+            'healthy': self.ejected_until is None,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'ejections': self.ejections,
+            'send_seconds': self.latency.summary(),
+            }
+
+    def _add(self, other):
+        """Add another Endpoint's statistics for the same node"""
+        self.outstanding += other.outstanding
+        self.requests += other.requests
+        self.errors += other.errors
+        self.ejections += other.ejections
+        if other.ejected_until is not None:
+            self.ejected_until = max(
+                self.ejected_until or other.ejected_until,
+                other.ejected_until)
+        self.latency.merge(other.latency)
+
+
+class Endpoints(object):
+    """Pick endpoints and track their health
+
+    `balance` is 'round_robin' (take healthy endpoints in turn) or
+    'least_outstanding' (take the healthy endpoint with the fewest
+    sends in flight).  After `max_failures` consecutive failures, an
+    endpoint is ejected.  Once `cooldown` seconds have passed, the
+    next select() may return it as a probe: success restores it, and
+    failure ejects it for another cooldown.  If every endpoint is
+    ejected, the one due back soonest is used anyway.
+    """
+    def __init__(self, endpoints, port=None, balance='round_robin',
+                 max_failures=3, cooldown=30):
+        if balance not in BALANCE:
+            raise ValueError(balance)
+        self.endpoints = [
+            Endpoint(*parse(endpoint, port=port)) for endpoint in endpoints]
+        if not self.endpoints:
+            raise ValueError('no endpoints')
+        self.balance = balance
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._lock = _threading.Lock()
+        self._next = 0
+        _ENDPOINTS.add(self)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def select(self, exclude=()):
+        """Return the endpoint to use for the next send
+
+        Endpoints in `exclude` (e.g. ones that already failed this
+        send) are skipped unless there's nothing else.  Pass the
+        result to success() or failure() when the send completes.
+        """
+        with self._lock:
+            now = _monotonic()
+            candidates = [
+                endpoint for endpoint in self.endpoints
+                if endpoint not in exclude and self._available(endpoint, now)]
+            if not candidates:
+                candidates = [
+                    endpoint for endpoint in self.endpoints
+                    if endpoint not in exclude] or self.endpoints
+                candidates = [min(
+                    candidates,
+                    key=lambda endpoint: endpoint.ejected_until or 0)]
+            if self.balance == 'least_outstanding':
+                endpoint = min(
+                    candidates, key=lambda endpoint: endpoint.outstanding)
+            else:
+                endpoint = candidates[self._next % len(candidates)]
+                self._next += 1
+            if endpoint.ejected_until is not None:
+                endpoint.probing = True
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _available(self, endpoint, now):
+        if endpoint.ejected_until is None:
+            return True
+        return not endpoint.probing and now >= endpoint.ejected_until
+
+    def success(self, endpoint, duration=None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.failures = 0
+            if endpoint.ejected_until is not None:
+                _bes.LOG.info('endpoint {} restored'.format(endpoint.name))
+            endpoint.ejected_until = None
+            endpoint.probing = False
+            if duration is not None:
+                endpoint.latency.record(duration)
+
+    def failure(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.failures += 1
+            endpoint.errors += 1
+            if (endpoint.probing or
+                    endpoint.failures >= self.max_failures and
+                    endpoint.ejected_until is None):
+                _bes.LOG.warning(
+                    'ejecting endpoint {} for {} seconds'.format(
+                        endpoint.name, self.cooldown))
+                _bes.COUNTERS.increment('endpoint_ejections')
+                endpoint.ejections += 1
+                endpoint.ejected_until = _monotonic() + self.cooldown
+                endpoint.probing = False
+
+    def release(self, endpoint):
+        """The send finished without saying anything about health"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.probing = False
+
+    def stats(self):
+        """Return {endpoint name: statistics}"""
+        with self._lock:
+            return dict(
+                (endpoint.name, endpoint.stats())
+                for endpoint in self.endpoints)
+
+    def _after_fork_in_child(self):
+        """Forget sends that were in flight in the parent's threads"""
+        self._lock = _threading.Lock()
+        for endpoint in self.endpoints:
+            endpoint.outstanding = 0
+            endpoint.probing = False
+
+
+def get(endpoints, port=None, balance='round_robin'):
+    """Return the shared Endpoints for these endpoints and balance
+
+    Connection uses this, so health and statistics for a set of nodes
+    live as long as the process rather than as long as a connection.
+    """
+    key = (
+        tuple(parse(endpoint, port=port) for endpoint in endpoints),
+        balance)
+    shared = _SHARED.get(key)
+    if shared is None:
+        with _SHARED_LOCK:
+            shared = _SHARED.get(key)
+            if shared is None:
+                shared = _SHARED[key] = Endpoints(
+                    endpoints, port=port, balance=balance)
+    return shared
+
+
+def stats():
+    """Per-endpoint statistics for every Endpoints in this process
+
+    Statistics for a node used by several Endpoints are added up (it
+    counts as healthy only if none of them has ejected it).
+    """
+    totals = {}
+    for endpoints in list(_ENDPOINTS):
+        with endpoints._lock:
+            for endpoint in endpoints.endpoints:
+                total = totals.get(endpoint.name)
+                if total is None:
+                    total = totals[endpoint.name] = Endpoint(
+                        endpoint.host, endpoint.port)
+                total._add(endpoint)
+    return dict((name, total.stats()) for name, total in totals.items())
+
+
+_bes.COUNTERS.register_gauge('endpoints', stats)
+
+
+def _after_fork_in_child():
+    global _SHARED_LOCK
+    _SHARED_LOCK = _threading.Lock()
+    for endpoints in list(_ENDPOINTS):
+        endpoints._after_fork_in_child()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=_after_fork_in_child)
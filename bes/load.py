@@ -0,0 +1,394 @@
+"""Bulk-load NDJSON files into Elastic Search
+
+Each input line is a JSON document, which is indexed with the same
+index, type, and datestamp logic as bes.emit().  Datestamps come from
+each document's own @timestamp, so old events land in the index for
+their day (documents without one use the current time):
+
+  $ python -m bes load --type record --protocol HTTP --port 9200 \\
+  >   'events-*.json.gz'
+
+Inputs can be files, glob patterns, gzipped files (ending in '.gz'),
+or '-' for stdin.  Plain files are memory-mapped.  Lines are grouped
+into bulk chunks, which a pool of worker threads uploads in parallel.
+Progress and throughput are written to stderr.  If a chunk can't be
+delivered (including documents the cluster keeps rejecting under
+load), loading stops and the error says which byte offset to restart
+from with --offset.
+"""
+
+from __future__ import absolute_import
+
+import calendar as _calendar
+import glob as _glob
+import gzip as _gzip
+import mmap as _mmap
+import os as _os
+import re as _re
+try:
+    import queue as _queue
+except ImportError:  # Python 2
+    import Queue as _queue
+import sys as _sys
+import threading as _threading
+import time as _time
+
+import bes as _bes
+from . import bulk as _bes_bulk
+from . import http as _bes_http
+from . import retry as _bes_retry
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+
+_TIMESTAMP = _re.compile(
+    br'"@timestamp"\s*:\s*(?:"([^"]*)"|(-?[0-9]+(?:[.][0-9]+)?))')
+_UTC_OFFSET = _re.compile(r'([+-])([0-9]{2}):?([0-9]{2})$')
+
+
+class LoadError(Exception):
+    """Loading `path` failed; everything before `offset` was sent"""
+    def __init__(self, path, offset, error):
+        super(LoadError, self).__init__(
+            'failed to load {} ({}); resume with --offset {}'.format(
+                path, error, offset))
+        self.path = path
+        self.offset = offset
+        self.error = error
+
+
+def expand(patterns):
+    """Return the input paths matching `patterns`, in order
+
+    '-' (stdin) and paths without glob characters are passed through
+    as they are.
+    """
+    paths = []
+    for pattern in patterns:
+        if pattern == '-' or not _glob.has_magic(pattern):
+            paths.append(pattern)
+        else:
+            paths.extend(sorted(_glob.glob(pattern)))
+    return paths
+
+
+def timestamp(line):
+    """Return a document's @timestamp in seconds since the epoch
+
+    Handles both DEFAULT['timestamp_format'] styles: ISO 8601 strings
+    (UTC, unless they carry an offset) and epoch milliseconds.
+    Returns None if the document has no @timestamp we can read.
+
+    >>> timestamp(b'{"@timestamp": "2014-05-13T17:21:01.123456Z"}')
+    1400001661
+    >>> timestamp(b'{"@timestamp": 1400001661123}')
+    1400001661.123
+    """
+    match = _TIMESTAMP.search(line)
+    if match is None:
+        return None
+    iso, millis = match.groups()
+    if millis is not None:
+        return float(millis) / 1000
+    iso = iso.decode('ascii', 'replace')
+    try:
+        if iso[4] + iso[7] + iso[10] + iso[13] + iso[16] != '--T::':
+            return None
+        seconds = _calendar.timegm((
+            int(iso[0:4]), int(iso[5:7]), int(iso[8:10]),
+            int(iso[11:13]), int(iso[14:16]), int(iso[17:19]), 0, 0, 0))
+    except (IndexError, ValueError):
+        return None
+    offset = _UTC_OFFSET.search(iso[19:])
+    if offset is not None:
+        sign, hours, minutes = offset.groups()
+        delta = 3600 * int(hours) + 60 * int(minutes)
+        seconds += -delta if sign == '+' else delta
+    return seconds
+
+
+def read_lines(path, offset=0):
+    """Yield (line, end offset) for each non-empty line in `path`
+
+    Offsets count bytes of (uncompressed) input, so a load can resume
+    from any offset this yields.  Plain files are memory-mapped;
+    gzipped files and stdin are streamed.
+    """
+    if path == '-':
+        stream = getattr(_sys.stdin, 'buffer', _sys.stdin)
+        for line in _read_stream(stream, offset):
+            yield line
+    elif path.endswith('.gz'):
+        with _gzip.open(path, 'rb') as stream:
+            for line in _read_stream(stream, offset):
+                yield line
+    else:
+        with open(path, 'rb') as f:
+            if _os.fstat(f.fileno()).st_size <= offset:
+                return
+            buffer = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+            try:
+                for line in _read_buffer(buffer, offset):
+                    yield line
+            finally:
+                buffer.close()
+
+
+def _read_buffer(buffer, offset):
+    end = len(buffer)
+    position = offset
+    while position < end:
+        newline = buffer.find(b'\n', position)
+        if newline < 0:
+            newline = end
+        line = buffer[position:newline].strip()
+        position = newline + 1
+        if line:
+            yield (line, min(position, end))
+
+
+def _read_stream(stream, offset):
+    position = 0
+    while position < offset:  # skip (streams can't seek)
+        data = stream.read(min(offset - position, 2**16))
+        if not data:
+            return
+        position += len(data)
+    for line in stream:
+        position += len(line)
+        line = line.strip()
+        if line:
+            yield (line, position)
+
+
+def chunks(lines, header, max_count=500, max_bytes=2**20):
+    """Group (line, offset) pairs into bulk bodies
+
+    Yields (body, document count, end offset) for chunks of at most
+    `max_count` documents and (unless a single document is larger)
+    `max_bytes` bytes.  `header(line)` returns the action line for
+    the document `line`.
+    """
+    parts = []
+    count = size = 0
+    end = None
+    for line, offset in lines:
+        action = header(line)
+        item_size = len(action) + len(line) + 1
+        if parts and (count >= max_count or size + item_size > max_bytes):
+            yield (b''.join(parts), count, end)
+            parts = []
+            count = size = 0
+        parts.extend([action, line, b'\n'])
+        count += 1
+        size += item_size
+        end = offset
+    if parts:
+        yield (b''.join(parts), count, end)
+
+
+class Loader(object):
+    """Upload NDJSON inputs with `workers` parallel threads
+
+    `index`, `type`, and `datestamp_index` default to bes.DEFAULT, as
+    for bes.emit().  Chunks that fail with a retryable error (see
+    bes.retry.RetryPolicy) are resent after a backoff, and so are
+    documents the cluster rejects under load (e.g. with a 429).  Any
+    other failure, or running out of retries, stops the load with a
+    LoadError.  Documents rejected for other reasons (e.g. mapping
+    errors) are counted, logged, and skipped.  Remaining keyword
+    arguments configure the connections, as for bes.emit().
+    """
+    def __init__(self, index=None, type=None, datestamp_index=None,
+                 workers=4, max_count=500, max_bytes=2**20,
+                 retry_policy=None, progress_interval=1.0, output=None,
+                 connection_class=_bes.Connection, pool=_bes.POOL,
+                 **kwargs):
+        if index is None:
+            index = _bes.DEFAULT['index']
+        if type is None:
+            type = _bes.DEFAULT['type']
+        if type is None:
+            raise ValueError('you must set a type')
+        if datestamp_index is None:
+            datestamp_index = _bes.DEFAULT['datestamp_index']
+        if retry_policy is None:
+            retry_policy = _bes_retry.RetryPolicy()
+        self.index = index
+        self.type = type
+        self.datestamp_index = datestamp_index
+        self.workers = workers
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.retry_policy = retry_policy
+        self.progress_interval = progress_interval
+        self.output = output
+        self.connection_class = connection_class
+        self.pool = pool
+        self.connection_kwargs = kwargs
+        self.documents = 0
+        self.bytes = 0
+        self.rejected = 0
+        self._lock = _threading.Lock()
+        self._start = None
+        self._last_progress = None
+
+    def header(self, line):
+        """Return the action line for the document `line`"""
+        now = None
+        if self.datestamp_index:
+            now = timestamp(line)
+        return _bes.HEADERS.get(
+            index=self.index, type=self.type,
+            datestamp_index=self.datestamp_index,
+            datestamp_format=_bes.DEFAULT['datestamp_format'], now=now)
+
+    def load(self, paths, offset=0):
+        """Load each path in turn, starting the first at `offset`"""
+        self._start = self._last_progress = _monotonic()
+        for path in paths:
+            self.load_path(path, offset=offset)
+            offset = 0
+        self.progress(final=True)
+
+    def load_path(self, path, offset=0):
+        """Load one input; return the offset of its end"""
+        tasks = _queue.Queue(maxsize=2 * self.workers)
+        state = _LoadState(offset=offset)
+        threads = [
+            _threading.Thread(
+                name='bes loader', target=self._work, args=(tasks, state))
+            for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for sequence, chunk in enumerate(chunks(
+                    read_lines(path, offset=offset), header=self.header,
+                    max_count=self.max_count, max_bytes=self.max_bytes)):
+                if state.error is not None:
+                    break
+                tasks.put((sequence, chunk))
+                self.progress()
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        if state.error is not None:
+            raise LoadError(path=path, offset=state.offset, error=state.error)
+        return state.offset
+
+    def _work(self, tasks, state):
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            sequence, (body, count, end) = task
+            if state.error is not None:
+                continue
+            try:
+                self._send(body)
+            except Exception as e:
+                _bes.LOG.error('unable to send chunk {} ({})'.format(
+                    sequence, e))
+                state.fail(e)
+                continue
+            with self._lock:
+                self.documents += count
+                self.bytes += len(body)
+            state.complete(sequence, end)
+
+    def _send(self, body):
+        attempt = 0
+        while True:
+            connection = self.pool.get(
+                connection_class=self.connection_class,
+                **self.connection_kwargs)
+            try:
+                response = connection.send(body)
+            except Exception as e:
+                self.pool.discard(connection)
+                if (attempt >= self.retry_policy.max_retries or
+                        not self.retry_policy.retryable_error(e)):
+                    raise
+                _time.sleep(self.retry_policy.delay(attempt))
+                attempt += 1
+                continue
+            retry = self._rejected(body, response)
+            if not retry:
+                return response
+            if attempt >= self.retry_policy.max_retries:
+                raise _bes_http.BulkError(
+                    status=retry[0][1].get('status'),
+                    reason='{} documents still rejected after {} '
+                    'retries'.format(len(retry), attempt))
+            _bes.COUNTERS.increment('retries', len(retry))
+            _time.sleep(self.retry_policy.delay(attempt))
+            attempt += 1
+            body = b''.join(item for item, result in retry)
+
+    def _rejected(self, body, response):
+        """Count rejected documents; return retryable (item, result)s"""
+        if not (isinstance(response, dict) and response.get('errors')):
+            return []
+        retry = []
+        rejected = 0
+        for item, (action, result) in zip(
+                _bes_bulk.split_items(body),
+                _bes_http.item_results(response)):
+            if result.get('status', 200) < 300 and 'error' not in result:
+                continue
+            if self.retry_policy.retryable_item(result):
+                retry.append((item, result))
+            else:
+                rejected += 1
+        if rejected:
+            with self._lock:
+                self.rejected += rejected
+        return retry
+
+    def progress(self, final=False):
+        """Write a progress line to `output` every progress_interval"""
+        if self.output is None:
+            return
+        now = _monotonic()
+        if not final and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        elapsed = max(now - self._start, 1e-9)
+        with self._lock:
+            documents, size, rejected = (
+                self.documents, self.bytes, self.rejected)
+        self.output.write(
+            '{}{} documents ({} rejected), {:.1f} MB in {:.1f} s: '
+            '{:.0f} documents/s, {:.2f} MB/s\n'.format(
+                'done: ' if final else '', documents, rejected, size / 1e6,
+                elapsed, documents / elapsed, size / 1e6 / elapsed))
+        self.output.flush()
+
+
+class _LoadState(object):
+    """Track the offset below which every chunk has been delivered
+
+    Workers finish chunks out of order, so the resumable offset only
+    advances past a chunk once all earlier chunks are done.
+    """
+    def __init__(self, offset):
+        self.offset = offset
+        self.error = None
+        self._lock = _threading.Lock()
+        self._next = 0
+        self._done = {}
+
+    def complete(self, sequence, end):
+        with self._lock:
+            self._done[sequence] = end
+            while self._next in self._done:
+                self.offset = self._done.pop(self._next)
+                self._next += 1
+
+    def fail(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
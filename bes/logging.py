@@ -0,0 +1,184 @@
+"""A standard library logging handler that logs to Elastic Search
+
+>>> import logging
+>>> import bes.logging
+>>> logging.getLogger().addHandler(bes.logging.BesHandler())
+>>> logging.getLogger('app').warning('disk %d%% full', 93)
+
+BesHandler turns each LogRecord into the same kind of document
+bes.log() builds (with @timestamp and @version), plus the message,
+level, logger name, source location, any `extra` fields, and the
+formatted traceback for exceptions.  Records are put on a bounded
+queue, as with logging.handlers.QueueHandler, and a listener thread
+encodes them and hands them to a bes.batch.BatchEmitter, so logging
+calls never wait on the network.
+"""
+
+from __future__ import absolute_import
+
+import copy as _copy
+import logging as _logging
+import logging.handlers as _logging_handlers
+import os as _os
+import queue as _queue
+import weakref as _weakref
+
+import bes as _bes
+from . import batch as _bes_batch
+
+
+_HANDLERS = _weakref.WeakSet()
+
+# LogRecord attributes that aren't `extra` fields
+_RECORD_ATTRIBUTES = frozenset(
+    list(_logging.LogRecord('', 0, '', 0, '', None, None).__dict__) +
+    ['message', 'asctime', 'taskName'])
+
+_FORMATTER = _logging.Formatter()
+
+
+class _Listener(_logging_handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # wait for room in a full queue
+
+
+class BesHandler(_logging_handlers.QueueHandler):
+    """Queue log records for a background thread to send to bes
+
+    Records are logged with `type` (and `index`, if given, instead of
+    DEFAULT['index']).  At most `max_queue` records wait in the queue;
+    records logged while it's full are dropped and counted in
+    bes.COUNTERS ('dropped' and 'log_records_dropped').
+
+    Records are encoded by a bes.Emitter built once for the handler
+    (and rebuilt only when DEFAULT changes), and sent through
+    `emitter`, which defaults to a BatchEmitter owned by the handler
+    (and shut down by close()).
+    Records from bes' own loggers are ignored, so bes can't feed its
+    send failures back into itself.
+    """
+    def __init__(self, level=_logging.NOTSET, index=None, type='log',
+                 max_queue=10000, emitter=None):
+        self._owns_emitter = emitter is None
+        if emitter is None:
+            emitter = _bes_batch.BatchEmitter()
+        self.index = index
+        self.type = type
+        self.max_queue = max_queue
+        self.emitter = emitter
+        self._pipeline_cache = None  # (DEFAULT version, bes.Emitter)
+        self._listener = None
+        super(BesHandler, self).__init__(_queue.Queue(max_queue))
+        self.setLevel(level)
+        _HANDLERS.add(self)
+
+    def _pipeline(self):
+        """Return the bes.Emitter that encodes this handler's records"""
+        cached = self._pipeline_cache
+        version = _bes.DEFAULT.version
+        if cached is None or cached[0] != version:
+            cached = self._pipeline_cache = (version, _bes.Emitter(
+                index=self.index, type=self.type, emitter=self.emitter,
+                headers=_bes.HEADERS))
+        return cached[1]
+
+    def _after_fork_in_child(self):
+        self.queue = _queue.Queue(self.max_queue)
+        self._listener = None
+
+    def _start(self):
+        self.acquire()
+        try:
+            if self._listener is None:
+                self._listener = _Listener(self.queue, _Sender(self))
+                self._listener.start()
+        finally:
+            self.release()
+
+    def emit(self, record):
+        if record.name == 'bes' or record.name.startswith('bes.'):
+            return
+        if self._listener is None:
+            self._start()
+        super(BesHandler, self).emit(record)
+
+    def prepare(self, record):
+        """Render the message and traceback on the logging thread
+
+        Unlike QueueHandler.prepare(), the traceback is kept separate
+        from the message (in exc_text).
+        """
+        formatter = self.formatter or _FORMATTER
+        record = _copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except _queue.Full:
+            _bes.COUNTERS.increment('dropped')
+            _bes.COUNTERS.increment('log_records_dropped')
+
+    def payload(self, record):
+        """Return the document for a (prepared) log record"""
+        payload = {
+            '@timestamp': self._pipeline().timestamper.render(
+                record.created),
+            '@version': 1,
+            'message': record.message,
+            'level': record.levelname,
+            'logger': record.name,
+            'path': record.pathname,
+            'lineno': record.lineno,
+            'function': record.funcName,
+            'process': record.process,
+            'thread_name': record.threadName,
+            }
+        if record.exc_text:
+            payload['exc_info'] = record.exc_text
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and key not in payload:
+                payload[key] = value
+        return payload
+
+    def close(self):
+        self.acquire()
+        try:
+            listener = self._listener
+            self._listener = None
+        finally:
+            self.release()
+        if listener is not None:
+            listener.stop()
+        if self._owns_emitter:
+            self.emitter.shutdown()
+        super(BesHandler, self).close()
+
+
+class _Sender(_logging.Handler):
+    """The listener's handler: encode records and pass them on"""
+    def __init__(self, handler):
+        super(_Sender, self).__init__()
+        self.handler = handler
+
+    def emit(self, record):
+        handler = self.handler
+        try:
+            handler._pipeline().emit(
+                payload=handler.payload(record), now=record.created)
+        except Exception:
+            self.handleError(record)
+
+
+def _after_fork_in_child():
+    for handler in list(_HANDLERS):
+        handler._after_fork_in_child()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=_after_fork_in_child)
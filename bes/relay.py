@@ -0,0 +1,133 @@
+"""Funnel bulk messages from many local processes through one sender
+
+Under pre-fork servers (gunicorn, uwsgi, multiprocessing, ...) every
+worker would otherwise run its own batching and network I/O.  With a
+relay, workers just hand their encoded messages to a single local
+process over a Unix datagram socket:
+
+>>> import bes
+>>> bes.DEFAULT['protocol'] = 'UNIX'
+>>> bes.DEFAULT['host'] = '/run/bes.sock'
+
+and the relay process batches them and sends them upstream with a
+bes.batch.BatchEmitter.  Start the relay from your master process
+with spawn(), or run it on its own with:
+
+  $ python -m bes.relay /run/bes.sock --host es.example.com --port 9200 \\
+  >   --protocol HTTP
+"""
+
+from __future__ import absolute_import
+
+import argparse as _argparse
+import multiprocessing as _multiprocessing
+import os as _os
+import socket as _socket
+import threading as _threading
+
+import bes as _bes
+from . import batch as _bes_batch
+
+
+class Relay(object):
+    """Receive bulk messages on a Unix datagram socket and forward them
+
+    Each datagram received on `path` is passed to `emitter.put()`.
+    """
+    def __init__(self, path, emitter, bufsize=2**20):
+        self.path = path
+        self.emitter = emitter
+        self.bufsize = bufsize
+        self._sock = None
+        self._stop = _threading.Event()
+
+    def __enter__(self):
+        if _os.path.exists(self.path):
+            _os.remove(self.path)
+        self._sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.settimeout(0.5)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+                _os.remove(self.path)
+            finally:
+                self._sock = None
+        self.emitter.shutdown()
+
+    def serve_forever(self):
+        """Forward datagrams until stop() is called"""
+        while not self._stop.is_set():
+            try:
+                message = self._sock.recv(self.bufsize)
+            except _socket.timeout:
+                continue
+            _bes.COUNTERS.increment('relay_messages')
+            self.emitter.put(message)
+
+    def stop(self):
+        self._stop.set()
+
+
+def serve(path, **kwargs):
+    """Run a relay on `path`, forwarding with BatchEmitter(**kwargs)"""
+    if kwargs.get('protocol', _bes.DEFAULT['protocol']) == 'UNIX':
+        raise ValueError('the relay must forward over UDP or HTTP')
+    # wait a little for upstream to catch up, but never forever;
+    # meanwhile senders back up into the socket buffer, and then drop
+    kwargs.setdefault('queue_policy', 'block')
+    kwargs.setdefault('queue_timeout', 1)
+    emitter = _bes_batch.BatchEmitter(**kwargs)
+    with Relay(path=path, emitter=emitter) as relay:
+        try:
+            relay.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def spawn(path, **kwargs):
+    """Start a relay in a separate process and return the Process
+
+    Call this before forking your workers.  The relay process is a
+    daemon, so it exits with its parent.
+    """
+    process = _multiprocessing.Process(
+        name='bes relay', target=serve, args=(path,), kwargs=kwargs)
+    process.daemon = True
+    process.start()
+    return process
+
+
+def main(args=None):
+    parser = _argparse.ArgumentParser(
+        description='Forward bulk messages from a Unix socket.')
+    parser.add_argument('path', help='Unix datagram socket to listen on')
+    parser.add_argument('--host', help='Elastic Search host')
+    parser.add_argument('--port', type=int, help='Elastic Search port')
+    parser.add_argument('--protocol', help="'UDP' or 'HTTP'")
+    parser.add_argument(
+        '--gzip-level', type=int,
+        help='gzip HTTP request bodies at this level (1 to 9)')
+    parser.add_argument(
+        '--max-count', type=int, default=500,
+        help='maximum documents per bulk request')
+    parser.add_argument(
+        '--max-linger', type=float, default=1.0,
+        help='maximum seconds to hold a partial batch')
+    args = parser.parse_args(args)
+    kwargs = dict(
+        (name, value) for name, value in [
+            ('host', args.host),
+            ('port', args.port),
+            ('protocol', args.protocol),
+            ('gzip_level', args.gzip_level),
+            ] if value is not None)
+    serve(path=args.path, max_count=args.max_count,
+          max_linger=args.max_linger, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
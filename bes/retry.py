@@ -0,0 +1,86 @@
+"""Retry policy for documents rejected under back-pressure
+
+When the cluster is overloaded, Elastic Search rejects individual
+bulk items with a 429 (es_rejected_execution_exception) while
+accepting the rest of the request.  RetryPolicy decides which
+documents are worth resending, how long to wait before resending
+them, and when to give up.
+"""
+
+from __future__ import absolute_import
+
+import random as _random
+import socket as _socket
+import threading as _threading
+
+import bes as _bes
+
+
+RETRY_STATUSES = (429, 503)
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter and a retry budget
+
+    Attempt n (counting from zero) waits a random time between zero
+    and min(max_backoff, backoff * 2**n) seconds.  Documents are
+    retried at most `max_retries` times.
+
+    Retries also draw from a shared token bucket holding at most
+    `budget` tokens.  Each document delivered on its first attempt
+    deposits `budget_ratio` tokens and each retry withdraws one, so
+    in steady state retries are limited to roughly `budget_ratio` of
+    fresh traffic.  That keeps a struggling cluster from being
+    buried under its own rejected documents.
+    """
+    def __init__(self, max_retries=5, backoff=0.1, max_backoff=30,
+                 budget=100, budget_ratio=0.1):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self._tokens = float(budget)
+        self._lock = _threading.Lock()
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number `attempt`"""
+        return _random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def deposit(self, count=1):
+        """Credit the budget for `count` first-attempt deliveries"""
+        with self._lock:
+            self._tokens = min(
+                self.budget, self._tokens + count * self.budget_ratio)
+
+    def acquire(self, attempt):
+        """Return True if a document may make retry number `attempt`"""
+        if attempt >= self.max_retries:
+            return False
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        return True
+
+    def retryable_error(self, error):
+        """Is it worth resending a request that raised `error`?"""
+        status = getattr(error, 'status', None)
+        if status is not None:
+            return status in RETRY_STATUSES
+        return isinstance(error, _socket.error)
+
+    def retryable_item(self, result):
+        """Is it worth resending an item with this bulk result?"""
+        if result.get('status') in RETRY_STATUSES:
+            return True
+        error = result.get('error')
+        if isinstance(error, dict):
+            error = error.get('type')
+        return error == 'es_rejected_execution_exception'
+
+
+def log_dead_letter(message, reason):
+    """The default dead-letter callback: log and drop the document"""
+    _bes.LOG.error('giving up on {!r} ({})'.format(message, reason))
@@ -0,0 +1,133 @@
+"""Sampling and rate limiting for noisy event types
+
+Hot code paths wrapped with bes.trace.trace() or bes.django helpers
+can produce far more events than you need.  Install a Sampler to
+thin them out before any timestamping or encoding happens:
+
+>>> import bes.sampling
+>>> bes.DEFAULT['sampler'] = bes.sampling.Sampler(
+...     rates={'request': 0.1},  # keep 10% of 'request' events
+...     limits={'my_function': 100})  # at most 100 events per second
+
+Events matching bes.is_error() (action='error' events and ERROR or
+CRITICAL log records) are never dropped.
+"""
+
+from __future__ import absolute_import
+
+import random as _random
+import threading as _threading
+import time as _time
+
+import bes as _bes
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+
+
+def log_report(counts, interval):
+    """The default report callback: log the dropped-event counts"""
+    for type, count in sorted(counts.items()):
+        _bes.LOG.info(
+            'dropped {} type {!r} events in the last {:.0f} seconds '
+            '({} sampled out, {} throttled)'.format(
+                count['sampled'] + count['throttled'], type, interval,
+                count['sampled'], count['throttled']))
+
+
+class _TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        if burst is None:
+            burst = max(rate, 1)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = _monotonic()
+
+    def take(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Sampler(object):
+    """Decide which events are worth sending
+
+    `rates` maps event types to the probability (0 to 1) of keeping
+    each event, and `limits` maps event types to a maximum number of
+    events per second (a token bucket with a burst of one second's
+    worth of events).  Types missing from `rates` use `default_rate`.
+    Events for which `exempt(type, payload)` (by default,
+    bes.is_error) returns True are always kept.
+
+    Dropped events are counted in bes.COUNTERS ('sampled_out' and
+    'throttled').  Every `report_interval` seconds, per-type counts of
+    events dropped since the last report are passed to
+    `report(counts, interval)`.
+    """
+    def __init__(self, rates=None, limits=None, default_rate=1.0,
+                 exempt=_bes.is_error, report=log_report, report_interval=60):
+        if rates is None:
+            rates = {}
+        if limits is None:
+            limits = {}
+        self.rates = rates
+        self.default_rate = default_rate
+        self.exempt = exempt
+        self.report = report
+        self.report_interval = report_interval
+        self._buckets = dict(
+            (type, _TokenBucket(rate=rate)) for type, rate in limits.items())
+        self._lock = _threading.Lock()
+        self._counts = {}
+        self._last_report = _monotonic()
+
+    def allow(self, type, payload):
+        """Return True if this event should be sent"""
+        if self.exempt is not None and self.exempt(type, payload):
+            return True
+        rate = self.rates.get(type, self.default_rate)
+        if rate < 1 and _random.random() >= rate:
+            self._drop(type=type, reason='sampled')
+            return False
+        bucket = self._buckets.get(type)
+        if bucket is not None:
+            with self._lock:
+                allowed = bucket.take(_monotonic())
+            if not allowed:
+                self._drop(type=type, reason='throttled')
+                return False
+        self._maybe_report()
+        return True
+
+    def _drop(self, type, reason):
+        if reason == 'sampled':
+            _bes.COUNTERS.increment('sampled_out')
+        else:
+            _bes.COUNTERS.increment('throttled')
+        with self._lock:
+            count = self._counts.get(type)
+            if count is None:
+                count = self._counts[type] = {'sampled': 0, 'throttled': 0}
+            count[reason] += 1
+        self._maybe_report()
+
+    def _maybe_report(self):
+        if self._counts and (
+                _monotonic() - self._last_report >= self.report_interval):
+            self.flush_report()
+
+    def flush_report(self):
+        """Report drops since the last report, and reset the counts"""
+        now = _monotonic()
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+            interval = now - self._last_report
+            self._last_report = now
+        if counts and self.report is not None:
+            self.report(counts, interval)
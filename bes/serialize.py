@@ -0,0 +1,119 @@
+"""JSON encoders for bulk sources
+
+Each encoder takes a payload and a `sort_keys` flag, and returns the
+encoded JSON as UTF-8 bytes.  Pick one with DEFAULT['encoder']:
+
+* 'json': the standard library's json module (the default),
+* 'orjson' or 'ujson': faster third-party encoders, if installed,
+* 'auto': the fastest installed encoder, or
+* any callable with the encoder signature.
+
+The third-party encoders produce compact JSON (no spaces after
+separators), so their output isn't byte-for-byte identical to the
+standard library's.
+"""
+
+import datetime as _datetime
+import decimal as _decimal
+import json as _json
+import uuid as _uuid
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+try:
+    import ujson as _ujson
+except ImportError:
+    _ujson = None
+
+
+def json_default(value):
+    """Convert common types that JSON doesn't handle natively
+
+    >>> json_default(_datetime.date(2014, 1, 2))
+    '2014-01-02'
+    >>> json_default(_decimal.Decimal('1.5'))
+    1.5
+    >>> json_default(set([3, 1, 2]))
+    [1, 2, 3]
+
+    Raises TypeError for anything else.
+    """
+    if isinstance(value, (_datetime.date, _datetime.time)):
+        return value.isoformat()
+    if isinstance(value, _decimal.Decimal):
+        return float(value)
+    if isinstance(value, _uuid.UUID):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        try:
+            return sorted(value)
+        except TypeError:
+            return list(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', 'replace')
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def json_encoder(payload, sort_keys=False):
+    return _json.dumps(
+        payload, sort_keys=sort_keys, default=json_default).encode('utf-8')
+
+
+ENCODERS = {
+    'json': json_encoder,
+    }
+
+if _orjson is not None:
+    def orjson_encoder(payload, sort_keys=False):
+        option = _orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= _orjson.OPT_SORT_KEYS
+        return _orjson.dumps(payload, default=json_default, option=option)
+
+    ENCODERS['orjson'] = orjson_encoder
+
+if _ujson is not None:
+    def ujson_encoder(payload, sort_keys=False):
+        return _ujson.dumps(
+            payload, sort_keys=sort_keys, default=json_default,
+            escape_forward_slashes=False, ensure_ascii=False,
+            ).encode('utf-8')
+
+    ENCODERS['ujson'] = ujson_encoder
+
+for _name in ['orjson', 'ujson', 'json']:
+    if _name in ENCODERS:
+        ENCODERS['auto'] = ENCODERS[_name]
+        break
+del _name
+
+
+def get_encoder(encoder):
+    """Resolve an encoder name (or callable) to an encoder callable"""
+    if callable(encoder):
+        return encoder
+    try:
+        return ENCODERS[encoder]
+    except KeyError:
+        raise ValueError('unknown or uninstalled encoder {!r}'.format(encoder))
+
+
+def encode_fields(payload, sort_keys=False, encoder=json_encoder):
+    """Encode a payload, stringifying fields that can't be encoded
+
+    For when encoding the whole payload failed.  Each top-level field
+    that can't be encoded on its own is replaced by its str(), and the
+    rest of the payload is kept.  Returns (source, bad_keys).
+    """
+    fixed = {}
+    bad_keys = []
+    for key, value in payload.items():
+        try:
+            encoder({key: value})
+        except (TypeError, ValueError, OverflowError):
+            bad_keys.append(key)
+            value = str(value)
+        fixed[key] = value
+    return (encoder(fixed, sort_keys), bad_keys)
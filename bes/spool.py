@@ -0,0 +1,304 @@
+"""Spool bulk messages to disk while Elastic Search is unavailable
+
+A Spool is a directory of append-only segment files holding encoded
+bulk messages exactly as emit() produced them, so each segment is a
+valid bulk body.  Use it as a BatchEmitter's spool, and documents that
+can't be delivered are written to disk instead of being dropped.  A
+Replayer thread streams them back once the cluster recovers:
+
+>>> import bes.batch
+>>> import bes.spool
+>>> emitter = bes.batch.start(spool=bes.spool.Spool('/var/spool/bes'))
+"""
+
+from __future__ import absolute_import
+
+import errno as _errno
+import mmap as _mmap
+import os as _os
+import threading as _threading
+import time as _time
+import weakref as _weakref
+
+import bes as _bes
+
+
+_monotonic = getattr(_time, 'monotonic', _time.time)
+
+_SPOOLS = _weakref.WeakSet()
+
+
+def _pid_alive(pid):
+    try:
+        _os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == _errno.EPERM
+    return True
+
+
+def _item_boundaries(buffer, start, end, max_bytes):
+    """Yield (start, end) chunks of at most `max_bytes` bulk items
+
+    Chunks only break between items (see bes.bulk.split_items).  An
+    item larger than `max_bytes` gets a chunk of its own.
+    """
+    chunk_start = position = start
+    while position < end:
+        newline = buffer.find(b'\n', position, end)
+        if newline < 0:  # truncated final item
+            break
+        if not buffer[position:position + 20].lstrip().startswith(
+                b'{"delete"'):
+            newline = buffer.find(b'\n', newline + 1, end)
+            if newline < 0:
+                break
+        item_end = newline + 1
+        if item_end - chunk_start > max_bytes and position > chunk_start:
+            yield (chunk_start, position)
+            chunk_start = position
+        position = item_end
+    if position > chunk_start:
+        yield (chunk_start, position)
+
+
+class Spool(object):
+    """An append-only, size-capped directory of bulk segments
+
+    Appended messages are written to the current segment file, which
+    is flushed and fsynced once `sync_bytes` are pending or
+    `sync_interval` seconds have passed since the last sync, so a
+    burst of writes shares one fsync.  Segments are rotated once they
+    reach `segment_size` bytes.  If the spool grows beyond `max_size`
+    bytes, the oldest segments are deleted (and counted in
+    bes.COUNTERS as 'spool_dropped_bytes').
+
+    Segments are named '<sequence>-<pid>.open' while they're being
+    written and renamed to '<sequence>-<pid>.bulk' when they're
+    closed, so several (e.g. forked) processes can share a spool
+    directory.  Only closed segments are replayed.  Open segments
+    left behind by dead processes are closed when a Spool is created.
+    """
+    suffix = '.bulk'
+    open_suffix = '.open'
+
+    def __init__(self, path, segment_size=16*2**20, max_size=2**30,
+                 sync_bytes=2**20, sync_interval=1.0):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.sync_bytes = sync_bytes
+        self.sync_interval = sync_interval
+        self._lock = _threading.RLock()
+        self._file = None
+        self._file_path = None
+        self._pending = 0
+        self._last_sync = _monotonic()
+        if not _os.path.isdir(path):
+            _os.makedirs(path)
+        self._sequence = 0
+        for segment in self.segments(include_open=True):
+            name = _os.path.basename(segment)
+            sequence, pid = name.split('.')[0].split('-')
+            self._sequence = max(self._sequence, int(sequence))
+            if segment.endswith(self.open_suffix) and not _pid_alive(
+                    int(pid)):
+                _os.rename(segment, self._closed_path(segment))
+        _SPOOLS.add(self)
+
+    def segments(self, include_open=False):
+        """Return the paths of closed segments, oldest first"""
+        suffixes = (self.suffix,)
+        if include_open:
+            suffixes += (self.open_suffix,)
+        return sorted(
+            _os.path.join(self.path, name)
+            for name in _os.listdir(self.path)
+            if name.endswith(suffixes))
+
+    def size(self):
+        """Total bytes spooled (including already-replayed offsets)"""
+        return sum(
+            _os.path.getsize(path)
+            for path in self.segments(include_open=True))
+
+    def append(self, message):
+        """Write a bulk message (bytes) to the spool"""
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(message)
+            self._pending += len(message)
+            _bes.COUNTERS.increment('spool_bytes', len(message))
+            if (self._pending >= self.sync_bytes or
+                    _monotonic() - self._last_sync >= self.sync_interval):
+                self.sync()
+            if self._file.tell() >= self.segment_size:
+                self._close()
+                self._enforce_max_size()
+
+    def dead_letter(self, message, reason):
+        """A BatchEmitter dead_letter callback that spools the message"""
+        self.append(message)
+
+    def sync(self):
+        """Flush and fsync the current segment"""
+        with self._lock:
+            if self._file is not None and self._pending:
+                self._file.flush()
+                _os.fsync(self._file.fileno())
+            self._pending = 0
+            self._last_sync = _monotonic()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _closed_path(self, path):
+        return path[:-len(self.open_suffix)] + self.suffix
+
+    def _open(self):
+        self._sequence += 1
+        self._file_path = _os.path.join(
+            self.path, '{:020d}-{}{}'.format(
+                self._sequence, _os.getpid(), self.open_suffix))
+        # unbuffered, so a fork can't duplicate pending writes
+        self._file = open(self._file_path, 'ab', 0)
+
+    def _close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            _os.rename(self._file_path, self._closed_path(self._file_path))
+            self._file = None
+            self._file_path = None
+
+    def _after_fork_in_child(self):
+        """Leave the parent's open segment to the parent"""
+        self._lock = _threading.RLock()
+        if self._file is not None:
+            self._file.close()  # just the child's descriptor
+            self._file = None
+            self._file_path = None
+        self._pending = 0
+
+    def _enforce_max_size(self):
+        segments = self.segments()
+        sizes = [_os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        for path, size in zip(segments, sizes):
+            if total <= self.max_size or path == self._file_path:
+                break
+            _bes.LOG.warning('spool full, dropping {}'.format(path))
+            _bes.COUNTERS.increment('spool_dropped_bytes', size)
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        for p in [path, path + '.offset']:
+            try:
+                _os.remove(p)
+            except OSError:
+                pass
+
+    def _read_offset(self, path):
+        try:
+            with open(path + '.offset', 'r') as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _write_offset(self, path, offset):
+        with open(path + '.offset', 'w') as f:
+            f.write(str(offset))
+
+    def replay(self, send, max_bytes=2**20):
+        """Stream spooled messages to `send(body)`, oldest first
+
+        Segments are memory-mapped and passed to `send` in chunks of
+        up to `max_bytes` (split between documents).  Replayed
+        segments are deleted.  If `send` raises, replay stops, the
+        position is recorded so the next replay resumes there, and
+        the exception is re-raised.  Returns the number of bytes
+        replayed.
+        """
+        with self._lock:
+            self._close()  # rotate, so the current segment can be replayed
+            segments = self.segments()
+        replayed = 0
+        for path in segments:
+            offset = self._read_offset(path)
+            size = _os.path.getsize(path)
+            if size > offset:
+                with open(path, 'rb') as f:
+                    buffer = _mmap.mmap(
+                        f.fileno(), 0, access=_mmap.ACCESS_READ)
+                    try:
+                        for start, end in _item_boundaries(
+                                buffer, offset, size, max_bytes):
+                            try:
+                                send(buffer[start:end])
+                            except Exception:
+                                self._write_offset(path, start)
+                                raise
+                            replayed += end - start
+                            _bes.COUNTERS.increment(
+                                'spool_replayed_bytes', end - start)
+                    finally:
+                        buffer.close()
+            self._remove(path)
+        return replayed
+
+
+class Replayer(object):
+    """Periodically replay a spool from a background thread
+
+    Every `interval` seconds the replayer checks the spool, and if
+    there is anything in it, replays it through `send`.  A failed
+    send leaves the rest of the spool for the next attempt, so the
+    replay itself acts as the probe for transport recovery.
+    """
+    def __init__(self, spool, send, interval=30, max_bytes=2**20):
+        self.spool = spool
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._stop = _threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = _threading.Thread(
+                name='bes spool replayer', target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join(timeout)
+            self._thread = None
+
+    def replay(self):
+        """Replay the spool now; return True if it was emptied"""
+        try:
+            self.spool.replay(send=self.send, max_bytes=self.max_bytes)
+        except Exception as e:
+            _bes.LOG.warning('spool replay failed ({})'.format(e))
+            return False
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.spool.segments():
+                self.replay()
+
+
+def _after_fork_in_child():
+    for spool in list(_SPOOLS):
+        spool._after_fork_in_child()
+
+
+if hasattr(_os, 'register_at_fork'):  # Python >= 3.7
+    _os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -4,12 +4,89 @@ except ImportError as e:
     _wrapt = None
     import functools as _functools
 
+import atexit as _atexit
+import threading as _threading
+import time as _time
+
 
 import bes as _bes
 
 
+_perf_counter = getattr(_time, 'perf_counter', _time.time)
+
+# aggregators holding unflushed calls; the strong references keep
+# their counts alive even if the traced function is collected
+_PENDING = set()
+
+
+class Aggregator(object):
+    """Accumulate call statistics and log them as periodic summaries
+
+    record() is cheap: it updates an error count and a bes.Histogram
+    of durations (exact count, sum, min, and max, and percentiles
+    accurate to within about 12%).  Once `interval` seconds have
+    passed, the next record() (or an explicit flush()) logs a single
+    summary with action='summary'.  Calls that haven't been
+    summarized yet are flushed by flush_all() at exit.
+    """
+    def __init__(self, logger, interval, log_kwargs):
+        self.logger = logger
+        self.interval = interval
+        self.log_kwargs = log_kwargs
+        self._lock = _threading.Lock()
+        self._reset(_perf_counter())
+
+    def _reset(self, now):
+        self._start = now
+        self._errors = 0
+        self._durations = _bes.Histogram()
+
+    def record(self, duration, error=False):
+        with self._lock:
+            if not self._durations.count:
+                _PENDING.add(self)
+            if error:
+                self._errors += 1
+            self._durations.record(duration)
+        if _perf_counter() - self._start >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Log a summary of the calls recorded since the last flush"""
+        now = _perf_counter()
+        with self._lock:
+            errors = self._errors
+            durations = self._durations
+            interval = now - self._start
+            self._reset(now)
+            _PENDING.discard(self)
+        if not durations.count:
+            return
+        summary = dict(self.log_kwargs)
+        summary.update({
+            'action': 'summary',
+            'interval': interval,
+            'errors': errors,
+            })
+        for name, value in durations.summary().items():
+            if name == 'count':
+                summary[name] = value
+            else:
+                summary['duration_{}'.format(name)] = value
+        self.logger(**summary)
+
+
+def flush_all():
+    """Flush every aggregating tracer (run automatically at exit)"""
+    for aggregator in list(_PENDING):
+        aggregator.flush()
+
+
+_atexit.register(flush_all)
+
+
 def trace(start=True, error=True, complete=True, logger=_bes.log,
-          **log_kwargs):
+          aggregate=False, interval=60, **log_kwargs):
     """A decorator to get automatic bes logging for function execution
 
     Use::
@@ -19,7 +96,17 @@ def trace(start=True, error=True, complete=True, logger=_bes.log,
           ...
 
     To log start and completion of your task with bes.
+
+    For functions that are called too often to log every call, use
+    aggregate=True.  Instead of start/complete/error events, each
+    call's duration is measured and accumulated, and a single summary
+    (count, errors, and duration statistics in seconds) is logged
+    with action='summary' every `interval` seconds.
     """
+    if aggregate:
+        return _aggregate_decorator(
+            logger=logger, interval=interval, log_kwargs=log_kwargs)
+
     # closure to capture start, logger, etc. and run the logging
     def log_wrapper(wrapped, *args, **kwargs):
         if 'type' not in log_kwargs:
@@ -37,6 +124,35 @@ def trace(start=True, error=True, complete=True, logger=_bes.log,
                 logger(action='complete', **log_kwargs)
         return result
 
+    return _decorator(log_wrapper)
+
+
+def _aggregate_decorator(logger, interval, log_kwargs):
+    aggregators = {}
+
+    # closure to capture the aggregators and time each call
+    def log_wrapper(wrapped, *args, **kwargs):
+        # wrapt passes methods bound, but all instances share a summary
+        function = getattr(wrapped, '__func__', wrapped)
+        aggregator = aggregators.get(function)
+        if aggregator is None:
+            summary_kwargs = dict(log_kwargs)
+            summary_kwargs.setdefault('type', wrapped.__name__)
+            aggregator = aggregators.setdefault(function, Aggregator(
+                logger=logger, interval=interval, log_kwargs=summary_kwargs))
+        start = _perf_counter()
+        try:
+            result = wrapped(*args, **kwargs)
+        except Exception:
+            aggregator.record(_perf_counter() - start, error=True)
+            raise
+        aggregator.record(_perf_counter() - start)
+        return result
+
+    return _decorator(log_wrapper)
+
+
+def _decorator(log_wrapper):
     if _wrapt:
         @_wrapt.decorator
         def decorator(wrapped, instance, args, kwargs):
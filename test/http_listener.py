@@ -0,0 +1,107 @@
+try:
+    import http.server as _http_server
+except ImportError:  # Python 2
+    import BaseHTTPServer as _http_server
+import json as _json
+try:
+    import socketserver as _socketserver
+except ImportError:  # Python 2
+    import SocketServer as _socketserver
+import threading as _threading
+import zlib as _zlib
+
+
+class _Handler (_http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = _zlib.decompress(body, 16 + _zlib.MAX_WBITS)
+        listener = self.server.listener
+        listener.record({
+            'path': self.path,
+            'headers': dict(self.headers.items()),
+            'body': body,
+            'length': length,
+            'client_address': self.client_address,
+            })
+        status, response = listener.respond(body)
+        data = _json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server (_socketserver.ThreadingMixIn, _http_server.HTTPServer):
+    daemon_threads = True
+
+
+def bulk_response(body, status=201, errors=None):
+    """Build a bulk response with one item per action line in body"""
+    if errors is None:
+        errors = {}
+    lines = body.splitlines()
+    items = []
+    for i, line in enumerate(lines[::2]):
+        action = list(_json.loads(line.decode('utf-8')).keys())[0]
+        if i in errors:
+            result = {'status': errors[i][0], 'error': errors[i][1]}
+        else:
+            result = {'status': status}
+        items.append({action: result})
+    return {
+        'took': 1,
+        'errors': bool(errors),
+        'items': items,
+        }
+
+
+class HTTPListener (object):
+    """A local stand-in for Elastic Search's /_bulk endpoint
+
+    `respond` is called with each request body and should return
+    (status, response-object).  The default accepts every item.
+    """
+    def __init__(self, host='127.0.0.1', port=0, respond=None):
+        self.host = host
+        self.port = port
+        if respond is None:
+            respond = lambda body: (200, bulk_response(body))
+        self.respond = respond
+        self.requests = []
+        self._server = None
+        self._thread = None
+
+    def record(self, request):
+        self.requests.append(request)
+
+    def __enter__(self):
+        self._server = _Server(
+            (self.host, self.port), _Handler)
+        self._server.listener = self
+        self.port = self._server.server_address[1]
+        self._thread = _threading.Thread(
+            name='HTTP server',
+            target=self._server.serve_forever,
+            kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._server is not None:
+            try:
+                self._server.shutdown()
+                self._server.server_close()
+                self._thread.join()
+            finally:
+                self._server = None
+                self._thread = None
@@ -0,0 +1,139 @@
+import asyncio as _asyncio
+import unittest as _unittest
+
+import bes as _bes
+import bes.aio as _bes_aio
+from . import http_listener as _http_listener
+from . import udp_listener as _udp_listener
+
+
+def _run(coroutine):
+    loop = _asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncEmitterTestCase (_unittest.TestCase):
+    def test_udp(self):
+        async def main(listener):
+            emitter = _bes_aio.AsyncEmitter(
+                host='127.0.0.1', port=listener.port, max_linger=60)
+            messages = []
+            for i in range(3):
+                messages.append(await _bes.aemit(
+                    payload={'i': i}, type='record', datestamp_index=False,
+                    emitter=emitter))
+            await emitter.aclose()
+            return messages
+
+        with _udp_listener.UDPListener(count=1) as listener:
+            messages = _run(main(listener))
+        self.assertEqual(
+            [msg for msg,addr in listener.messages], [b''.join(messages)])
+
+    def test_http(self):
+        async def main(listener):
+            emitter = _bes_aio.AsyncEmitter(
+                host=listener.host, port=listener.port, protocol='HTTP',
+                max_count=2)
+            messages = []
+            for i in range(3):
+                messages.append(await _bes.alog(
+                    type='record', i=i, emitter=emitter))
+            await emitter.flush()
+            await emitter.aclose()
+            return messages
+
+        with _http_listener.HTTPListener() as listener:
+            messages = _run(main(listener))
+        self.assertEqual(
+            [r['body'] for r in listener.requests],
+            [b''.join(messages[:2]), messages[2]])
+        self.assertEqual(
+            len(set(r['client_address'] for r in listener.requests)), 1)
+
+    def test_http_gzip(self):
+        async def main(listener):
+            emitter = _bes_aio.AsyncEmitter(
+                host=listener.host, port=listener.port, protocol='HTTP',
+                gzip_level=1, gzip_min_size=0)
+            message = await _bes.alog(type='record', emitter=emitter)
+            await emitter.aclose()
+            return message
+
+        with _http_listener.HTTPListener() as listener:
+            message = _run(main(listener))
+        request, = listener.requests
+        self.assertEqual(request['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(request['body'], message)
+
+    def test_priority(self):
+        async def main(listener):
+            emitter = _bes_aio.AsyncEmitter(
+                host='127.0.0.1', port=listener.port, max_linger=60,
+                max_priority_queue=2)
+            emitter.put(b'a\n')
+            results = [emitter.put_priority(message)
+                       for message in [b'e1\n', b'e2\n', b'e3\n']]
+            await emitter.aclose()
+            return results
+
+        with _udp_listener.UDPListener(count=2) as listener:
+            results = _run(main(listener))
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(
+            [msg for msg,addr in listener.messages], [b'e1\ne2\n', b'a\n'])
+
+    def test_priority_skips_queue(self):
+        async def main(listener):
+            emitter = _bes_aio.AsyncEmitter(
+                host='127.0.0.1', port=listener.port, max_count=1)
+            for i in range(20):
+                emitter.put('{}\n'.format(i).encode('ascii'))
+            emitter.put_priority(b'error\n')
+            await emitter.aclose()
+
+        with _udp_listener.UDPListener(count=21) as listener:
+            _run(main(listener))
+        messages = [msg for msg,addr in listener.messages]
+        self.assertEqual(len(messages), 21)
+        self.assertEqual(messages[0], b'error\n')
+
+    def test_full_queue(self):
+        async def main(listener, policy):
+            emitter = _bes_aio.AsyncEmitter(
+                host='127.0.0.1', port=listener.port, max_linger=60,
+                max_queue=2, queue_policy=policy)
+            results = [emitter.put(message)
+                       for message in [b'a\n', b'b\n', b'c\n']]
+            await emitter.aclose()
+            return results
+
+        for policy, results, sent in [
+                ('drop_newest', [True, True, False], b'a\nb\n'),
+                ('drop_oldest', [True, True, True], b'b\nc\n')]:
+            _bes.COUNTERS.reset()
+            with _udp_listener.UDPListener(count=1) as listener:
+                self.assertEqual(_run(main(listener, policy)), results)
+            self.assertEqual(
+                [msg for msg,addr in listener.messages], [sent])
+            self.assertEqual(_bes.COUNTERS.get('dropped'), 1)
+        self.assertRaises(
+            ValueError, _bes_aio.AsyncEmitter, queue_policy='block')
+
+    def test_default_emitter(self):
+        async def main(listener):
+            original = dict(_bes.DEFAULT)
+            _bes.DEFAULT.update(host='127.0.0.1', port=listener.port)
+            try:
+                message = await _bes.alog(type='record')
+                await _bes_aio.aclose()
+            finally:
+                _bes.DEFAULT.update(original)
+            return message
+
+        with _udp_listener.UDPListener(count=1) as listener:
+            message = _run(main(listener))
+        self.assertEqual([msg for msg,addr in listener.messages], [message])
@@ -0,0 +1,244 @@
+import socket as _socket
+import threading as _threading
+import time as _time
+import unittest as _unittest
+try:
+    import unittest.mock as _mock
+except ImportError:
+    import mock as _mock
+
+import bes as _bes
+import bes.batch as _bes_batch
+import bes.retry as _bes_retry
+from . import udp_listener as _udp_listener
+
+
+class BatchEmitterTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.pool = _bes.ConnectionPool()
+        self.connection_class = _mock.MagicMock()
+        self.connection = self.connection_class.return_value
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def _emitter(self, **kwargs):
+        return _bes_batch.BatchEmitter(
+            connection_class=self.connection_class, pool=self.pool,
+            **kwargs)
+
+    def _sent(self):
+        return [args[0] for args, kwargs in self.connection.send.call_args_list]
+
+    def test_flush(self):
+        emitter = self._emitter(max_linger=60)
+        emitter.put(b'a\n')
+        emitter.put(b'b\n')
+        self.assertTrue(emitter.flush(timeout=5))
+        self.assertEqual(self._sent(), [b'a\nb\n'])
+        emitter.shutdown(timeout=5)
+
+    def test_max_count(self):
+        emitter = self._emitter(max_count=2, max_linger=60)
+        for message in [b'a\n', b'b\n', b'c\n']:
+            emitter.put(message)
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'a\nb\n', b'c\n'])
+
+    def test_max_bytes(self):
+        emitter = self._emitter(max_bytes=3, max_linger=60)
+        for message in [b'a\n', b'b\n', b'c\n']:
+            emitter.put(message)
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'a\nb\n', b'c\n'])
+
+    def test_max_linger(self):
+        emitter = self._emitter(max_linger=0)
+        emitter.put(b'a\n')
+        emitter.flush(timeout=5)
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'a\n'])
+
+    def test_full_queue(self):
+        emitter = self._emitter(
+            max_linger=60, max_queue=1, queue_policy='drop_newest')
+        with _mock.patch.object(emitter, '_start'):
+            self.assertTrue(emitter.put(b'a\n'))
+            self.assertFalse(emitter.put(b'b\n'))
+        emitter._start()
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'a\n'])
+
+    def test_priority(self):
+        emitter = self._emitter(max_linger=60)
+        emitter.put(b'a\n')
+        emitter.put_priority(b'error\n')
+        for i in range(500):
+            if self.connection.send.called:
+                break
+            _time.sleep(0.01)
+        self.assertEqual(self._sent(), [b'error\n'])
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'error\n', b'a\n'])
+
+    def test_priority_lane_drained_together(self):
+        emitter = self._emitter(max_linger=60, max_priority_queue=2)
+        _bes.COUNTERS.reset()
+        with _mock.patch.object(emitter, '_start'):
+            self.assertTrue(emitter.put_priority(b'e1\n'))
+            self.assertTrue(emitter.put_priority(b'e2\n'))
+            self.assertFalse(emitter.put_priority(b'e3\n'))
+        self.assertEqual(_bes.COUNTERS.get('priority_dropped'), 1)
+        self.assertEqual(_bes.COUNTERS.get('dropped'), 1)
+        emitter._start()
+        emitter.shutdown(timeout=5)
+        self.assertEqual(self._sent(), [b'e1\ne2\n'])
+
+    def test_shutdown_all(self):
+        emitters = [self._emitter(max_linger=60) for i in range(2)]
+        for emitter in emitters:
+            emitter.put(b'a\n')
+        self.assertTrue(_bes_batch.shutdown_all(timeout=5))
+        self.assertEqual(self._sent(), [b'a\n', b'a\n'])
+        for emitter in emitters:
+            self.assertIsNone(emitter._thread)
+
+    def test_shutdown_timeout_dead_letters_retries(self):
+        dead_letters = []
+        policy = _bes_retry.RetryPolicy()
+        self.connection.send.side_effect = _socket.error('unreachable')
+        emitter = self._emitter(
+            max_linger=0, retry_policy=policy,
+            dead_letter=lambda message, reason: dead_letters.append(
+                (message, reason)))
+        with _mock.patch.object(policy, 'delay', return_value=60):
+            emitter.put(b'a\n')
+            emitter.flush(timeout=5)
+            start = _time.time()
+            self.assertFalse(emitter.shutdown(timeout=0.2))
+        self.assertLess(_time.time() - start, 2)
+        self.assertEqual(dead_letters, [(b'a\n', 'shutdown timed out')])
+
+    def test_shutdown_timeout_during_send(self):
+        dead_letters = []
+        release = _threading.Event()
+        self.connection.send.side_effect = lambda body: release.wait(5)
+        emitter = self._emitter(
+            max_linger=0,
+            dead_letter=lambda message, reason: dead_letters.append(message))
+        try:
+            emitter.put(b'a\n')
+            for i in range(500):
+                if self.connection.send.called:
+                    break
+                _time.sleep(0.01)
+            emitter.put(b'b\n')
+            thread = emitter._thread
+            self.assertFalse(emitter.shutdown(timeout=0.2))
+            self.assertEqual(dead_letters, [b'b\n'])
+        finally:
+            release.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_exit_timeout(self):
+        with _mock.patch.object(_bes_batch, 'EXIT_TIMEOUT', 3):
+            with _mock.patch.object(_bes_batch, 'shutdown_all') as shutdown:
+                _bes_batch._shutdown_at_exit()
+        shutdown.assert_called_once_with(timeout=3)
+
+    def test_shutdown_without_start(self):
+        self.assertTrue(self._emitter().shutdown())
+
+
+class BoundedQueueTestCase (_unittest.TestCase):
+    def setUp(self):
+        _bes.COUNTERS.reset()
+
+    def _items(self, queue):
+        items = []
+        while not queue.empty():
+            items.append(queue.get_nowait())
+        return items
+
+    def test_block_timeout(self):
+        queue = _bes_batch.BoundedQueue(maxsize=1, timeout=0.01)
+        self.assertTrue(queue.offer(b'a'))
+        self.assertFalse(queue.offer(b'b'))
+        self.assertEqual(self._items(queue), [b'a'])
+        self.assertEqual(_bes.COUNTERS.get('queue_block_timeouts'), 1)
+        self.assertEqual(_bes.COUNTERS.get('dropped'), 1)
+        self.assertEqual(
+            _bes.COUNTERS.histograms()['queue_block_seconds']['count'], 1)
+
+    def test_drop_newest(self):
+        queue = _bes_batch.BoundedQueue(maxsize=2, policy='drop_newest')
+        for item in [b'a', b'b', b'c']:
+            queue.offer(item)
+        self.assertEqual(self._items(queue), [b'a', b'b'])
+        self.assertEqual(_bes.COUNTERS.get('queue_dropped_newest'), 1)
+
+    def test_drop_oldest(self):
+        queue = _bes_batch.BoundedQueue(maxsize=2, policy='drop_oldest')
+        marker = _bes_batch._Marker()
+        queue.put_control(marker)
+        for item in [b'a', b'b', b'c']:
+            self.assertTrue(queue.offer(item))
+        self.assertEqual(self._items(queue), [marker, b'c'])
+        self.assertEqual(_bes.COUNTERS.get('queue_dropped_oldest'), 2)
+
+    def test_spill(self):
+        spilled = []
+        queue = _bes_batch.BoundedQueue(
+            maxsize=1, policy='spill', spill=spilled.append)
+        for item in [b'a', b'b']:
+            queue.offer(item)
+        self.assertEqual(self._items(queue), [b'a'])
+        self.assertEqual(spilled, [b'b'])
+        self.assertEqual(_bes.COUNTERS.get('queue_spilled'), 1)
+        self.assertEqual(_bes.COUNTERS.get('dropped'), 0)
+
+    def test_spill_needs_function(self):
+        self.assertRaises(
+            ValueError, _bes_batch.BoundedQueue, policy='spill')
+
+    def test_urgent_jumps_ahead(self):
+        queue = _bes_batch.BoundedQueue(maxsize=1, policy='drop_oldest')
+        queue.offer(b'a')
+        urgent = _bes_batch._Urgent()
+        queue.put_control(urgent, front=True)
+        queue.offer(b'b')
+        self.assertEqual(self._items(queue), [urgent, b'b'])
+
+    def test_control_ignores_bound(self):
+        queue = _bes_batch.BoundedQueue(maxsize=1, policy='drop_newest')
+        queue.offer(b'a')
+        marker = _bes_batch._Marker()
+        queue.put_control(marker)
+        self.assertEqual(self._items(queue), [b'a', marker])
+
+
+class StartTestCase (_unittest.TestCase):
+    def tearDown(self):
+        _bes_batch.stop()
+
+    def test_log(self):
+        with _udp_listener.UDPListener(count=1) as listener:
+            _bes_batch.start(
+                host=listener.host, port=listener.port, max_linger=60)
+            for i in range(3):
+                _bes.emit(payload={'i': i}, type='record',
+                          datestamp_index=False, sort_keys=True)
+            _bes_batch.stop(timeout=5)
+        self.assertIsNone(_bes.DEFAULT['emitter'])
+        self.assertEqual(
+            [msg for msg,addr in listener.messages],
+            [b'\n'.join([
+                b'{"index": {"_index": "log", "_type": "record"}}',
+                b'{"i": 0}',
+                b'{"index": {"_index": "log", "_type": "record"}}',
+                b'{"i": 1}',
+                b'{"index": {"_index": "log", "_type": "record"}}',
+                b'{"i": 2}',
+                b'',
+                ])])
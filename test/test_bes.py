@@ -1,13 +1,113 @@
+import datetime as _datetime
+import decimal as _decimal
+import threading as _threading
+import time as _time
 import unittest as _unittest
+import uuid as _uuid
 try:
     import unittest.mock as _mock
 except ImportError:
     import mock as _mock
 
 import bes as _bes
+import bes.serialize as _bes_serialize
 from . import udp_listener as _udp_listener
 
 
+class CountersTestCase (_unittest.TestCase):
+    def test_threads(self):
+        counters = _bes.Counters()
+
+        def count():
+            for i in range(1000):
+                counters.increment('events')
+                counters.increment('bytes', 2)
+
+        threads = [_threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counters.increment('events')
+        self.assertEqual(
+            counters.snapshot(), {'events': 4001, 'bytes': 8000})
+        self.assertEqual(counters.get('events'), 4001)
+        counters.reset()
+        self.assertEqual(counters.snapshot(), {})
+
+    def test_exited_threads_pruned(self):
+        counters = _bes.Counters()
+        for i in range(500):
+            thread = _threading.Thread(
+                target=counters.increment, args=('events',))
+            thread.start()
+            thread.join()
+        self.assertLess(len(counters._threads), 130)
+        self.assertEqual(counters.get('events'), 500)
+        self.assertEqual(counters.snapshot(), {'events': 500})
+
+    def test_histogram(self):
+        counters = _bes.Counters()
+        for i in range(1, 101):
+            counters.observe('send_seconds', i / 1000.0)
+        summary = counters.histograms()['send_seconds']
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['sum'], 5.05)
+        self.assertEqual(summary['min'], 0.001)
+        self.assertEqual(summary['max'], 0.1)
+        for percentile in [50, 90, 99]:
+            self.assertAlmostEqual(
+                summary['p{}'.format(percentile)], percentile / 1000.0,
+                delta=0.13 * percentile / 1000.0)
+
+    def test_gauge(self):
+        counters = _bes.Counters()
+        counters.register_gauge('depth', lambda: 3)
+        self.assertEqual(counters.gauges(), {'depth': 3})
+
+
+class StatsTestCase (_unittest.TestCase):
+    def setUp(self):
+        _bes.COUNTERS.reset()
+
+    def test_stats(self):
+        message = _bes.emit(
+            payload={'hello': 'world'}, type='record', datestamp_index=False,
+            connection_class=_mock.MagicMock(), pool=None)
+        stats = _bes.stats()
+        self.assertEqual(stats['events'], 1)
+        self.assertEqual(stats['event_bytes'], len(message))
+        self.assertEqual(stats['send_seconds']['count'], 1)
+
+    def test_send_errors(self):
+        connection_class = _mock.MagicMock()
+        connection = connection_class.return_value.__enter__.return_value
+        connection.send.side_effect = OSError('unreachable')
+        self.assertRaises(
+            OSError, _bes.emit, payload={}, type='record',
+            connection_class=connection_class, pool=None)
+        self.assertEqual(_bes.stats()['send_errors'], 1)
+
+    def test_reporter(self):
+        documents = []
+
+        def logger(**kwargs):
+            documents.append(kwargs)
+
+        _bes.COUNTERS.increment('events', 5)
+        reporter = _bes.StatsReporter(interval=0.01, logger=logger)
+        reporter.start()
+        try:
+            for i in range(100):
+                if documents:
+                    break
+                _time.sleep(0.01)
+        finally:
+            reporter.stop()
+        self.assertEqual(documents[0]['type'], 'bes_stats')
+        self.assertEqual(documents[0]['events'], 5)
+
+
 class ConnectionTestCase (_unittest.TestCase):
     def test_udp_connection(self):
         with _udp_listener.UDPListener(count=2) as listener:
@@ -21,6 +121,158 @@ class ConnectionTestCase (_unittest.TestCase):
             [b'Hello!', b'Goodbye!'])
 
 
+    def _document(self, i, size=10):
+        return (
+            b'{"index": {"_index": "log", "_type": "record"}}\n' +
+            '{{"i": {}, "x": "{}"}}\n'.format(i, 'x' * size).encode('utf-8'))
+
+    def _send(self, message, count, **kwargs):
+        with _udp_listener.UDPListener(count=count) as listener:
+            with _bes.Connection(
+                    host=listener.host, port=listener.port, protocol='UDP',
+                    **kwargs) as connection:
+                connection.send(message)
+        return [msg for msg,addr in listener.messages]
+
+    def test_udp_packing(self):
+        documents = [self._document(i) for i in range(5)]
+        messages = self._send(
+            message=b''.join(documents), count=3,
+            max_datagram=2 * len(documents[0]))
+        self.assertEqual(
+            messages,
+            [b''.join(documents[0:2]), b''.join(documents[2:4]),
+             documents[4]])
+
+    def test_udp_oversize_send(self):
+        big = self._document(1, size=100)
+        messages = self._send(
+            message=self._document(0) + big, count=2, max_datagram=100)
+        self.assertEqual(messages, [big, self._document(0)])
+
+    def test_udp_oversize_truncate(self):
+        _bes.COUNTERS.reset()
+        messages = self._send(
+            message=self._document(0, size=100), count=1, max_datagram=100,
+            oversize='truncate')
+        self.assertEqual(len(messages[0]), 100)
+        self.assertTrue(messages[0].endswith(b'xxx..."}\n'))
+        self.assertEqual(_bes.COUNTERS.get('udp_truncated'), 1)
+
+    def test_udp_oversize_reject(self):
+        _bes.COUNTERS.reset()
+        messages = self._send(
+            message=self._document(0, size=100) + self._document(1),
+            count=1, max_datagram=100, oversize='reject')
+        self.assertEqual(messages, [self._document(1)])
+        self.assertEqual(_bes.COUNTERS.get('udp_rejected'), 1)
+
+
+class ConnectionPoolTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.pool = _bes.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_reuse(self):
+        connection_class = _mock.MagicMock()
+        a = self.pool.get(connection_class=connection_class, host='a')
+        b = self.pool.get(connection_class=connection_class, host='a')
+        self.assertIs(a, b)
+        self.assertEqual(connection_class.call_count, 1)
+        a.__enter__.assert_called_once_with()
+
+    def test_key(self):
+        connection_class = _mock.MagicMock(
+            side_effect=lambda **kwargs: _mock.MagicMock())
+        a = self.pool.get(connection_class=connection_class, host='a')
+        b = self.pool.get(connection_class=connection_class, host='b')
+        self.assertIsNot(a, b)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_close_all(self):
+        connection_class = _mock.MagicMock()
+        connection = self.pool.get(connection_class=connection_class)
+        self.pool.close_all()
+        connection.__exit__.assert_called_once_with(None, None, None)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_emit_reuses_udp_socket(self):
+        with _udp_listener.UDPListener(count=2) as listener:
+            for i in range(2):
+                _bes.emit(
+                    payload={'i': i}, type='record', datestamp_index=False,
+                    host=listener.host, port=listener.port, pool=self.pool)
+            self.assertEqual(len(self.pool), 1)
+        self.assertEqual(len(listener.messages), 2)
+
+
+class TimestamperTestCase (_unittest.TestCase):
+    def test_iso(self):
+        timestamper = _bes.Timestamper()
+        self.assertEqual(
+            timestamper.render(1380213249.179048),
+            '2013-09-26T16:34:09.179048Z')
+        self.assertEqual(
+            timestamper.render(1380213249.5), '2013-09-26T16:34:09.500000Z')
+        self.assertEqual(
+            timestamper.render(1380213250.25), '2013-09-26T16:34:10.250000Z')
+
+    def test_epoch_millis(self):
+        timestamper = _bes.Timestamper(format='epoch_millis')
+        self.assertEqual(timestamper.render(1380213249.179048), 1380213249179)
+
+    def test_log_shares_clock(self):
+        emitter = _bes.Emitter(
+            type='record', datestamp_index=True,
+            datestamp_format='%Y.%m.%d.%H.%M.%S',
+            emitter=_mock.MagicMock(), sort_keys=True)
+        with _mock.patch.object(
+                _bes._time, 'time', return_value=59.9999):
+            message = emitter.log()
+        self.assertEqual(
+            message,
+            b'{"index": {"_index": "log-1970.01.01.00.00.59", '
+            b'"_type": "record"}}\n'
+            b'{"@timestamp": "1970-01-01T00:00:59.999900Z", "@version": 1}\n')
+
+
+class HeaderCacheTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.cache = _bes.HeaderCache(max_size=2)
+
+    def _get(self, index='log', type='record', datestamp_index=True,
+             datestamp_format='%Y.%m.%d', now=None):
+        return self.cache.get(
+            index=index, type=type, datestamp_index=datestamp_index,
+            datestamp_format=datestamp_format, now=now)
+
+    def test_header(self):
+        self.assertEqual(
+            self._get(datestamp_index=False),
+            b'{"index": {"_index": "log", "_type": "record"}}\n')
+
+    def test_cached(self):
+        self.assertIs(self._get(), self._get())
+
+    def test_datestamp_rollover(self):
+        header = self._get(datestamp_format='%Y.%m.%d.%H', now=0)
+        self.assertIn(b'"_index": "log-1970.01.01.00"', header)
+        self.assertIs(
+            self._get(datestamp_format='%Y.%m.%d.%H', now=3599.9), header)
+        rebuilt = self._get(datestamp_format='%Y.%m.%d.%H', now=3600)
+        self.assertIn(b'"_index": "log-1970.01.01.01"', rebuilt)
+        # a late reading from before the rollover keeps its own hour
+        self.assertEqual(
+            self._get(datestamp_format='%Y.%m.%d.%H', now=3599.9), header)
+
+    def test_bounded(self):
+        for index in ['a', 'b', 'c']:
+            self._get(index=index)
+        self.assertEqual(len(self.cache._headers), 2)
+
+
 class EmitTestCase (_unittest.TestCase):
     def _call_emit(self, *args, **kwargs):
         return _bes.emit(
@@ -41,3 +293,195 @@ class EmitTestCase (_unittest.TestCase):
                 b'{"goodbye": "everybody", "hello": "world"}',
                 b'',
             ]))
+
+    def test_emit_converts_types(self):
+        message = self._call_emit(
+            type='record',
+            payload={
+                'date': _datetime.date(2014, 1, 2),
+                'decimal': _decimal.Decimal('1.5'),
+                'set': set([2, 1]),
+                'uuid': _uuid.UUID(int=1),
+                })
+        self.assertEqual(
+            message.splitlines()[1],
+            b'{"date": "2014-01-02", "decimal": 1.5, "set": [1, 2], '
+            b'"uuid": "00000000-0000-0000-0000-000000000001"}')
+
+    def test_emit_stringifies_bad_fields(self):
+        class Unserializable (object):
+            def __str__(self):
+                return 'unserializable'
+
+        message = self._call_emit(
+            type='record',
+            payload={'hello': 'world', 'bad': Unserializable()})
+        self.assertEqual(
+            message.splitlines()[1],
+            b'{"bad": "unserializable", "hello": "world"}')
+
+    def test_emit_unserializable(self):
+        message = self._call_emit(type='record', payload={(1, 2): 3})
+        self.assertEqual(
+            message.splitlines()[1], b'{"error": "unable to serialize"}')
+
+    @_unittest.skipIf(
+        'orjson' not in _bes_serialize.ENCODERS, 'orjson not installed')
+    def test_emit_orjson(self):
+        message = self._call_emit(
+            type='record', encoder='orjson',
+            payload={'hello': 'world', 'goodbye': 'everybody'})
+        self.assertEqual(
+            message.splitlines()[1],
+            b'{"goodbye":"everybody","hello":"world"}')
+
+
+class PriorityTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.emitter = _mock.MagicMock()
+        self.sampler = _mock.MagicMock()
+        self.sampler.allow.return_value = False
+
+    def tearDown(self):
+        _bes.DEFAULT['priority'] = _bes.is_error
+
+    def _emit(self, **payload):
+        return _bes.emit(
+            payload=payload, type='record', emitter=self.emitter,
+            sampler=self.sampler)
+
+    def test_error(self):
+        message = self._emit(action='error', error='oops')
+        self.emitter.put_priority.assert_called_once_with(message)
+        self.assertFalse(self.emitter.put.called)
+        self.assertFalse(self.sampler.allow.called)
+
+    def test_routine(self):
+        self.sampler.allow.return_value = True
+        message = self._emit(action='complete')
+        self.emitter.put.assert_called_once_with(message)
+        self.assertFalse(self.emitter.put_priority.called)
+
+    def test_routine_sampled(self):
+        self.assertIsNone(self._emit(action='complete'))
+        self.assertFalse(self.emitter.put.called)
+
+    def test_predicate(self):
+        _bes.DEFAULT['priority'] = (
+            lambda type, payload: payload.get('status', 0) >= 500)
+        self.assertTrue(_bes.is_priority(type=None, payload={'status': 503}))
+        self.assertFalse(_bes.is_priority(
+            type=None, payload={'action': 'error'}))
+        _bes.DEFAULT['priority'] = None
+        self.assertFalse(_bes.is_priority(
+            type=None, payload={'action': 'error'}))
+
+    def test_emitter_without_lane(self):
+        emitter = _mock.MagicMock(spec=['put'])
+        message = _bes.emit(
+            payload={'action': 'error'}, type='record', emitter=emitter)
+        emitter.put.assert_called_once_with(message)
+
+
+class EmitterTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.pool = _bes.ConnectionPool()
+        self.connection_class = _mock.MagicMock()
+        self.connection = self.connection_class.return_value
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def _emitter(self, **kwargs):
+        return _bes.Emitter(
+            connection_class=self.connection_class, pool=self.pool,
+            datestamp_index=False, sort_keys=True, **kwargs)
+
+    def test_frozen(self):
+        emitter = self._emitter(type='record')
+        with _mock.patch.dict(_bes.DEFAULT, {'index': 'other', 'type': 'x'}):
+            message = emitter.emit(payload={'hello': 'world'})
+        self.assertEqual(
+            message,
+            b'{"index": {"_index": "log", "_type": "record"}}\n'
+            b'{"hello": "world"}\n')
+        self.connection.send.assert_called_once_with(message)
+
+    def test_slots(self):
+        self.assertRaises(
+            AttributeError, setattr, self._emitter(), 'index_', 'x')
+
+    def test_connection_cached(self):
+        emitter = self._emitter(type='record')
+        for i in range(3):
+            emitter.emit(payload={'i': i})
+        self.assertEqual(self.connection_class.call_count, 1)
+        self.assertEqual(self.connection.send.call_count, 3)
+        self.pool.close_all()
+        emitter.emit(payload={'i': 3})
+        self.assertEqual(self.connection_class.call_count, 2)
+
+    def test_log(self):
+        message = self._emitter(type='record').log(hello='world')
+        self.assertIn(b'"@version": 1', message)
+        self.assertIn(b'"hello": "world"', message)
+
+    def test_sampler_off(self):
+        sampler = _mock.MagicMock()
+        sampler.allow.return_value = False
+        with _mock.patch.dict(_bes.DEFAULT, {'sampler': sampler}):
+            emitter = self._emitter(type='record', sampler=False)
+        self.assertIsNotNone(emitter.emit(payload={'i': 0}))
+        self.assertFalse(sampler.allow.called)
+
+    def test_default_emitter(self):
+        emitter = _bes.default_emitter()
+        self.assertIs(_bes.default_emitter(), emitter)
+        with _mock.patch.dict(_bes.DEFAULT, {'index': 'other'}):
+            self.assertEqual(_bes.default_emitter().index, 'other')
+        self.assertEqual(_bes.default_emitter().index, 'log')
+
+
+class EmitManyTestCase (_unittest.TestCase):
+    def test_udp_chunks(self):
+        payloads = [{'i': i} for i in range(10)]
+        messages = [
+            _bes.encode(payload=payload, type='record', datestamp_index=False)
+            for payload in payloads]
+        pool = _bes.ConnectionPool()
+        with _udp_listener.UDPListener(count=4) as listener:
+            try:
+                results = _bes.emit_many(
+                    (payload for payload in payloads), type='record',
+                    datestamp_index=False, host=listener.host,
+                    port=listener.port, max_datagram=3 * len(messages[0]),
+                    pool=pool)
+            finally:
+                pool.close_all()
+        self.assertEqual(
+            [result['documents'] for result in results], [3, 3, 3, 1])
+        self.assertEqual(
+            [result['error'] for result in results], [None] * 4)
+        self.assertEqual(
+            [msg for msg,addr in listener.messages],
+            [b''.join(messages[i:i + 3]) for i in range(0, 10, 3)])
+
+    def test_max_count(self):
+        connection_class = _mock.MagicMock()
+        results = _bes.emit_many(
+            ({'i': i} for i in range(5)), type='record', max_count=2,
+            connection_class=connection_class, pool=_bes.ConnectionPool())
+        self.assertEqual(
+            [result['documents'] for result in results], [2, 2, 1])
+        connection = connection_class.return_value
+        self.assertEqual(len(connection.send_parts.call_args_list), 3)
+
+    def test_send_error(self):
+        connection_class = _mock.MagicMock()
+        connection = connection_class.return_value
+        connection.send_parts.side_effect = [OSError('unreachable'), None]
+        results = _bes.emit_many(
+            ({'i': i} for i in range(2)), type='record', max_count=1,
+            connection_class=connection_class, pool=_bes.ConnectionPool())
+        self.assertIsInstance(results[0]['error'], OSError)
+        self.assertIsNone(results[1]['error'])
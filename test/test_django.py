@@ -1,3 +1,4 @@
+import json as _json
 import re as _re
 import unittest as _unittest
 try:
@@ -21,10 +22,18 @@ else:
                     'ENGINE': 'django.db.backends.dummy',
                     },
                 },
+            INSTALLED_APPS=[
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+                ],
             )
     try:
+        import django as _django
+        if hasattr(_django, 'setup'):  # Django >= 1.7
+            _django.setup()
         import django.http as _http
         import django.contrib.auth.models as _auth
+        import django.test as _django_test
 
         import bes.django as _bes_django
     except ImportError as e:
@@ -35,12 +44,12 @@ import bes as _bes
 
 
 DATE_TIME_REGEXP = _re.compile(
-    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[.]\d{6}')
+    r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}[.]\d{6}Z')
 
 
 def clean_message(message):
-    if not hasattr(str, 'encode'):
-        message = str(message, 'utf-8')
+    if not isinstance(message, str):  # Python 3
+        message = message.decode('utf-8')
 
     search = DATE_TIME_REGEXP.search(message)
     if not search:
@@ -48,7 +57,7 @@ def clean_message(message):
 
     message = DATE_TIME_REGEXP.sub(
         'YYYY-MM-DDTHH:MM:SS.XXXXXX', message, count=1)
-    return (message, search.group(0))
+    return (message.encode('utf-8'), search.group(0))
 
 
 def skip_if_settings_is_none(obj):
@@ -151,3 +160,67 @@ class LogTestCase (_unittest.TestCase):
                 b'{"@timestamp": "YYYY-MM-DDTHH:MM:SS.XXXXXX", "@version": 1, "request_body": "Hey Jude", "request_path": "/music/bands/the_beatles/?print=true", "user_id": 123, "username": "jdoe"}',
                 b'',
             ]))
+
+
+@skip_if_settings_is_none
+class RequestLoggingMiddlewareTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.emitter = _mock.MagicMock()
+        self.original = _bes.DEFAULT['emitter']
+        _bes.DEFAULT['emitter'] = self.emitter
+        self.factory = _django_test.RequestFactory()
+
+    def tearDown(self):
+        _bes.DEFAULT['emitter'] = self.original
+
+    def _call(self, request, view, middleware_class=None):
+        if middleware_class is None:
+            middleware_class = _bes_django.RequestLoggingMiddleware
+        request.user = _auth.User(id=123, username='jdoe')
+        response = middleware_class(get_response=view)(request)
+        self.assertFalse(self.emitter.put.called)
+        response.close()
+        (message,), kwargs = self.emitter.put.call_args
+        header, source, empty = message.split(b'\n')
+        return _json.loads(source.decode('utf-8'))
+
+    def test_request(self):
+        request = self.factory.get('/music/?print=true')
+        request.resolver_match = _mock.Mock(view_name='music')
+        payload = self._call(
+            request=request,
+            view=lambda request: _http.HttpResponse(status=201))
+        self.assertEqual(payload['method'], 'GET')
+        self.assertEqual(payload['request_path'], '/music/?print=true')
+        self.assertEqual(payload['user_id'], 123)
+        self.assertEqual(payload['username'], 'jdoe')
+        self.assertEqual(payload['status'], 201)
+        self.assertEqual(payload['view'], 'music')
+        self.assertEqual(payload['db_queries'], 0)
+        self.assertTrue(payload['duration'] >= 0)
+        self.assertNotIn('request_body', payload)
+
+    def test_reuses_pipeline(self):
+        middleware = _bes_django.RequestLoggingMiddleware(get_response=None)
+        pipeline = middleware._pipeline()
+        self.assertIs(middleware._pipeline(), pipeline)
+        self.assertIs(pipeline.emitter, self.emitter)
+        _bes.DEFAULT['emitter'] = other = _mock.MagicMock()
+        self.assertIs(middleware._pipeline().emitter, other)
+
+    def test_body(self):
+        class Middleware (_bes_django.RequestLoggingMiddleware):
+            max_body_size = 10
+
+        def view(request):
+            self.assertEqual(request.body, b'Hey Jude, don\'t be afraid')
+            return _http.HttpResponse()
+
+        request = self.factory.post(
+            '/upload/', data=b'Hey Jude, don\'t be afraid',
+            content_type='text/plain')
+        payload = self._call(
+            request=request, view=view, middleware_class=Middleware)
+        self.assertEqual(payload['request_body'], 'Hey Jude, ')
+        self.assertEqual(payload['request_body_size'], 25)
+        self.assertTrue(payload['request_body_truncated'])
@@ -0,0 +1,140 @@
+import socket as _socket
+import unittest as _unittest
+try:
+    import unittest.mock as _mock
+except ImportError:
+    import mock as _mock
+
+import bes as _bes
+import bes.dns as _bes_dns
+
+
+def _addrinfo(address):
+    return [(_socket.AF_INET, _socket.SOCK_DGRAM, 17, '', (address, 9700))]
+
+
+class ResolverTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.resolver = _bes_dns.Resolver(ttl=60, negative_ttl=5)
+        self.clock = 100
+        patcher = _mock.patch.object(
+            _bes_dns, '_monotonic', side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _refresh_inline(self):
+        # run background refreshes on the calling thread
+        return _mock.patch.object(
+            self.resolver, '_refresh', side_effect=self.resolver._lookup)
+
+    def test_cache(self):
+        with _mock.patch.object(
+                _socket, 'getaddrinfo',
+                return_value=_addrinfo('10.0.0.1')) as getaddrinfo:
+            for i in range(3):
+                self.assertEqual(
+                    self.resolver.resolve('es', 9700),
+                    (_socket.AF_INET, ('10.0.0.1', 9700)))
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+    def test_prefers_ipv4(self):
+        addrinfo = [
+            (_socket.AF_INET6, _socket.SOCK_DGRAM, 17, '',
+             ('::1', 9700, 0, 0)),
+            ] + _addrinfo('127.0.0.1')
+        with _mock.patch.object(
+                _socket, 'getaddrinfo', return_value=addrinfo):
+            self.assertEqual(
+                self.resolver.resolve('localhost', 9700),
+                (_socket.AF_INET, ('127.0.0.1', 9700)))
+
+    def test_ipv6_only(self):
+        addrinfo = [
+            (_socket.AF_INET6, _socket.SOCK_DGRAM, 17, '',
+             ('fd00::3', 9700, 0, 0))]
+        with _mock.patch.object(
+                _socket, 'getaddrinfo', return_value=addrinfo):
+            self.assertEqual(
+                self.resolver.resolve('es', 9700),
+                (_socket.AF_INET6, ('fd00::3', 9700, 0, 0)))
+
+    def test_refresh(self):
+        with _mock.patch.object(
+                _socket, 'getaddrinfo', return_value=_addrinfo('10.0.0.1')):
+            self.resolver.resolve('es', 9700)
+        self.clock += 61
+        with _mock.patch.object(
+                _socket, 'getaddrinfo', return_value=_addrinfo('10.0.0.2')):
+            with _mock.patch.object(self.resolver, '_refresh') as refresh:
+                # the stale address is used while refreshing
+                self.assertEqual(
+                    self.resolver.resolve('es', 9700)[1], ('10.0.0.1', 9700))
+            self.assertEqual(refresh.call_count, 1)
+            with self._refresh_inline():
+                self.resolver.resolve('es', 9700)
+            self.assertEqual(
+                self.resolver.resolve('es', 9700)[1], ('10.0.0.2', 9700))
+
+    def test_refresh_failure_keeps_addresses(self):
+        with _mock.patch.object(
+                _socket, 'getaddrinfo', return_value=_addrinfo('10.0.0.1')):
+            self.resolver.resolve('es', 9700)
+        self.clock += 61
+        with _mock.patch.object(
+                _socket, 'getaddrinfo',
+                side_effect=_socket.gaierror(-2, 'Name or service not known')):
+            with self._refresh_inline():
+                self.assertEqual(
+                    self.resolver.resolve('es', 9700)[1], ('10.0.0.1', 9700))
+        self.assertEqual(
+            self.resolver.resolve('es', 9700)[1], ('10.0.0.1', 9700))
+
+    def test_negative_cache(self):
+        with _mock.patch.object(
+                _socket, 'getaddrinfo',
+                side_effect=_socket.gaierror(-2, 'Name or service not known')
+                ) as getaddrinfo:
+            for i in range(3):
+                self.assertRaises(
+                    _socket.gaierror, self.resolver.resolve, 'es', 9700)
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+
+class ConnectionTestCase (_unittest.TestCase):
+    def tearDown(self):
+        _bes_dns.RESOLVER.clear()
+
+    def test_ipv6(self):
+        if not _socket.has_ipv6:
+            self.skipTest('no IPv6 support')
+        server = _socket.socket(_socket.AF_INET6, _socket.SOCK_DGRAM)
+        try:
+            try:
+                server.bind(('::1', 0))
+            except _socket.error:
+                self.skipTest('no IPv6 loopback')
+            server.settimeout(1)
+            port = server.getsockname()[1]
+            with _bes.Connection(host='::1', port=port) as connection:
+                connection.send(b'hello')
+            self.assertEqual(server.recv(100), b'hello')
+        finally:
+            server.close()
+
+    def test_resolves_once(self):
+        server = _socket.socket(_socket.AF_INET, _socket.SOCK_DGRAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(1)
+            port = server.getsockname()[1]
+            with _mock.patch.object(
+                    _socket, 'getaddrinfo',
+                    wraps=_socket.getaddrinfo) as getaddrinfo:
+                with _bes.Connection(host='localhost', port=port) as c:
+                    for i in range(3):
+                        c.send(b'hello')
+            self.assertEqual(getaddrinfo.call_count, 1)
+            for i in range(3):
+                self.assertEqual(server.recv(100), b'hello')
+        finally:
+            server.close()
@@ -0,0 +1,143 @@
+import socket as _socket
+import unittest as _unittest
+try:
+    import unittest.mock as _mock
+except ImportError:
+    import mock as _mock
+
+import bes as _bes
+import bes.endpoints as _bes_endpoints
+from . import http_listener as _http_listener
+from . import udp_listener as _udp_listener
+
+
+def _closed_port():
+    sock = _socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ParseTestCase (_unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(_bes_endpoints.parse('es1:9200'), ('es1', 9200))
+        self.assertEqual(
+            _bes_endpoints.parse('[fd00::3]:9200'), ('fd00::3', 9200))
+        self.assertEqual(_bes_endpoints.parse('[fd00::3]', 1), ('fd00::3', 1))
+        self.assertEqual(_bes_endpoints.parse('es1', port=1), ('es1', 1))
+        self.assertEqual(_bes_endpoints.parse(('es1', '2')), ('es1', 2))
+
+
+class EndpointsTestCase (_unittest.TestCase):
+    def test_round_robin(self):
+        endpoints = _bes_endpoints.Endpoints(['a:1', 'b:1', 'c:1'])
+        names = []
+        for i in range(6):
+            endpoint = endpoints.select()
+            names.append(endpoint.host)
+            endpoints.success(endpoint)
+        self.assertEqual(names, ['a', 'b', 'c', 'a', 'b', 'c'])
+
+    def test_least_outstanding(self):
+        endpoints = _bes_endpoints.Endpoints(
+            ['a:1', 'b:1'], balance='least_outstanding')
+        first = endpoints.select()
+        second = endpoints.select()
+        self.assertNotEqual(first, second)
+        endpoints.success(second)
+        self.assertEqual(endpoints.select(), second)
+
+    def test_eject_and_probe(self):
+        endpoints = _bes_endpoints.Endpoints(
+            ['a:1', 'b:1'], max_failures=2, cooldown=10)
+        a, b = endpoints.endpoints
+        with _mock.patch.object(
+                _bes_endpoints, '_monotonic', return_value=100):
+            for i in range(2):
+                endpoints.select(exclude=[b])
+                endpoints.failure(a)
+            self.assertEqual(endpoints.stats()['a:1']['healthy'], False)
+            self.assertEqual(
+                [endpoints.select() for i in range(3)], [b, b, b])
+        with _mock.patch.object(
+                _bes_endpoints, '_monotonic', return_value=111):
+            probe = endpoints.select(exclude=[b])
+            self.assertEqual(probe, a)
+            # only one probe at a time
+            self.assertEqual(endpoints.select(), b)
+            endpoints.success(a)
+        self.assertEqual(endpoints.stats()['a:1']['healthy'], True)
+        self.assertEqual(endpoints.stats()['a:1']['ejections'], 1)
+
+    def test_all_ejected(self):
+        endpoints = _bes_endpoints.Endpoints(['a:1'], max_failures=1)
+        endpoint = endpoints.select()
+        endpoints.failure(endpoint)
+        self.assertEqual(endpoints.select(), endpoint)
+
+    def test_shared(self):
+        endpoints = _bes_endpoints.get(['shared:1', 'other:1'], port=9200)
+        self.assertIs(
+            _bes_endpoints.get(
+                [('shared', 1), ('other', 1)], port=9700), endpoints)
+        self.assertIsNot(
+            _bes_endpoints.get(
+                ['shared:1', 'other:1'], balance='least_outstanding'),
+            endpoints)
+
+    def test_stats_merged(self):
+        first = _bes_endpoints.Endpoints(['merged:1'])
+        second = _bes_endpoints.Endpoints(['merged:1'], max_failures=1)
+        first.success(first.select(), duration=0.5)
+        second.failure(second.select())
+        second.success(second.select(), duration=2)
+        stats = _bes_endpoints.stats()['merged:1']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['ejections'], 1)
+        self.assertEqual(stats['send_seconds']['count'], 2)
+        self.assertEqual(stats['send_seconds']['max'], 2)
+        second.failure(second.select())
+        self.assertFalse(_bes_endpoints.stats()['merged:1']['healthy'])
+
+
+class ConnectionTestCase (_unittest.TestCase):
+    def test_udp_round_robin(self):
+        with _udp_listener.UDPListener(
+                host='127.0.0.1', port=_closed_port(), count=2) as first:
+            with _udp_listener.UDPListener(
+                    host='127.0.0.1', port=_closed_port(), count=2) as second:
+                hosts = [
+                    (listener.host, listener.port)
+                    for listener in [first, second]]
+                with _bes.Connection(
+                        protocol='UDP', hosts=hosts) as connection:
+                    for i in range(4):
+                        connection.send('{}'.format(i).encode('ascii'))
+        self.assertEqual(
+            [msg for msg,addr in first.messages], [b'0', b'2'])
+        self.assertEqual(
+            [msg for msg,addr in second.messages], [b'1', b'3'])
+
+    def test_http_failover(self):
+        dead = '127.0.0.1:{}'.format(_closed_port())
+        message = _bes.encode(
+            payload={'hello': 'world'}, type='record', datestamp_index=False)
+        with _http_listener.HTTPListener() as listener:
+            live = '{}:{}'.format(listener.host, listener.port)
+            with _bes.Connection(
+                    protocol='HTTP', hosts=[dead, live]) as connection:
+                for i in range(4):
+                    connection.send(message)
+                stats = connection.endpoints.stats()
+        self.assertEqual(len(listener.requests), 4)
+        self.assertEqual(stats[live]['requests'], 4)
+        self.assertEqual(stats[dead]['healthy'], False)
+
+    def test_health_outlives_connection(self):
+        hosts = ['127.0.0.1:{}'.format(_closed_port()), '127.0.0.1:1']
+        with _bes.Connection(protocol='UDP', hosts=hosts) as connection:
+            endpoints = connection.endpoints
+        with _bes.Connection(protocol='UDP', hosts=hosts) as connection:
+            self.assertIs(connection.endpoints, endpoints)
@@ -0,0 +1,148 @@
+import socket as _socket
+import time as _time
+import unittest as _unittest
+
+import bes as _bes
+import bes.http as _bes_http
+from . import http_listener as _http_listener
+
+
+MESSAGE = b'\n'.join([
+    b'{"index": {"_index": "log", "_type": "record"}}',
+    b'{"hello": "world"}',
+    b'',
+    ])
+
+
+class BulkClientTestCase (_unittest.TestCase):
+    def setUp(self):
+        _bes.COUNTERS.reset()
+
+    def test_keep_alive(self):
+        with _http_listener.HTTPListener() as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port)
+            try:
+                for i in range(3):
+                    response = client.send(MESSAGE)
+                    self.assertFalse(response['errors'])
+            finally:
+                client.close()
+        self.assertEqual(len(listener.requests), 3)
+        self.assertEqual(
+            set(r['client_address'] for r in listener.requests),
+            set([listener.requests[0]['client_address']]))
+        self.assertEqual(listener.requests[0]['path'], '/_bulk')
+        self.assertEqual(listener.requests[0]['body'], MESSAGE)
+        self.assertEqual(
+            listener.requests[0]['headers']['Content-Type'],
+            'application/x-ndjson')
+
+    def test_timeout_not_resent(self):
+        def respond(body):
+            if len(listener.requests) > 1:
+                _time.sleep(0.5)
+            return (200, _http_listener.bulk_response(body))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port, timeout=0.2)
+            try:
+                client.send(MESSAGE)
+                self.assertRaises(_socket.timeout, client.send, MESSAGE)
+            finally:
+                client.close()
+        self.assertEqual(len(listener.requests), 2)
+
+    def test_stale_connection_resent(self):
+        with _http_listener.HTTPListener() as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port)
+            try:
+                client.send(MESSAGE)
+                client._idle[0].sock.shutdown(_socket.SHUT_RDWR)
+                self.assertFalse(client.send(MESSAGE)['errors'])
+            finally:
+                client.close()
+        self.assertEqual(len(listener.requests), 2)
+
+    def test_gzip(self):
+        with _http_listener.HTTPListener() as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port, gzip_level=6,
+                gzip_min_size=len(MESSAGE) * 2)
+            try:
+                client.send(MESSAGE)
+                client.send(MESSAGE * 100)
+            finally:
+                client.close()
+        small, large = listener.requests
+        self.assertNotIn('Content-Encoding', small['headers'])
+        self.assertEqual(small['length'], len(MESSAGE))
+        self.assertEqual(large['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(large['body'], MESSAGE * 100)
+        self.assertLess(large['length'], len(MESSAGE) * 10)
+        self.assertEqual(
+            _bes.COUNTERS.get('http_bytes'),
+            small['length'] + large['length'])
+
+    def test_item_errors(self):
+        def respond(body):
+            return (200, _http_listener.bulk_response(
+                body, errors={0: (400, 'mapper_parsing_exception')}))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port)
+            try:
+                response = client.send(MESSAGE + MESSAGE)
+            finally:
+                client.close()
+        self.assertTrue(response['errors'])
+        self.assertEqual(_bes.COUNTERS.get('http_items'), 2)
+        self.assertEqual(_bes.COUNTERS.get('http_item_errors'), 1)
+
+    def test_request_error(self):
+        respond = lambda body: (503, {'error': 'unavailable'})
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            client = _bes_http.BulkClient(
+                host=listener.host, port=listener.port)
+            try:
+                self.assertRaises(_bes_http.BulkError, client.send, MESSAGE)
+            finally:
+                client.close()
+        self.assertEqual(_bes.COUNTERS.get('http_request_errors'), 1)
+
+
+class HTTPConnectionTestCase (_unittest.TestCase):
+    def test_emit(self):
+        pool = _bes.ConnectionPool()
+        with _http_listener.HTTPListener() as listener:
+            try:
+                message = _bes.emit(
+                    payload={'hello': 'world'}, type='record',
+                    datestamp_index=False, host=listener.host,
+                    port=listener.port, protocol='HTTP', pool=pool)
+            finally:
+                pool.close_all()
+        self.assertEqual([r['body'] for r in listener.requests], [message])
+
+    def test_emit_many(self):
+        def respond(body):
+            return (200, _http_listener.bulk_response(
+                body, errors={1: (400, 'mapper_parsing_exception')}))
+
+        pool = _bes.ConnectionPool()
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            try:
+                results = _bes.emit_many(
+                    ({'i': i} for i in range(5)), type='record',
+                    datestamp_index=False, max_count=3, host=listener.host,
+                    port=listener.port, protocol='HTTP', pool=pool)
+            finally:
+                pool.close_all()
+        self.assertEqual(
+            [(result['documents'], result['errors']) for result in results],
+            [(3, 1), (2, 1)])
+        self.assertEqual(
+            [len(r['body'].splitlines()) for r in listener.requests], [6, 4])
@@ -0,0 +1,175 @@
+import gzip as _gzip
+import os as _os
+import shutil as _shutil
+import tempfile as _tempfile
+import unittest as _unittest
+
+import bes as _bes
+import bes.__main__ as _bes_main
+import bes.load as _bes_load
+import bes.retry as _bes_retry
+from . import http_listener as _http_listener
+
+
+LINES = [('{{"i": {}}}'.format(i)).encode('utf-8') for i in range(10)]
+
+
+class LoadTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.dir = _tempfile.mkdtemp(prefix='bes-load-')
+        self.path = _os.path.join(self.dir, 'events.json')
+        with open(self.path, 'wb') as f:
+            f.write(b'\n'.join(LINES[:5]) + b'\n\n' + b'\n'.join(LINES[5:]))
+        self.pool = _bes.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+        _shutil.rmtree(self.dir)
+
+    def test_read_lines(self):
+        lines = list(_bes_load.read_lines(self.path))
+        self.assertEqual([line for line, offset in lines], LINES)
+        self.assertEqual(lines[-1][1], _os.path.getsize(self.path))
+        offset = lines[2][1]
+        self.assertEqual(
+            [line for line, offset in _bes_load.read_lines(
+                self.path, offset=offset)],
+            LINES[3:])
+
+    def test_read_gzip(self):
+        path = self.path + '.gz'
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with _gzip.open(path, 'wb') as f:
+            f.write(data)
+        self.assertEqual(
+            list(_bes_load.read_lines(path, offset=10)),
+            list(_bes_load.read_lines(self.path, offset=10)))
+
+    def test_expand(self):
+        other = _os.path.join(self.dir, 'other.json')
+        open(other, 'w').close()
+        self.assertEqual(
+            _bes_load.expand([_os.path.join(self.dir, '*.json'), '-']),
+            [self.path, other, '-'] if self.path < other else
+            [other, self.path, '-'])
+
+    def test_chunks(self):
+        lines = [(line, i) for i, line in enumerate(LINES)]
+        chunks = list(_bes_load.chunks(
+            lines, header=lambda line: b'H\n', max_count=4))
+        self.assertEqual(
+            [(count, end) for body, count, end in chunks],
+            [(4, 3), (4, 7), (2, 9)])
+        self.assertEqual(
+            chunks[0][0],
+            b''.join(b'H\n' + line + b'\n' for line in LINES[:4]))
+
+    def test_timestamp(self):
+        self.assertEqual(
+            _bes_load.timestamp(
+                b'{"@timestamp": "2014-05-13T17:21:01.123456Z", "a": 1}'),
+            1400001661)
+        self.assertEqual(
+            _bes_load.timestamp(b'{"@timestamp":"2014-05-13T19:21:01+02:00"}'),
+            1400001661)
+        self.assertEqual(
+            _bes_load.timestamp(b'{"@timestamp": 1400001661500}'),
+            1400001661.5)
+        self.assertIsNone(_bes_load.timestamp(b'{"@timestamp": "soon"}'))
+        self.assertIsNone(_bes_load.timestamp(b'{"a": 1}'))
+
+    def test_header_datestamp(self):
+        loader = _bes_load.Loader(
+            index='logs', type='record', datestamp_index=True)
+        self.assertEqual(
+            loader.header(b'{"@timestamp": "2014-05-13T23:59:59Z"}'),
+            _bes.HEADERS.get(
+                index='logs', type='record', datestamp_index=True,
+                datestamp_format=_bes.DEFAULT['datestamp_format'],
+                now=1400025599))
+        self.assertIn(
+            b'logs-2014.05.13',
+            loader.header(b'{"@timestamp": "2014-05-13T23:59:59Z"}'))
+
+    def _loader(self, listener, **kwargs):
+        return _bes_load.Loader(
+            type='record', datestamp_index=False, max_count=3,
+            host=listener.host, port=listener.port, protocol='HTTP',
+            pool=self.pool, **kwargs)
+
+    def test_load(self):
+        with _http_listener.HTTPListener() as listener:
+            loader = self._loader(listener, workers=2)
+            loader.load([self.path])
+        self.assertEqual(loader.documents, 10)
+        sources = sorted(
+            line for request in listener.requests
+            for line in request['body'].splitlines()
+            if not line.startswith(b'{"index"'))
+        self.assertEqual(sources, sorted(LINES))
+
+    def test_resume(self):
+        requests = []
+
+        def respond(body):
+            requests.append(body)
+            if len(requests) == 2:
+                return (400, {'error': 'bad request'})
+            return (200, _http_listener.bulk_response(body))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            loader = self._loader(listener, workers=1)
+            with self.assertRaises(_bes_load.LoadError) as context:
+                loader.load([self.path])
+            offset = context.exception.offset
+            self.assertEqual(
+                offset, list(_bes_load.read_lines(self.path))[2][1])
+            loader = self._loader(listener, workers=1)
+            loader.load([self.path], offset=offset)
+        self.assertEqual(loader.documents, 7)
+
+    def test_rejected_items_retried(self):
+        requests = []
+
+        def respond(body):
+            requests.append(body)
+            if len(requests) == 1:
+                return (200, _http_listener.bulk_response(
+                    body, errors={1: (429, 'es_rejected_execution_exception')}))
+            return (200, _http_listener.bulk_response(body))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            loader = self._loader(
+                listener, workers=1,
+                retry_policy=_bes_retry.RetryPolicy(backoff=0))
+            loader.load([self.path])
+        self.assertEqual(len(requests), 5)
+        self.assertEqual(requests[1].splitlines()[1], LINES[1])
+        self.assertEqual(len(requests[1].splitlines()), 2)
+        self.assertEqual((loader.documents, loader.rejected), (10, 0))
+
+    def test_rejected_items_exhausted(self):
+        def respond(body):
+            return (200, _http_listener.bulk_response(
+                body, errors={0: (429, 'es_rejected_execution_exception'),
+                              1: (400, 'mapper_parsing_exception')}))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            loader = self._loader(
+                listener, workers=1,
+                retry_policy=_bes_retry.RetryPolicy(max_retries=1, backoff=0))
+            with self.assertRaises(_bes_load.LoadError) as context:
+                loader.load([self.path])
+        self.assertEqual(context.exception.offset, 0)
+        self.assertEqual(loader.rejected, 1)
+
+    def test_main(self):
+        with _http_listener.HTTPListener() as listener:
+            status = _bes_main.main([
+                'load', '--type', 'record', '--no-datestamp', '--quiet',
+                '--host', listener.host, '--port', str(listener.port),
+                '--protocol', 'HTTP', self.path])
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            sum(len(r['body'].splitlines()) for r in listener.requests), 20)
@@ -0,0 +1,96 @@
+import json as _json
+import logging as _logging
+import threading as _threading
+import unittest as _unittest
+
+import bes as _bes
+import bes.logging as _bes_logging
+
+
+class Emitter (object):
+    def __init__(self, block=None):
+        self.block = block
+        self.messages = []
+
+    def put(self, message):
+        if self.block is not None:
+            self.block.wait()
+        self.messages.append(message)
+
+    def payloads(self):
+        return [
+            _json.loads(message.split(b'\n')[1].decode('utf-8'))
+            for message in self.messages]
+
+
+class BesHandlerTestCase (_unittest.TestCase):
+    def setUp(self):
+        _bes.COUNTERS.reset()
+        self.logger = _logging.getLogger('test.bes.logging')
+        self.logger.propagate = False
+        self.logger.setLevel(_logging.INFO)
+
+    def _handler(self, **kwargs):
+        handler = _bes_logging.BesHandler(**kwargs)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def test_records(self):
+        emitter = Emitter()
+        handler = self._handler(emitter=emitter)
+        self.logger.info('disk %d%% full', 93, extra={'disk': 'sda'})
+        try:
+            raise ValueError('dying')
+        except ValueError:
+            self.logger.exception('oops')
+        self.logger.debug('ignored')
+        handler.close()
+        info, error = emitter.payloads()
+        self.assertEqual(info['message'], 'disk 93% full')
+        self.assertEqual(info['level'], 'INFO')
+        self.assertEqual(info['logger'], 'test.bes.logging')
+        self.assertEqual(info['disk'], 'sda')
+        self.assertEqual(info['@version'], 1)
+        self.assertIn('@timestamp', info)
+        self.assertNotIn('exc_info', info)
+        self.assertEqual(error['message'], 'oops')
+        self.assertEqual(error['level'], 'ERROR')
+        self.assertIn('ValueError: dying', error['exc_info'])
+        self.assertIn(b'"_type": "log"', emitter.messages[0])
+
+    def test_reuses_pipeline(self):
+        handler = self._handler(emitter=Emitter())
+        pipeline = handler._pipeline()
+        self.assertIs(handler._pipeline(), pipeline)
+        self.assertIs(pipeline.emitter, handler.emitter)
+        original = _bes.DEFAULT['index']
+        _bes.DEFAULT['index'] = 'changed'
+        try:
+            self.assertEqual(handler._pipeline().index, 'changed')
+        finally:
+            _bes.DEFAULT['index'] = original
+        handler.close()
+
+    def test_ignores_bes_records(self):
+        emitter = Emitter()
+        handler = _bes_logging.BesHandler(emitter=emitter)
+        _bes.LOG.addHandler(handler)
+        try:
+            _bes.LOG.warning('send failed')
+        finally:
+            _bes.LOG.removeHandler(handler)
+            handler.close()
+        self.assertEqual(emitter.messages, [])
+
+    def test_bounded_queue(self):
+        block = _threading.Event()
+        emitter = Emitter(block=block)
+        handler = self._handler(emitter=emitter, max_queue=2)
+        for i in range(10):
+            self.logger.info('message %d', i)
+        dropped = _bes.COUNTERS.get('log_records_dropped')
+        block.set()
+        handler.close()
+        self.assertTrue(dropped >= 7)
+        self.assertEqual(len(emitter.messages) + dropped, 10)
@@ -0,0 +1,94 @@
+import os as _os
+import shutil as _shutil
+import socket as _socket
+import tempfile as _tempfile
+import threading as _threading
+import unittest as _unittest
+try:
+    import unittest.mock as _mock
+except ImportError:
+    import mock as _mock
+
+import bes as _bes
+import bes.batch as _bes_batch
+import bes.relay as _bes_relay
+
+
+class RelayTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.dir = _tempfile.mkdtemp(prefix='bes-relay-')
+        self.path = _os.path.join(self.dir, 'bes.sock')
+
+    def tearDown(self):
+        _shutil.rmtree(self.dir)
+
+    def test_relay(self):
+        emitter = _mock.MagicMock()
+        received = _threading.Event()
+        emitter.put.side_effect = lambda message: received.set()
+        with _bes_relay.Relay(path=self.path, emitter=emitter) as relay:
+            thread = _threading.Thread(target=relay.serve_forever)
+            thread.start()
+            try:
+                message = _bes.emit(
+                    payload={'hello': 'world'}, type='record',
+                    datestamp_index=False, host=self.path, protocol='UNIX',
+                    pool=None)
+                self.assertTrue(received.wait(5))
+            finally:
+                relay.stop()
+                thread.join()
+        emitter.put.assert_called_once_with(message)
+        emitter.shutdown.assert_called_once_with()
+
+    def test_full_relay_drops(self):
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_DGRAM)
+        sock.bind(self.path)  # but never read
+        try:
+            counters = _bes.Counters()
+            message = b'x' * 1024
+            with _mock.patch.object(_bes, 'COUNTERS', counters):
+                with _bes.Connection(
+                        host=self.path, protocol='UNIX') as connection:
+                    for _ in range(10000):
+                        connection.send(message)
+                        connection.send_parts([message])
+                        if counters.get('unix_dropped') > 1:
+                            break
+            self.assertGreater(counters.get('unix_dropped'), 1)
+            self.assertEqual(counters.get('dropped'), counters.get('unix_dropped'))
+        finally:
+            sock.close()
+
+    def test_serve_requires_upstream_protocol(self):
+        self.assertRaises(
+            ValueError, _bes_relay.serve, path=self.path, protocol='UNIX')
+
+
+@_unittest.skipUnless(
+    hasattr(_os, 'register_at_fork') and hasattr(_os, 'fork'),
+    'requires os.register_at_fork')
+class ForkTestCase (_unittest.TestCase):
+    def test_fork_resets_emitter(self):
+        connection_class = _mock.MagicMock()
+        emitter = _bes_batch.BatchEmitter(
+            connection_class=connection_class, pool=_bes.ConnectionPool(),
+            max_linger=60)
+        emitter.put(b'parent\n')
+        pool_connection = _bes.POOL.get(connection_class=connection_class)
+        pid = _os.fork()
+        if pid == 0:  # child
+            status = 1
+            try:
+                if (emitter._thread is None and
+                        emitter._queue.empty() and
+                        len(_bes.POOL) == 0):
+                    emitter.put(b'child\n')
+                    if emitter.flush(timeout=5):
+                        status = 0
+            finally:
+                _os._exit(status)
+        _, status = _os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        emitter.shutdown(timeout=5)
+        _bes.POOL.discard(pool_connection)
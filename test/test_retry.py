@@ -0,0 +1,113 @@
+import unittest as _unittest
+
+import bes as _bes
+import bes.batch as _bes_batch
+import bes.retry as _bes_retry
+from . import http_listener as _http_listener
+
+
+def _message(i):
+    return (
+        b'{"index": {"_index": "log", "_type": "record"}}\n' +
+        '{{"i": {}}}\n'.format(i).encode('utf-8'))
+
+
+class RetryPolicyTestCase (_unittest.TestCase):
+    def test_delay(self):
+        policy = _bes_retry.RetryPolicy(backoff=1, max_backoff=5)
+        for attempt in range(10):
+            delay = policy.delay(attempt)
+            self.assertTrue(0 <= delay <= min(5, 2 ** attempt))
+
+    def test_max_retries(self):
+        policy = _bes_retry.RetryPolicy(max_retries=2)
+        self.assertTrue(policy.acquire(attempt=1))
+        self.assertFalse(policy.acquire(attempt=2))
+
+    def test_budget(self):
+        policy = _bes_retry.RetryPolicy(budget=2, budget_ratio=0.5)
+        self.assertTrue(policy.acquire(attempt=0))
+        self.assertTrue(policy.acquire(attempt=0))
+        self.assertFalse(policy.acquire(attempt=0))
+        policy.deposit(2)
+        self.assertTrue(policy.acquire(attempt=0))
+
+    def test_retryable_item(self):
+        policy = _bes_retry.RetryPolicy()
+        self.assertTrue(policy.retryable_item({'status': 429}))
+        self.assertTrue(policy.retryable_item({
+            'status': 500,
+            'error': {'type': 'es_rejected_execution_exception'}}))
+        self.assertFalse(policy.retryable_item({
+            'status': 400, 'error': 'mapper_parsing_exception'}))
+
+
+class BatchRetryTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.pool = _bes.ConnectionPool()
+        self.dead = []
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def _emitter(self, listener, **kwargs):
+        return _bes_batch.BatchEmitter(
+            max_linger=60, pool=self.pool,
+            dead_letter=lambda message, reason: self.dead.append(message),
+            host=listener.host, port=listener.port, protocol='HTTP',
+            **kwargs)
+
+    def test_retry_rejected_items(self):
+        responses = [{1: (429, 'es_rejected_execution_exception')}, {}]
+
+        def respond(body):
+            return (200, _http_listener.bulk_response(
+                body, errors=responses.pop(0)))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            emitter = self._emitter(
+                listener, retry_policy=_bes_retry.RetryPolicy(backoff=0))
+            for i in range(3):
+                emitter.put(_message(i))
+            emitter.shutdown(timeout=5)
+        self.assertEqual(
+            [r['body'] for r in listener.requests],
+            [_message(0) + _message(1) + _message(2), _message(1)])
+        self.assertEqual(self.dead, [])
+
+    def test_dead_letter(self):
+        def respond(body):
+            return (200, _http_listener.bulk_response(
+                body, errors={0: (429, 'es_rejected_execution_exception')}))
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            emitter = self._emitter(
+                listener,
+                retry_policy=_bes_retry.RetryPolicy(max_retries=2, backoff=0))
+            emitter.put(_message(0))
+            emitter.flush(timeout=5)
+            emitter.shutdown(timeout=5)
+        self.assertEqual(len(listener.requests), 3)
+        self.assertEqual(self.dead, [_message(0)])
+
+    def test_whole_request_rejected(self):
+        responses = [
+            (429, {'error': 'too many requests'}),
+            (200, None),
+            ]
+
+        def respond(body):
+            status, response = responses.pop(0)
+            if response is None:
+                response = _http_listener.bulk_response(body)
+            return (status, response)
+
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            emitter = self._emitter(
+                listener, retry_policy=_bes_retry.RetryPolicy(backoff=0))
+            emitter.put(_message(0))
+            emitter.put(_message(1))
+            emitter.shutdown(timeout=5)
+        self.assertEqual(
+            [r['body'] for r in listener.requests],
+            [_message(0) + _message(1)] * 2)
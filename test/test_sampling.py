@@ -0,0 +1,67 @@
+import unittest as _unittest
+try:
+    import unittest.mock as _mock
+except ImportError:
+    import mock as _mock
+
+import bes as _bes
+import bes.sampling as _bes_sampling
+
+
+class SamplerTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.reports = []
+
+    def _sampler(self, **kwargs):
+        kwargs.setdefault(
+            'report',
+            lambda counts, interval: self.reports.append(counts))
+        return _bes_sampling.Sampler(**kwargs)
+
+    def test_default_allows(self):
+        sampler = self._sampler()
+        self.assertTrue(sampler.allow(type='request', payload={}))
+
+    def test_rate(self):
+        sampler = self._sampler(rates={'request': 0})
+        self.assertFalse(sampler.allow(type='request', payload={}))
+        self.assertTrue(sampler.allow(type='other', payload={}))
+
+    def test_limit(self):
+        sampler = self._sampler(limits={'request': 2})
+        allowed = [sampler.allow(type='request', payload={})
+                   for i in range(3)]
+        self.assertEqual(allowed, [True, True, False])
+
+    def test_errors_exempt(self):
+        sampler = self._sampler(rates={'request': 0}, limits={'request': 1})
+        for i in range(3):
+            self.assertTrue(
+                sampler.allow(type='request', payload={'action': 'error'}))
+        self.assertTrue(
+            sampler.allow(type='request', payload={'level': 'CRITICAL'}))
+
+    def test_report(self):
+        sampler = self._sampler(
+            rates={'a': 0}, limits={'b': 1}, report_interval=0)
+        sampler.allow(type='b', payload={})
+        sampler.allow(type='a', payload={})
+        sampler.allow(type='b', payload={})
+        self.assertEqual(
+            self.reports,
+            [{'a': {'sampled': 1, 'throttled': 0}},
+             {'b': {'sampled': 0, 'throttled': 1}}])
+
+
+class LogSamplingTestCase (_unittest.TestCase):
+    def test_log_skips_encoding(self):
+        sampler = _bes_sampling.Sampler(rates={'record': 0})
+        connection_class = _mock.MagicMock()
+        with _mock.patch.dict(_bes.DEFAULT, {'sampler': sampler}):
+            with _mock.patch.object(_bes, 'encode') as encode:
+                self.assertIsNone(_bes.log(type='record', a=1))
+                self.assertIsNone(_bes.emit(
+                    payload={'a': 1}, type='record',
+                    connection_class=connection_class))
+        self.assertFalse(encode.called)
+        self.assertFalse(connection_class.called)
@@ -0,0 +1,118 @@
+import shutil as _shutil
+import tempfile as _tempfile
+import unittest as _unittest
+
+import bes as _bes
+import bes.batch as _bes_batch
+import bes.retry as _bes_retry
+import bes.spool as _bes_spool
+from . import http_listener as _http_listener
+
+
+def _message(i):
+    return (
+        b'{"index": {"_index": "log", "_type": "record"}}\n' +
+        '{{"i": {}}}\n'.format(i).encode('utf-8'))
+
+
+class SpoolTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.path = _tempfile.mkdtemp(prefix='bes-spool-')
+
+    def tearDown(self):
+        _shutil.rmtree(self.path)
+
+    def test_replay(self):
+        spool = _bes_spool.Spool(self.path)
+        for i in range(3):
+            spool.append(_message(i))
+        sent = []
+        spool.replay(send=sent.append)
+        self.assertEqual(sent, [_message(0) + _message(1) + _message(2)])
+        self.assertEqual(spool.segments(), [])
+
+    def test_replay_chunks(self):
+        spool = _bes_spool.Spool(self.path)
+        for i in range(3):
+            spool.append(_message(i))
+        spool.append(b'{"delete": {"_id": "1"}}\n')
+        sent = []
+        spool.replay(send=sent.append, max_bytes=2 * len(_message(0)))
+        self.assertEqual(
+            sent,
+            [_message(0) + _message(1),
+             _message(2) + b'{"delete": {"_id": "1"}}\n'])
+
+    def test_resume(self):
+        spool = _bes_spool.Spool(self.path)
+        for i in range(3):
+            spool.append(_message(i))
+        sent = []
+
+        def send(body):
+            if len(sent) == 1:
+                raise IOError('down')
+            sent.append(body)
+
+        self.assertRaises(
+            IOError, spool.replay, send=send, max_bytes=len(_message(0)))
+        spool.replay(send=sent.append)
+        self.assertEqual(
+            sent, [_message(0), _message(1) + _message(2)])
+
+    def test_rotation_and_max_size(self):
+        _bes.COUNTERS.reset()
+        size = len(_message(0))
+        spool = _bes_spool.Spool(
+            self.path, segment_size=size, max_size=2 * size)
+        for i in range(4):
+            spool.append(_message(i))
+        self.assertEqual(len(spool.segments()), 2)
+        self.assertEqual(_bes.COUNTERS.get('spool_dropped_bytes'), 2 * size)
+        sent = []
+        spool.replay(send=sent.append)
+        self.assertEqual(b''.join(sent), _message(2) + _message(3))
+
+    def test_reopen(self):
+        spool = _bes_spool.Spool(self.path)
+        spool.append(_message(0))
+        spool.close()
+        spool = _bes_spool.Spool(self.path)
+        spool.append(_message(1))
+        sent = []
+        spool.replay(send=sent.append)
+        self.assertEqual(sent, [_message(0), _message(1)])
+
+
+class BatchSpoolTestCase (_unittest.TestCase):
+    def setUp(self):
+        self.path = _tempfile.mkdtemp(prefix='bes-spool-')
+        self.pool = _bes.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+        _shutil.rmtree(self.path)
+
+    def test_spool_and_replay(self):
+        statuses = [503]
+
+        def respond(body):
+            if statuses:
+                return (statuses.pop(0), {'error': 'unavailable'})
+            return (200, _http_listener.bulk_response(body))
+
+        spool = _bes_spool.Spool(self.path)
+        with _http_listener.HTTPListener(respond=respond) as listener:
+            emitter = _bes_batch.BatchEmitter(
+                max_linger=60, spool=spool, replay_interval=60,
+                retry_policy=_bes_retry.RetryPolicy(max_retries=0),
+                pool=self.pool, host=listener.host, port=listener.port,
+                protocol='HTTP')
+            emitter.put(_message(0))
+            emitter.flush(timeout=5)
+            self.assertEqual(spool.size(), len(_message(0)))
+            self.assertTrue(emitter._replayer.replay())
+            emitter.shutdown(timeout=5)
+        self.assertEqual(spool.segments(), [])
+        self.assertEqual(
+            [r['body'] for r in listener.requests], [_message(0)] * 2)
@@ -1,6 +1,8 @@
+import gc as _gc
 import inspect as _inspect
 import sys as _sys
 import unittest as _unittest
+import weakref as _weakref
 
 try:
     import wrapt as _wrapt
@@ -228,3 +230,96 @@ class TraceTestCase (_unittest.TestCase):
                 '            return 1 * 2 + 3',
                 '',
                 ]))
+
+
+class AggregateTestCase (_unittest.TestCase):
+    def test_aggregate(self):
+        logger = Logger()
+
+        @_bes_trace.trace(logger=logger, aggregate=True, interval=3600, a=1)
+        def foo(fail=False):
+            if fail:
+                raise ValueError('dying')
+            return 1
+
+        for i in range(3):
+            self.assertEqual(foo(), 1)
+        self.assertRaises(ValueError, foo, fail=True)
+        self.assertEqual(logger.messages, [])
+        _bes_trace.flush_all()
+        self.assertEqual(len(logger.messages), 1)
+        kwargs = logger.messages[0]['kwargs']
+        self.assertEqual(kwargs['action'], 'summary')
+        self.assertEqual(kwargs['type'], 'foo')
+        self.assertEqual(kwargs['a'], 1)
+        self.assertEqual(kwargs['count'], 4)
+        self.assertEqual(kwargs['errors'], 1)
+        self.assertTrue(
+            kwargs['duration_min'] <= kwargs['duration_p50'] <=
+            kwargs['duration_p99'] <= kwargs['duration_max'])
+        _bes_trace.flush_all()
+        self.assertEqual(len(logger.messages), 1)
+
+    def test_collected_function(self):
+        logger = Logger()
+
+        @_bes_trace.trace(logger=logger, aggregate=True, interval=3600)
+        def foo():
+            return 1
+
+        foo()
+        del foo
+        _gc.collect()
+        _bes_trace.flush_all()
+        self.assertEqual(
+            [message['kwargs']['count'] for message in logger.messages], [1])
+
+    def test_method(self):
+        logger = Logger()
+
+        class Foo(object):
+            @_bes_trace.trace(logger=logger, aggregate=True, interval=3600)
+            def bar(self):
+                return 1
+
+        instances = [Foo() for i in range(3)]
+        for instance in instances:
+            instance.bar()
+        references = [_weakref.ref(instance) for instance in instances]
+        del instance, instances
+        _gc.collect()
+        self.assertEqual([reference() for reference in references],
+                         [None, None, None])
+        _bes_trace.flush_all()
+        self.assertEqual(
+            [(message['kwargs']['type'], message['kwargs']['count'])
+             for message in logger.messages],
+            [('bar', 3)])
+
+    def test_interval(self):
+        logger = Logger()
+
+        @_bes_trace.trace(logger=logger, aggregate=True, interval=0)
+        def foo():
+            return 1
+
+        foo()
+        foo()
+        self.assertEqual(
+            [message['kwargs']['count'] for message in logger.messages],
+            [1, 1])
+
+    def test_percentiles(self):
+        logger = Logger()
+        aggregator = _bes_trace.Aggregator(
+            logger=logger, interval=3600, log_kwargs={'type': 'foo'})
+        for i in range(1, 101):
+            aggregator.record(i / 1000.0)
+        aggregator.flush()
+        kwargs = logger.messages[0]['kwargs']
+        self.assertEqual(kwargs['count'], 100)
+        self.assertAlmostEqual(kwargs['duration_sum'], 5.05)
+        for percentile in [50, 90, 99]:
+            value = kwargs['duration_p{}'.format(percentile)]
+            self.assertAlmostEqual(
+                value, percentile / 1000.0, delta=0.13 * percentile / 1000.0)